@@ -0,0 +1,578 @@
+import gzip
+import json
+import time
+import uuid
+import hashlib
+import logging
+import threading
+from collections import OrderedDict, namedtuple
+
+import redis
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+
+LOG = logging.getLogger('cache')
+
+DEFAULT_CACHE_PERIOD = 60 * 60 * 8  # 8 hours
+DEFAULT_STALE_PERIOD = 60 * 60 * 24  # 1 day
+# Values that depend on tags are kept no longer than their versions.
+TAG_VERSION_TTL = DEFAULT_CACHE_PERIOD + DEFAULT_STALE_PERIOD
+PURGE_BATCH = 1000
+
+REDIS_TIMEOUT = 0.25  # seconds, for connecting and each reply
+BREAKER_THRESHOLD = 5
+BREAKER_RESET = 30  # seconds
+
+# Values are compressed once when cached, so favour size over speed.
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 9
+
+REDIS_CONNECTION_ERRORS = (redis.ConnectionError, redis.TimeoutError)
+REDIS_ERRORS = REDIS_CONNECTION_ERRORS + (redis.exceptions.ResponseError, )
+
+# Delete a lock only if it still holds our token.
+UNLOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+
+# `value` is UTF-8 encoded bytes.
+# `encoded` is a dictionary of content encoding to compressed `value`.
+CacheEntry = namedtuple("CacheEntry", ["value", "etag", "fresh", "encoded"])
+
+
+
+class CircuitBreaker(object):
+    """
+    Fails fast after `threshold` consecutive connection failures,
+    then allows a single trial connection every `reset` seconds until
+    one succeeds.
+    """
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, reset=BREAKER_RESET):
+        super(CircuitBreaker, self).__init__()
+        self.threshold = threshold
+        self.reset = reset
+        self.failures = 0
+        self.opened = None
+        self.trips = 0
+
+    @property
+    def closed(self):
+        return self.opened is None
+
+    def allow(self):
+        if self.opened is None:
+            return True
+        now = time.time()
+        if now - self.opened < self.reset:
+            return False
+        # Half open. Hold other callers off for another period
+        # unless this trial succeeds.
+        self.opened = now
+        return True
+
+    def success(self):
+        self.failures = 0
+        self.opened = None
+
+    def failure(self):
+        self.failures += 1
+        if self.opened is None and self.failures >= self.threshold:
+            self.opened = time.time()
+            self.trips += 1
+            LOG.warning(
+                "Redis failed %d times. Skipping it for %d seconds.",
+                self.failures, self.reset)
+
+    def stats(self):
+        return {
+            "closed": self.closed,
+            "failures": self.failures,
+            "trips": self.trips,
+        }
+
+
+
+class BreakerConnection(redis.Connection):
+    "Redis connection that reports to, and is guarded by, a `CircuitBreaker`."
+
+    def __init__(self, breaker=None, **kwargs):
+        super(BreakerConnection, self).__init__(**kwargs)
+        self.breaker = breaker
+
+    def connect(self):
+        if self._sock:
+            return
+        if not self.breaker.allow():
+            raise redis.ConnectionError(
+                "Circuit breaker open for %s:%s." % (self.host, self.port))
+        try:
+            super(BreakerConnection, self).connect()
+        except REDIS_CONNECTION_ERRORS:
+            self.breaker.failure()
+            raise
+
+    def send_packed_command(self, *args, **kwargs):
+        try:
+            super(BreakerConnection, self).send_packed_command(
+                *args, **kwargs)
+        except REDIS_CONNECTION_ERRORS:
+            self.breaker.failure()
+            raise
+
+    def read_response(self, *args, **kwargs):
+        try:
+            response = super(BreakerConnection, self).read_response(
+                *args, **kwargs)
+        except REDIS_CONNECTION_ERRORS:
+            self.breaker.failure()
+            raise
+        self.breaker.success()
+        return response
+
+
+
+_REDIS_CLIENT = None
+
+
+def redis_client():
+    """
+    Returns a Redis client for localhost shared within the process.
+
+    Calls time out after `REDIS_TIMEOUT` seconds, and once Redis has
+    failed repeatedly they raise `redis.ConnectionError` immediately,
+    so that callers treat them as a cache miss without waiting.
+    """
+    global _REDIS_CLIENT
+    if _REDIS_CLIENT is None:
+        pool = redis.ConnectionPool(
+            connection_class=BreakerConnection,
+            breaker=CircuitBreaker(),
+            socket_timeout=REDIS_TIMEOUT,
+            socket_connect_timeout=REDIS_TIMEOUT,
+        )
+        _REDIS_CLIENT = redis.StrictRedis(connection_pool=pool)
+    return _REDIS_CLIENT
+
+
+
+def compute_etag(value):
+    "Same format as `tornado.web.RequestHandler.compute_etag`."
+    return '"%s"' % hashlib.sha1(value).hexdigest()
+
+
+
+def compress(value):
+    "Returns a dictionary of content encoding to compressed `value`."
+    encoded = {
+        "gzip": gzip.compress(value, GZIP_LEVEL),
+    }
+    if brotli:
+        encoded["br"] = brotli.compress(value, quality=BROTLI_QUALITY)
+    return encoded
+
+
+
+def entry_size(entry):
+    return len(entry.value) + sum(len(v) for v in entry.encoded.values())
+
+
+
+class MemoryCache(object):
+    """
+    In-process least-recently-used cache with a limit on the total
+    size of values in bytes.
+
+    Items are tuples of `(entry, expires, tags)`, validated by the
+    `RedisCache` that owns this cache.
+
+    Safe to use from several threads.
+    """
+
+    def __init__(self, max_bytes):
+        super(MemoryCache, self).__init__()
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            self._items.move_to_end(key)
+            return item[0]
+
+    def set(self, key, item, size):
+        with self._lock:
+            self._delete(key)
+            if size > self.max_bytes:
+                return
+            self._items[key] = (item, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                _key, (_item, size_) = self._items.popitem(last=False)
+                self._size -= size_
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._delete(key)
+
+    def _delete(self, key):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self._size -= item[1]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+
+    def stats(self):
+        return {
+            "entries": len(self._items),
+            "bytes": self._size,
+            "maxBytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+
+class RedisCache(object):
+    """
+    Values are stored in hashes with the versions of the tags they
+    depend on. Invalidating a tag increments its version, so values
+    stored against an earlier version become stale. Versions expire
+    after `TAG_VERSION_TTL` seconds without an invalidation, so values
+    with tags are kept no longer than that.
+
+    Values also become stale when their soft TTL passes, but remain
+    in Redis for a further stale period so they can be served while
+    being recomputed.
+
+    `registry` is the key of a set of namespaces used by this
+    deployment, so that previous namespaces can be purged.
+
+    `memory` is the size in bytes of an in-process cache in front
+    of Redis. Its entries are checked against the tag versions in
+    Redis on each read, and cleared when the namespace changes.
+
+    Values of at least `compress_min_length` bytes are also stored
+    compressed, so they can be sent without compressing them for each
+    request. `None` disables compression.
+
+    All Redis errors are treated as a cache miss.
+
+    Methods may be called from several threads, so that coroutines can
+    wait for Redis without blocking the IOLoop.
+    """
+
+    def __init__(self, namespace, registry=None, memory=None,
+                 compress_min_length=None):
+        super(RedisCache, self).__init__()
+        self._cache = redis_client()
+        self._registry = registry
+        self._memory = memory and MemoryCache(memory) or None
+        self._compress_min_length = compress_min_length
+        self._unlock = self._cache.register_script(UNLOCK_SCRIPT)
+        self.set_namespace(namespace)
+
+    def set_namespace(self, namespace):
+        self._namespace = namespace
+        if self._memory:
+            self._memory.clear()
+        if self._registry:
+            try:
+                self._cache.sadd(self._registry, self._namespace)
+            except REDIS_ERRORS:
+                pass
+        return self._namespace
+
+    def get_namespace(self):
+        return self._namespace
+
+    def key(self, key):
+        return self._namespace + ":" + key
+
+    def tag_key(self, tag):
+        return self.key("tag:" + tag)
+
+    @property
+    def name(self):
+        return "redis"
+
+    @property
+    def breaker(self):
+        return self._cache.connection_pool.connection_kwargs.get("breaker")
+
+    @property
+    def connected(self):
+        breaker = self.breaker
+        if breaker and not breaker.closed:
+            return False
+        try:
+            self._cache.ping()
+        except REDIS_ERRORS:
+            return False
+        return True
+
+    def _tag_versions(self, tags):
+        tags = sorted(set(tags))
+        if not tags:
+            return {}
+        versions = self._cache.mget([self.tag_key(tag) for tag in tags])
+        return dict(zip(tags, [int(v or 0) for v in versions]))
+
+    def tag_versions(self, tags):
+        """
+        Snapshot the current versions of `tags`. Take this before
+        querying the data to cache and pass it to `set`, so that writes
+        committed in between invalidate the new value.
+
+        Returns the tag names unchanged if Redis is unavailable,
+        for `set` to resolve at write time.
+        """
+        try:
+            return self._tag_versions(tags)
+        except REDIS_ERRORS:
+            return list(tags)
+
+    def _get_memory_entry(self, key, strict=False):
+        item = self._memory.get(key)
+        if item is None:
+            return None
+        entry, expires, tags = item
+        fresh = not expires or expires >= time.time()
+        if fresh and tags:
+            try:
+                fresh = self._tag_versions(tags) == tags
+            except REDIS_ERRORS:
+                if strict:
+                    return None
+                # Invalidations cannot be recorded either,
+                # so rely on the soft TTL.
+        return entry._replace(fresh=fresh)
+
+    def get_entry(self, key, strict=False):
+        """
+        Returns a `CacheEntry`, or `None` if missing. `fresh` is false if
+        the soft TTL has passed or a tag has been invalidated since
+        the value was computed.
+
+        `strict`:  Return `None` if the tags cannot be checked, rather
+                   than an in-process entry that may have been
+                   invalidated.
+        """
+        key = self.key(key)
+
+        if self._memory:
+            entry = self._get_memory_entry(key, strict)
+            if entry and entry.fresh:
+                self._memory.hits += 1
+                return entry
+            self._memory.misses += 1
+            # A stale entry may have been refreshed by another process.
+            memory_entry = entry
+
+        try:
+            item = self._cache.hgetall(key)
+            if not item:
+                return None
+            fresh = True
+            expires = item.get(b"expires")
+            if expires:
+                expires = float(expires)
+                if expires < time.time():
+                    fresh = False
+            tags = item.get(b"tags")
+            if tags:
+                tags = json.loads(str(tags, "utf-8"))
+                if fresh and self._tag_versions(tags) != tags:
+                    fresh = False
+        except REDIS_ERRORS:
+            if strict:
+                return None
+            return self._memory and memory_entry or None
+
+        value = item.get(b"value") or b""
+        encoded = {}
+        for name, data in item.items():
+            if name.startswith(b"encoded:"):
+                encoded[str(name[8:], "utf-8")] = data
+        entry = CacheEntry(
+            value,
+            str(item.get(b"etag") or b"", "utf-8") or compute_etag(value),
+            fresh,
+            encoded,
+        )
+        if self._memory and fresh:
+            self._memory.set(key, (entry, expires, tags), entry_size(entry))
+        return entry
+
+    def get(self, key, strict=False):
+        """
+        Returns the value for `key` as a string, only if it is fresh.
+        `strict` is as for `get_entry`.
+        """
+        entry = self.get_entry(key, strict)
+        if not (entry and entry.fresh):
+            return None
+        return str(entry.value, "utf-8")
+
+    def set(self, key, value, period=DEFAULT_CACHE_PERIOD, tags=None,
+            stale_period=DEFAULT_STALE_PERIOD):
+        """
+        `period`:        Soft TTL in seconds, after which the value is stale.
+        `tags`:          A list of tag names, or a dictionary of versions
+                         from `tag_versions`.
+        `stale_period`:  Seconds to keep the value after it becomes stale.
+
+        Returns the stored `CacheEntry`.
+        """
+        key = self.key(key)
+
+        if tags:
+            # A tag version that expired would restart from zero, and
+            # could match a value stored before it was invalidated.
+            period = min(period or TAG_VERSION_TTL, TAG_VERSION_TTL)
+            stale_period = min(stale_period or 0, TAG_VERSION_TTL - period)
+
+        if not isinstance(value, bytes):
+            value = str(value).encode("utf-8")
+        encoded = {}
+        if self._compress_min_length is not None and \
+                len(value) >= self._compress_min_length:
+            encoded = compress(value)
+        entry = CacheEntry(value, compute_etag(value), True, encoded)
+        expires = period and time.time() + period or None
+
+        try:
+            if tags is not None and not isinstance(tags, dict):
+                tags = self._tag_versions(tags)
+            item = {
+                "value": value,
+                "etag": entry.etag,
+            }
+            for name, data in encoded.items():
+                item["encoded:" + name] = data
+            if expires:
+                item["expires"] = expires
+            if tags:
+                item["tags"] = json.dumps(tags)
+            pipe = self._cache.pipeline()
+            pipe.delete(key)
+            pipe.hset(key, mapping=item)
+            if period:
+                pipe.expire(key, period + (stale_period or 0))
+            pipe.execute()
+        except REDIS_ERRORS:
+            pass
+
+        if self._memory:
+            if tags is None or isinstance(tags, dict):
+                self._memory.set(
+                    key, (entry, expires, tags), entry_size(entry))
+            else:
+                # Cannot validate without tag versions.
+                self._memory.delete(key)
+
+        return entry
+
+    def delete(self, key):
+        if self._memory:
+            self._memory.delete(self.key(key))
+        try:
+            self._cache.delete(self.key(key))
+        except REDIS_ERRORS:
+            pass
+
+    def stats(self):
+        breaker = self.breaker
+        return {
+            "memory": self._memory and self._memory.stats() or None,
+            "redis": breaker and breaker.stats() or None,
+        }
+
+    def lock(self, key, timeout):
+        """
+        Acquire a lock on `key` that expires after `timeout` seconds.
+
+        Returns a token to pass to `unlock`, or `None` if the lock is
+        already held. If Redis is unavailable there is nothing to
+        coordinate with, so a token is returned anyway.
+        """
+        token = uuid.uuid4().hex
+        try:
+            if not self._cache.set(
+                    self.key("lock:" + key), token,
+                    nx=True, px=int(timeout * 1000)):
+                return None
+        except REDIS_ERRORS:
+            pass
+        return token
+
+    def unlock(self, key, token):
+        try:
+            self._unlock(keys=[self.key("lock:" + key)], args=[token])
+        except REDIS_ERRORS:
+            pass
+
+    def invalidate(self, tags):
+        if not tags:
+            return
+        try:
+            pipe = self._cache.pipeline()
+            for tag in sorted(set(tags)):
+                pipe.incr(self.tag_key(tag))
+                pipe.expire(self.tag_key(tag), TAG_VERSION_TTL)
+            pipe.execute()
+        except REDIS_ERRORS:
+            LOG.warning("Failed to invalidate cache tags: %s", tags)
+
+    def purge(self):
+        """
+        Delete the keys of all namespaces in the registry except the
+        current one.
+        """
+        if not self._registry:
+            return
+        try:
+            namespace_list = self._cache.smembers(self._registry)
+            for namespace in namespace_list:
+                namespace = str(namespace, "utf-8")
+                if namespace == self._namespace:
+                    continue
+                self._purge_namespace(namespace)
+                self._cache.srem(self._registry, namespace)
+        except REDIS_ERRORS:
+            LOG.warning("Failed to purge previous cache namespaces.")
+
+    def _purge_namespace(self, namespace):
+        count = 0
+        batch = []
+        for key in self._cache.scan_iter(
+                match=namespace + ":*", count=PURGE_BATCH):
+            batch.append(key)
+            if len(batch) >= PURGE_BATCH:
+                count += self._cache.delete(*batch)
+                batch = []
+        if batch:
+            count += self._cache.delete(*batch)
+        LOG.info("Purged %d keys from cache namespace %s.", count, namespace)
@@ -0,0 +1,279 @@
+"""
+Compact encoding of the marker and address feeds.
+
+Lists of objects are encoded as parallel arrays, one per key. Columns
+of URLs that differ only by a trailing id are reduced to the ids, and
+coordinates are stored as differences between successive fixed-point
+integers, which are small for nearby markers.
+
+The binary form is a JSON header followed by the coordinate columns
+packed as variable-length integers.
+"""
+
+import re
+import json
+import struct
+
+
+
+JSON_TYPE = "application/vnd.mango.compact+json"
+BINARY_TYPE = "application/vnd.mango.compact"
+VERSION = 1
+SCALE = 10 ** 5  # About one metre.
+COORDINATE_KEYS = (
+    "latitude", "longitude", "south", "north", "west", "east")
+BINARY_MAGIC = b"MNGC"
+
+URL_ID = re.compile(r"^(.*/)([1-9][0-9]*)$")
+
+
+
+def _is_table(value):
+    return bool(value) and isinstance(value, list) and all(
+        isinstance(item, dict) for item in value)
+
+
+
+def _url_prefix(value_list):
+    "Return the common prefix if all values are URLs ending in an id."
+    prefix = None
+    for value in value_list:
+        if value is None:
+            continue
+        if not isinstance(value, str):
+            return None
+        match = URL_ID.match(value)
+        if not match:
+            return None
+        if prefix is None:
+            prefix = match.group(1)
+        elif match.group(1) != prefix:
+            return None
+    return prefix
+
+
+
+def _delta_encode(value_list):
+    delta_list = []
+    last = 0
+    for value in value_list:
+        if value is None:
+            delta_list.append(None)
+            continue
+        value = int(round(value * SCALE))
+        delta_list.append(value - last)
+        last = value
+    return delta_list
+
+
+
+def _delta_decode(delta_list):
+    value_list = []
+    last = 0
+    for delta in delta_list:
+        if delta is None:
+            value_list.append(None)
+            continue
+        last += delta
+        value_list.append(float(last) / SCALE)
+    return value_list
+
+
+
+def encode_table(obj_list):
+    """
+    Encode a list of dictionaries as parallel arrays. Keys missing from
+    some dictionaries decode as `None`.
+    """
+    key_list = []
+    for obj in obj_list:
+        for key in obj:
+            if key not in key_list:
+                key_list.append(key)
+
+    table = {
+        "length": len(obj_list),
+        "columns": {},
+        "ids": {},
+        "deltas": {},
+    }
+
+    for key in key_list:
+        value_list = [obj.get(key, None) for obj in obj_list]
+        if key in COORDINATE_KEYS and all(
+                value is None or isinstance(value, (int, float))
+                for value in value_list):
+            table["deltas"][key] = _delta_encode(value_list)
+            continue
+        prefix = _url_prefix(value_list)
+        if prefix is not None:
+            table["ids"][key] = prefix
+            value_list = [
+                value and int(value[len(prefix):]) for value in value_list]
+        table["columns"][key] = value_list
+
+    return table
+
+
+
+def decode_table(table):
+    column_dict = {}
+    for key, value_list in table["columns"].items():
+        prefix = table["ids"].get(key, None)
+        if prefix is not None:
+            value_list = [
+                value and "%s%d" % (prefix, value) for value in value_list]
+        column_dict[key] = value_list
+    for key, delta_list in table["deltas"].items():
+        column_dict[key] = _delta_decode(delta_list)
+
+    return [
+        {key: value_list[i] for key, value_list in column_dict.items()}
+        for i in range(table["length"])
+    ]
+
+
+
+def encode(obj):
+    """
+    Encode a list of dictionaries, or a dictionary whose values include
+    lists of dictionaries, such as a marker packet.
+    """
+    if _is_table(obj):
+        data = encode_table(obj)
+    elif isinstance(obj, dict):
+        data = {
+            key: {"table": encode_table(value)} if _is_table(value) else value
+            for key, value in obj.items()
+        }
+    else:
+        data = obj
+    return {
+        "version": VERSION,
+        "scale": SCALE,
+        "table": _is_table(obj),
+        "data": data,
+    }
+
+
+
+def decode(document):
+    if document["version"] != VERSION or document["scale"] != SCALE:
+        raise ValueError("Unsupported compact encoding.")
+    data = document["data"]
+    if document["table"]:
+        return decode_table(data)
+    if isinstance(data, dict):
+        return {
+            key: (
+                decode_table(value["table"])
+                if isinstance(value, dict) and list(value) == ["table"]
+                else value
+            )
+            for key, value in data.items()
+        }
+    return data
+
+
+
+def dumps(obj):
+    return json.dumps(encode(obj), separators=(",", ":"))
+
+
+
+def loads(text):
+    return decode(json.loads(text))
+
+
+
+def _table_list(document):
+    data = document["data"]
+    if document["table"]:
+        return [data]
+    if isinstance(data, dict):
+        return [
+            value["table"] for value in data.values()
+            if isinstance(value, dict) and list(value) == ["table"]
+        ]
+    return []
+
+
+
+def _pack_varint(value):
+    # `None` is 0, other values are zigzag encoded and offset by 1.
+    if value is None:
+        value = 0
+    else:
+        value = ((value << 1) ^ (value >> 63)) + 1
+    data = bytearray()
+    while value > 0x7f:
+        data.append((value & 0x7f) | 0x80)
+        value >>= 7
+    data.append(value)
+    return data
+
+
+
+def _unpack_varint(blob, offset):
+    value = 0
+    shift = 0
+    while True:
+        byte = blob[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            break
+        shift += 7
+    if not value:
+        return None, offset
+    value -= 1
+    return (value >> 1) ^ -(value & 1), offset
+
+
+
+def dumps_binary(obj):
+    """
+    `BINARY_MAGIC`, the length of the header as a 32 bit big-endian
+    integer, the header, and then the coordinate columns of each table
+    in the header, in order, with their values replaced by their count.
+    """
+    document = encode(obj)
+    body = bytearray()
+    for table in _table_list(document):
+        for key in sorted(table["deltas"]):
+            delta_list = table["deltas"][key]
+            for delta in delta_list:
+                body += _pack_varint(delta)
+            table["deltas"][key] = len(delta_list)
+
+    header = json.dumps(document, separators=(",", ":")).encode("utf-8")
+    return BINARY_MAGIC + struct.pack(">I", len(header)) + header + \
+        bytes(body)
+
+
+
+def loads_binary(blob):
+    if blob[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+        raise ValueError("Not a compact binary document.")
+    offset = len(BINARY_MAGIC)
+    (length, ) = struct.unpack(">I", blob[offset:offset + 4])
+    offset += 4
+    document = json.loads(blob[offset:offset + length].decode("utf-8"))
+    offset += length
+
+    for table in _table_list(document):
+        for key in sorted(table["deltas"]):
+            delta_list = []
+            for _i in range(table["deltas"][key]):
+                delta, offset = _unpack_varint(blob, offset)
+                delta_list.append(delta)
+            table["deltas"][key] = delta_list
+
+    return decode(document)
+
+
+
+DUMPS = {
+    JSON_TYPE: dumps,
+    BINARY_TYPE: dumps_binary,
+}
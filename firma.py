@@ -8,11 +8,15 @@ import json
 import errno
 import bisect
 import base64
+import atexit
+import shutil
 import logging
 import datetime
+import tempfile
 import functools
 import urllib.parse
 import configparser
+from collections import namedtuple
 
 from dateutil.relativedelta import relativedelta
 
@@ -23,11 +27,14 @@ import tornado.auth
 import tornado.httpserver
 import tornado.options
 import tornado.ioloop
+import tornado.netutil
+import tornado.process
 from tornado import escape
 from tornado.log import app_log
 
-from sqlalchemy.exc import OperationalError
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy import event as sqla_event, bindparam
 
 
 
@@ -38,6 +45,10 @@ DEFAULTS = {
 
 ARG_DEFAULT = []
 
+# Session fields compared with the request by `compare_session`.
+CachedSession = namedtuple("CachedSession", [
+    "session_id", "user_id", "ip_address", "accept_language", "user_agent"])
+
 
 
 def conf_get(ini_path, section, key, default=ARG_DEFAULT):
@@ -91,11 +102,86 @@ class Settings(dict):
 
 
 
+class SqlStats(object):
+    "Number and total duration of the SQL statements run for a request."
+
+    def __init__(self):
+        super(SqlStats, self).__init__()
+        self.count = 0
+        self.duration = 0.0
+
+
+
+def sql_stats_listen(engine, session_factory):
+    """
+    Accumulate the statements run by each session in the `SqlStats`
+    object stored as `session.info["sql_stats"]`, if any.
+    """
+
+    def after_begin(session, _transaction, connection):
+        connection.info["sql_stats"] = session.info.get("sql_stats")
+
+    def before_cursor_execute(conn, *_args):
+        conn.info.setdefault("sql_start", []).append(time.time())
+
+    def after_cursor_execute(conn, *_args):
+        duration = time.time() - conn.info["sql_start"].pop()
+        stats = conn.info.get("sql_stats")
+        if stats:
+            stats.count += 1
+            stats.duration += duration
+
+    def handle_error(context):
+        if context.connection is not None:
+            context.connection.info.get("sql_start", [None]).pop()
+
+    def checkin(_dbapi_connection, connection_record):
+        connection_record.info.pop("sql_stats", None)
+
+    sqla_event.listen(session_factory, "after_begin", after_begin)
+    sqla_event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    sqla_event.listen(engine, "after_cursor_execute", after_cursor_execute)
+    sqla_event.listen(engine, "handle_error", handle_error)
+    sqla_event.listen(engine, "checkin", checkin)
+
+
+
+def gzip_content_encoding(min_length, content_types=()):
+    """
+    Returns a Tornado output transform that compresses responses of at
+    least `min_length` bytes, including the extra `content_types`.
+    Responses that already have a `Content-Encoding` are left alone.
+    """
+    base = tornado.web.GZipContentEncoding
+    return type("GZipContentEncoding", (base, ), {
+        "MIN_LENGTH": min_length,
+        "CONTENT_TYPES": base.CONTENT_TYPES | set(content_types),
+    })
+
+
+
 class Application(tornado.web.Application):
     stats = None
 
+    # Media types to compress in addition to Tornado's defaults.
+    compress_types = ()
+
+    # Set by `init` before forking, so shared by all processes.
+    started = None
+    process_dir = None
+
     RESPONSE_LOG_DURATION = 5 * 60  # Seconds
+    PROCESS_STATUS_INTERVAL = 5  # Seconds
     SESSION_COOKIE_PATH = None
+    SESSION_CACHE_PERIOD = 5 * 60  # Seconds
+    SESSION_TOUCH_INTERVAL = 60  # Seconds
+
+    # Optionally override. The model class passed to `get_session`,
+    # whose access times are written by `flush_session_touches`.
+    session_model = None
+    # Optionally set. A cache of sessions by ID, with `get`, `set` and
+    # `invalidate` methods like `cache.RedisCache`.
+    session_cache = None
 
     # Stats
 
@@ -105,12 +191,20 @@ class Application(tornado.web.Application):
     def add_stat(self, key, value):
         self.stats.append((key, value))
 
+    def server_status(self):
+        "Override to add data to the `/server-status` response."
+        return {}
+
     def write_stats(self):
         self.add_stat(
             "Started",
-            datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+            self.started.strftime("%Y-%m-%dT%H:%M:%SZ")
         )
 
+        if tornado.process.task_id():
+            # Only the first process reports.
+            return
+
         sys.stdout.write("%s is running.\n" % self.title)
         for key, value in self.stats:
             sys.stdout.write("  %-20s %s\n" % (key + ":", value))
@@ -138,6 +232,54 @@ class Application(tornado.web.Application):
         self.add_stat("Cookie prefix", prefix)
 
 
+    # Sessions
+
+    def init_sessions(self):
+        self.session_touches = {}
+        if self.session_model is not None:
+            tornado.ioloop.PeriodicCallback(
+                self.flush_session_touches,
+                self.SESSION_TOUCH_INTERVAL * 1000
+            ).start()
+
+    @staticmethod
+    def session_cache_key(session_id):
+        return "session:%d" % session_id
+
+    def touch_session(self, session_id):
+        "Record access to a session, to be written in the next batch."
+        self.session_touches[session_id] = time.time()
+
+    def flush_session_touches(self):
+        """
+        Write the latest access time of each session touched since the
+        last flush, in a single transaction.
+        """
+        if not self.session_touches:
+            return
+        touches = self.session_touches
+        self.session_touches = {}
+
+        table = self.session_model.__table__
+        statement = table.update() \
+            .where(table.c.session_id == bindparam("_session_id")) \
+            .values(a_time=bindparam("_a_time"))
+
+        # Not part of any request's transaction.
+        orm = self.orm.session_factory()
+        try:
+            orm.execute(statement, [
+                {"_session_id": session_id, "_a_time": a_time}
+                for session_id, a_time in touches.items()
+            ])
+            orm.commit()
+        except SQLAlchemyError:
+            app_log.exception(
+                "Failed to write access times of %d sessions.", len(touches))
+        finally:
+            orm.close()
+
+
     # Response Log
 
     @tornado.gen.coroutine
@@ -153,6 +295,48 @@ class Application(tornado.web.Application):
             self.trim_response_log,
             self.RESPONSE_LOG_DURATION * 1000
         ).start()
+        if self.process_dir:
+            tornado.ioloop.PeriodicCallback(
+                self.write_process_status,
+                self.PROCESS_STATUS_INTERVAL * 1000
+            ).start()
+
+
+    # Processes
+
+    def process_path(self, task_id):
+        return os.path.join(self.process_dir, "%d.json" % task_id)
+
+    def write_process_status(self):
+        "Share this process's response log and status with its siblings."
+        self.trim_response_log()
+        path = self.process_path(tornado.process.task_id())
+        with open(path + ".tmp", "w") as fp:
+            json.dump({
+                "responseLog": self.settings.app.response_log,
+                "status": self.server_status(),
+            }, fp)
+        os.rename(path + ".tmp", path)
+
+    def read_process_status(self):
+        """
+        Returns a list of `(task_id, response_log, status)` for the other
+        processes, as last written by each.
+        """
+        current = tornado.process.task_id()
+        status_list = []
+        for name in sorted(os.listdir(self.process_dir)):
+            match = re.match(r"^([0-9]+)\.json$", name)
+            if not match or int(match.group(1)) == current:
+                continue
+            try:
+                with open(os.path.join(self.process_dir, name)) as fp:
+                    data = json.load(fp)
+            except (IOError, ValueError):
+                continue
+            status_list.append(
+                (int(match.group(1)), data["responseLog"], data["status"]))
+        return status_list
 
 
     # Sibling Applications
@@ -280,6 +464,9 @@ class Application(tornado.web.Application):
 
         self.add_stat("Address",
                       "http://localhost:%d" % self.settings.options.port)
+        if self.process_dir:
+            self.add_stat("Processes", "%d" % (
+                options.processes or tornado.process.cpu_count()))
         if self.settings.options.label:
             self.add_stat("Label", self.settings.options.label)
 
@@ -300,10 +487,21 @@ class Application(tornado.web.Application):
             handlers.insert(1, (r"/server-status", ServerStatusHandler))
             self.init_response_log(self.settings.app)
 
+        self.init_sessions()
+
         _settings = self.settings
         # Resets `self.settings`:
         super(Application, self).__init__(handlers, **settings)
         self.settings = _settings
+
+        if options.compress:
+            self.add_transform(gzip_content_encoding(
+                options.compress_min_length, self.compress_types))
+        self.add_stat(
+            "Compression",
+            options.compress and "%d bytes" % options.compress_min_length or
+            "Disabled")
+
         self.write_stats()
 
 
@@ -312,6 +510,7 @@ class BaseHandler(tornado.web.RequestHandler):
     def __init__(self, *args, **kwargs):
         super(BaseHandler, self).__init__(*args, **kwargs)
         self.start = None
+        self.sql_stats = SqlStats()
         self.url_root = self.request.headers.get("X-Forwarded-Root", "/")
         sys.stdout.flush()
 
@@ -336,22 +535,37 @@ class BaseHandler(tornado.web.RequestHandler):
     def prepare(self):
         self.start = time.time()
 
+    def finish(self, chunk=None):
+        if self.start is not None and not self._headers_written:
+            self.set_header("Server-Timing", ", ".join([
+                'db;dur=%0.1f;desc="%d queries"' % (
+                    self.sql_stats.duration * 1000, self.sql_stats.count),
+                "total;dur=%0.1f" % ((time.time() - self.start) * 1000),
+            ]))
+        return super(BaseHandler, self).finish(chunk)
+
     def on_finish(self):
         if not hasattr(self, "start") or self.start is None:
             return
         now = time.time()
         duration = now - self.start
         self.settings.app.log.uri.log.info(
-            "%s, %s, %s, %s, %0.3f",
+            "%s, %s, %s, %s, %0.3f, %d, %0.3f",
             str(now),
             self.request.uri,
             self.request.remote_ip,
             repr(self.request.headers.get("User-Agent", "User-Agent")),
-            duration
+            duration,
+            self.sql_stats.count,
+            self.sql_stats.duration,
         )
 
         if self.settings.app.response_log is not None:
-            response = [now, self._status_code, duration]
+            response = [
+                now, self._status_code, duration,
+                type(self).__name__,
+                self.sql_stats.count, self.sql_stats.duration,
+            ]
             self.settings.app.response_log.append(response)
 
 
@@ -480,17 +694,22 @@ class BaseHandler(tornado.web.RequestHandler):
             session.accept_language != self.get_accept_language() or \
             session.user_agent != self.get_user_agent()
 
-    def get_session(self, Session):
-        # pylint: disable=invalid-name
-        # `Session` is a class.
-
+    def get_session_id(self):
         session_id = self.app_get_cookie("session")
 
         try:
-            session_id = int(session_id)
+            return int(session_id)
         except (ValueError, TypeError):
             return None
 
+    def get_session(self, Session):
+        # pylint: disable=invalid-name
+        # `Session` is a class.
+
+        session_id = self.get_session_id()
+        if session_id is None:
+            return None
+
         try:
             session = self.orm.query(Session).\
                 filter_by(session_id=session_id).one()
@@ -506,10 +725,72 @@ class BaseHandler(tornado.web.RequestHandler):
             self.end_session()
             return None
 
-        session.touch_commit()
+        self.application.touch_session(session_id)
 
         return session
 
+    def get_session_user_id(self, Session):
+        """
+        Like `get_session`, but returns the user ID, and uses the
+        application's `session_cache` to avoid querying the database.
+        """
+        # pylint: disable=invalid-name
+        # `Session` is a class.
+
+        cache = self.application.session_cache
+        if cache is None:
+            session = self.get_session(Session)
+            return session and session.user_id
+
+        session_id = self.get_session_id()
+        if session_id is None:
+            return None
+
+        key = self.application.session_cache_key(session_id)
+        # A closed session mustn't outlive an invalidation that was
+        # missed because Redis was unavailable.
+        value = cache.get(key, strict=True)
+        if value is None:
+            session = self.get_session(Session)
+            if not session:
+                return None
+            cached = CachedSession(
+                session.session_id,
+                session.user_id,
+                session.ip_address,
+                session.accept_language,
+                session.user_agent,
+            )
+            cache.set(
+                key, json.dumps(cached),
+                period=self.application.SESSION_CACHE_PERIOD, tags=[key])
+            return session.user_id
+
+        cached = CachedSession(*json.loads(value))
+        if self.compare_session(cached):
+            self.end_session()
+            return None
+
+        self.application.touch_session(session_id)
+
+        return cached.user_id
+
+    def close_session(self, Session):
+        # pylint: disable=invalid-name
+        # `Session` is a class.
+
+        session = self.get_session(Session)
+        if session:
+            session.close_commit()
+            cache = self.application.session_cache
+            if cache is not None:
+                key = self.application.session_cache_key(session.session_id)
+                # Deleting also clears this process's copy if Redis is
+                # unavailable to record the invalidation.
+                cache.delete(key)
+                cache.invalidate([key])
+        self.end_session()
+
 
 
 
@@ -734,6 +1015,38 @@ class ServerStatusHandler(tornado.web.RequestHandler):
             "q3": median if q3 is None else q3
         }
 
+    @staticmethod
+    def endpoints(response_log):
+        """
+        Returns request counts and mean durations and SQL statement
+        counts by handler.
+        """
+        endpoints = {}
+        for (
+                _timestamp, _status_code, duration_,
+                endpoint, sql_count, sql_duration
+        ) in (v for v in response_log if len(v) == 6):
+            if endpoint not in endpoints:
+                endpoints[endpoint] = {
+                    "requests": 0,
+                    "duration": 0,
+                    "sqlCount": 0,
+                    "sqlCountMax": 0,
+                    "sqlDuration": 0,
+                }
+            stats = endpoints[endpoint]
+            stats["requests"] += 1
+            stats["duration"] += duration_
+            stats["sqlCount"] += sql_count
+            stats["sqlCountMax"] = max(stats["sqlCountMax"], sql_count)
+            stats["sqlDuration"] += sql_duration
+
+        for stats in endpoints.values():
+            for key in ("duration", "sqlCount", "sqlDuration"):
+                stats[key] /= stats["requests"]
+
+        return endpoints
+
     def get(self):
         if self.settings.app.response_log is None:
             raise tornado.web.HTTPError(404)
@@ -754,13 +1067,31 @@ class ServerStatusHandler(tornado.web.RequestHandler):
         }
 
         self.application.trim_response_log()
+        response_log = self.settings.app.response_log
+        process_list = None
+
+        if self.application.process_dir:
+            start = time.time() - self.application.RESPONSE_LOG_DURATION
+            response_log = list(response_log)
+            process_list = [{
+                "taskId": tornado.process.task_id(),
+                "status": self.application.server_status(),
+            }]
+            for (
+                    task_id, response_log_, status
+            ) in self.application.read_process_status():
+                response_log += [v for v in response_log_ if v[0] >= start]
+                process_list.append({
+                    "taskId": task_id,
+                    "status": status,
+                })
 
         min_ = None
         max_ = None
 
         for (
                 _timestamp, status_code, duration_
-        ) in self.settings.app.response_log:
+        ) in (v[:3] for v in response_log):
             if min_ is None:
                 min_ = duration_
                 max_ = duration_
@@ -776,11 +1107,11 @@ class ServerStatusHandler(tornado.web.RequestHandler):
             duration["max"] = max_
             try:
                 duration.update(self.quartiles([
-                    v[2] for v in self.settings.app.response_log]))
+                    v[2] for v in response_log]))
             except TypeError:
                 sys.stderr.write(
                     "Failed quartiles: %s" %
-                    repr([v[2] for v in self.settings.app.response_log]))
+                    repr([v[2] for v in response_log]))
                 sys.stderr.flush()
                 raise
 
@@ -793,7 +1124,11 @@ class ServerStatusHandler(tornado.web.RequestHandler):
             "label": label,
             "response": response,
             "duration": duration,
+            "endpoints": self.endpoints(response_log),
         }
+        data.update(self.application.server_status())
+        if process_list:
+            data["processes"] = process_list
 
         self.set_header("Access-Control-Allow-Origin", "*")
         self.set_header("Content-Type", "application/json; charset=UTF-8")
@@ -825,6 +1160,16 @@ def init(application, defaults=None):
            help="Log directory. Write permission required."
            "Logging is disabled if this option is not set.")
 
+    define("processes", type=int, default=1,
+           help="Number of processes to fork. 0 forks one per CPU. "
+           "Default is 1.")
+
+    define("compress", type=bool, default=True,
+           help="Compress responses. Default is 1.")
+    define("compress_min_length", type=int, default=1024,
+           help="Only compress responses of at least this many bytes. "
+           "Default is 1024.")
+
     tornado.options.parse_command_line()
     ssl_options = None
     if options.ssl_cert and options.ssl_key:
@@ -832,10 +1177,40 @@ def init(application, defaults=None):
             "certfile": options.ssl_cert,
             "keyfile": options.ssl_key,
         }
+
+    application.started = datetime.datetime.utcnow()
+
+    sockets = None
+    if options.processes != 1:
+        sockets = tornado.netutil.bind_sockets(options.port)
+        application.process_dir = init_process_dir(application.name)
+        # Each process creates its own application, and so its own
+        # database engine and connection pool.
+        tornado.process.fork_processes(options.processes)
+
     http_server = tornado.httpserver.HTTPServer(
         application(),
         xheaders=True,
         ssl_options=ssl_options,
     )
-    http_server.listen(options.port)
-    tornado.ioloop.IOLoop.instance().start()
+    if sockets:
+        http_server.add_sockets(sockets)
+    else:
+        http_server.listen(options.port)
+    tornado.ioloop.IOLoop.current().start()
+
+
+
+def init_process_dir(name):
+    """
+    Create a directory for processes to share their status, removed
+    when the parent process exits.
+    """
+    path = tempfile.mkdtemp(prefix="%s-" % name)
+
+    def remove():
+        if tornado.process.task_id() is None:
+            shutil.rmtree(path, ignore_errors=True)
+
+    atexit.register(remove)
+    return path
@@ -1,7 +1,7 @@
 
 import re
 import json
-import time
+import math
 import urllib.request
 import urllib.parse
 import urllib.error
@@ -9,11 +9,11 @@ import logging
 import socket
 from hashlib import md5
 
-import redis
 import geopy
 import requests
 
 from geolocation import GeoLocation
+from cache import redis_client, REDIS_ERRORS
 
 
 
@@ -22,13 +22,14 @@ LOG.addHandler(logging.StreamHandler())
 
 
 
-GEOCODER = geopy.geocoders.GoogleV3()
-REDIS_SERVER = redis.Redis("localhost")
-WAIT = 0.0
+REDIS_SERVER = redis_client()
 ATTEMPTS = 3
 GEOCODE_CACHE_DEFAULT = True
 # https://developers.google.com/maps/documentation/geocoding/#RegionCodes
 GEOCODE_DEFAULT_REGION = "uk"
+CLUSTER_GRID_SIZE = 60  # Pixels
+CLUSTER_MAX_ZOOM = 15  # Markers are not clustered above this zoom level.
+MAP_MAX_ZOOM = 21
 
 
 
@@ -179,6 +180,21 @@ class Geobox(object):
             self.name and (" '" + self.name[:16] + "'") or "",
             self.south, self.north, self.west, self.east)
 
+    def contains(self, latitude, longitude):
+        if not self.south <= latitude <= self.north:
+            return False
+        if self.is_inverse():
+            return longitude >= self.west or longitude <= self.east
+        return self.west <= longitude <= self.east
+
+    def overlaps(self, south, north, west, east):
+        "Whether the box from `south` to `north`, `west` to `east` overlaps."
+        if north < self.south or south > self.north:
+            return False
+        if self.is_inverse():
+            return east >= self.west or west <= self.east
+        return west <= self.east and east >= self.west
+
     def set_min_radius(self, radius=None):
         # Radius in Km
         if radius is None:
@@ -193,6 +209,167 @@ class Geobox(object):
 
 
 
+def _world_pixel(latitude, longitude, zoom):
+    "Web Mercator pixel coordinates, as used by map tiles."
+    scale = 256 * 2 ** zoom
+    sin = math.sin(math.radians(max(-85, min(85, latitude))))
+    x = (longitude + 180) / 360 * scale
+    y = (0.5 - math.log((1 + sin) / (1 - sin)) / (4 * math.pi)) * scale
+    return x, y
+
+
+
+def cluster_markers(marker_list, zoom, grid_size=CLUSTER_GRID_SIZE):
+    """
+    Group markers that fall in the same `grid_size` pixel square at map
+    zoom level `zoom`.
+
+    `marker_list` is a list of dictionaries with "latitude" and
+    "longitude" keys. Returns `(cluster_list, marker_list)`, where
+    `cluster_list` has the centroid, bounds and count of each group of
+    more than one marker, and `marker_list` has the markers left on
+    their own. Markers without coordinates are dropped.
+    """
+    if zoom > CLUSTER_MAX_ZOOM:
+        return [], [
+            marker for marker in marker_list
+            if marker["latitude"] is not None and
+            marker["longitude"] is not None
+        ]
+
+    grid = {}
+    for marker in marker_list:
+        latitude = marker["latitude"]
+        longitude = marker["longitude"]
+        if latitude is None or longitude is None:
+            continue
+        x, y = _world_pixel(latitude, longitude, zoom)
+        grid.setdefault((int(x // grid_size), int(y // grid_size)), []) \
+            .append(marker)
+
+    cluster_list = []
+    single_list = []
+    for cell_marker_list in grid.values():
+        if len(cell_marker_list) == 1:
+            single_list.append(cell_marker_list[0])
+            continue
+        latitude_list = [marker["latitude"] for marker in cell_marker_list]
+        longitude_list = [marker["longitude"] for marker in cell_marker_list]
+        count = len(cell_marker_list)
+        cluster_list.append({
+            "latitude": sum(latitude_list) / count,
+            "longitude": sum(longitude_list) / count,
+            "count": count,
+            "south": min(latitude_list),
+            "north": max(latitude_list),
+            "west": min(longitude_list),
+            "east": max(longitude_list),
+        })
+
+    return cluster_list, single_list
+
+
+
+def filter_clusters(packet, geobox):
+    """
+    Returns a copy of a dictionary with "clusterList" and "markerList"
+    keys, without the markers outside `geobox` or the clusters whose
+    bounds don't overlap it. `packet` is not changed.
+    """
+    return {
+        "clusterList": [
+            cluster for cluster in packet["clusterList"]
+            if geobox.overlaps(
+                cluster["south"], cluster["north"],
+                cluster["west"], cluster["east"])
+        ],
+        "markerList": [
+            marker for marker in packet["markerList"]
+            if geobox.contains(marker["latitude"], marker["longitude"])
+        ],
+    }
+
+
+
+class GeocodeRetry(Exception):
+    """
+    The geocoder is over quota or unreachable, and the lookup should be
+    tried again later.
+    """
+
+
+
+class GoogleGeocoder(object):
+    """
+    Geocode with the Google geocoding API.
+    """
+    def __init__(self, region=GEOCODE_DEFAULT_REGION):
+        self.region = region
+        self.geocoder = geopy.geocoders.GoogleV3()
+
+    def geocode(self, address):
+        """
+        Return `(latitude, longitude)` or `None` if not found.
+        Raises `GeocodeRetry` if over quota or the geocoder can't be
+        reached, so that isn't mistaken for not found.
+        """
+        # pylint: disable=unpacking-non-sequence
+        for term in EXCLUDE:
+            if term in address.lower():
+                return None
+        try:
+            result = self.geocoder.geocode(address, region=self.region)
+        except (
+                geopy.exc.GeocoderQuotaExceeded,
+                geopy.exc.GeocoderTimedOut,
+                geopy.exc.GeocoderUnavailable,
+                urllib.error.URLError,
+        ) as e:
+            raise GeocodeRetry(e)
+        except (
+                geopy.exc.GeocoderQueryError,
+                ValueError,
+        ) as e:
+            print(e)
+            return None
+        if result is None:
+            print("No address found for %s." % repr(address))
+            return None
+
+        _address, (latitude, longitude) = result
+        return (latitude, longitude)
+
+
+
+class FakeGeocoder(object):
+    """
+    Geocode to stable coordinates derived from the address, without
+    network access, for testing and local development.
+    """
+    def __init__(self, south=51.3, north=51.7, west=-0.5, east=0.3):
+        self.south = south
+        self.north = north
+        self.west = west
+        self.east = east
+
+    def geocode(self, address):
+        for term in EXCLUDE:
+            if term in address.lower():
+                return None
+        digest = md5(address.encode("utf-8")).digest()
+        y = int.from_bytes(digest[:4], "big") / 0xffffffff
+        x = int.from_bytes(digest[4:8], "big") / 0xffffffff
+        return (
+            self.south + y * (self.north - self.south),
+            self.west + x * (self.east - self.west),
+        )
+
+
+
+GEOCODER = GoogleGeocoder()
+
+
+
 def clean_address(address):
     address = re.sub(r"\s+", " ", address)
     address = address.strip()
@@ -211,9 +388,6 @@ def geo_key(category, value):
 
 
 def coords(address, cache=GEOCODE_CACHE_DEFAULT):
-    # pylint: disable=too-many-return-statements
-    global WAIT
-
     address = clean_address(address)
 
     key = geo_key("coords", address)
@@ -222,7 +396,7 @@ def coords(address, cache=GEOCODE_CACHE_DEFAULT):
         value = None
         try:
             value = REDIS_SERVER.get(key)
-        except redis.ConnectionError as e:
+        except REDIS_ERRORS:
             LOG.warning("Connection to redis server on localhost failed.")
 
         if value:
@@ -232,61 +406,28 @@ def coords(address, cache=GEOCODE_CACHE_DEFAULT):
             except ValueError:
                 LOG.debug("Could not decode JSON.")
 
-    attempts = ATTEMPTS
-    while attempts:
-        # pylint: disable=unpacking-non-sequence
-        attempts -= 1
+    try:
+        result = GEOCODER.geocode(address)
+    except GeocodeRetry as e:
+        # Don't hold up the request. `BatchGeocoder` retries later.
+        LOG.warning("Geocoder unavailable for %s: %s", repr(address), e)
+        return None
+    if result is None:
+        return None
 
-        if WAIT:
-            LOG.info("Waiting: %.3f", WAIT)
-            time.sleep(WAIT)
-        for term in EXCLUDE:
-            if term in address.lower():
-                return None
-        try:
-            result = GEOCODER.geocode(
-                address,
-                region=GEOCODE_DEFAULT_REGION,
-                )
-        except geopy.exc.GeocoderTimedOut as e:
-            print(e)
-            return None
-        except geopy.exc.GeocoderUnavailable as e:
-            print(e)
-            return None
-        except geopy.exc.GeocoderQueryError as e:
-            print(e)
-            return None
-        except geopy.exc.GeocoderQuotaExceeded as e:
-            print(e)
-            WAIT += 1
-            continue
-        except urllib.error.URLError as e:
-            print(e)
-            return None
-        except ValueError as e:
-            print(e)
-            return None
-        if result is None:
-            print("No address found for %s." % repr(address))
-            return None
-
-        address, (latitude, longitude) = result
+    (latitude, longitude) = result
 
-        value = json.dumps((latitude, longitude))
-        try:
-            REDIS_SERVER.set(key, value)
-        except redis.ConnectionError as e:
-            LOG.warning("Connection to redis server on localhost failed.")
-        WAIT = max(0, WAIT - .1)
-        break
+    value = json.dumps((latitude, longitude))
+    try:
+        REDIS_SERVER.set(key, value)
+    except REDIS_ERRORS:
+        LOG.warning("Connection to redis server on localhost failed.")
 
     return (latitude, longitude)
 
 
 
 def bounds(address_full, min_radius=None, cache=GEOCODE_CACHE_DEFAULT):
-    global WAIT
     bounds_ = None
 
     address = clean_address(address_full)
@@ -297,7 +438,7 @@ def bounds(address_full, min_radius=None, cache=GEOCODE_CACHE_DEFAULT):
         value = None
         try:
             value = REDIS_SERVER.get(key)
-        except redis.ConnectionError:
+        except REDIS_ERRORS:
             LOG.warning("Connection to redis server on localhost failed.")
 
         if value:
@@ -310,9 +451,6 @@ def bounds(address_full, min_radius=None, cache=GEOCODE_CACHE_DEFAULT):
 
     if not value:
         for _i in range(ATTEMPTS):
-            if WAIT:
-                time.sleep(WAIT)
-
             parameters = urllib.parse.urlencode({
                 "sensor": "false",
                 "address": address,
@@ -359,10 +497,9 @@ def bounds(address_full, min_radius=None, cache=GEOCODE_CACHE_DEFAULT):
 
             try:
                 REDIS_SERVER.set(key, value.to_json())
-            except redis.ConnectionError:
+            except REDIS_ERRORS:
                 LOG.warning("Connection to redis server on localhost failed.")
 
-            WAIT = max(0, WAIT - .1)
             break
         else:
             return None
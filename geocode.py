@@ -0,0 +1,183 @@
+"""
+Batch geocoding.
+
+Addresses are queued and geocoded by a bounded number of concurrent
+workers, each lookup waiting for a token from a shared rate limiter.
+Results, including addresses that could not be found, are kept in a
+local SQLite store so that interrupted or repeated runs don't
+look anything up twice.
+"""
+
+import time
+import sqlite3
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from tornado import gen
+
+from geo import GeocodeRetry, clean_address
+
+
+
+LOG = logging.getLogger('geocode')
+
+
+
+class TokenBucket(object):
+    """
+    Allow `rate` events per second on average, and bursts of up to
+    `burst` events.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = None
+
+    def delay(self, now=None):
+        """
+        Take a token and return the number of seconds to wait before
+        using it.
+        """
+        if now is None:
+            now = time.time()
+        if self.updated is not None:
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    @gen.coroutine
+    def acquire(self):
+        delay = self.delay()
+        if delay:
+            yield gen.sleep(delay)
+
+
+
+class GeocodeStore(object):
+    """
+    Persistent store of geocoding results, keyed by cleaned address.
+    """
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("""
+create table if not exists geocode (
+  address text primary key,
+  latitude real,
+  longitude real,
+  a_time real not null
+)""")
+        self.connection.commit()
+
+    def get(self, address):
+        """
+        Return `(found, coords)` where `found` is `True` if the address has
+        been looked up before, and `coords` is `None` if it wasn't found.
+        """
+        row = self.connection.execute(
+            "select latitude, longitude from geocode where address = ?",
+            (clean_address(address), )
+        ).fetchone()
+        if row is None:
+            return False, None
+        if row[0] is None:
+            return True, None
+        return True, (row[0], row[1])
+
+    def set(self, address, coords):
+        latitude, longitude = coords or (None, None)
+        self.connection.execute(
+            "insert or replace into geocode values (?, ?, ?, ?)",
+            (clean_address(address), latitude, longitude, time.time()))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+
+class BatchGeocoder(object):
+    """
+    Geocode many addresses with `geocoder`, a `geo.GoogleGeocoder`,
+    `geo.FakeGeocoder` or any object with the same `geocode` method.
+    """
+    def __init__(self, geocoder, store, concurrency=4, rate=10,
+                 attempts=3, retry_wait=2):
+        self.geocoder = geocoder
+        self.store = store
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate, burst=concurrency)
+        self.attempts = attempts
+        self.retry_wait = retry_wait
+        self.executor = ThreadPoolExecutor(concurrency)
+        self.lookups = 0
+        self.retries = 0
+
+    @gen.coroutine
+    def geocode_all(self, address_list, callback=None):
+        """
+        Return a dictionary of address to coordinates, or `None` for
+        addresses that could not be found.
+
+        `callback(address, coords)` is called as each result arrives.
+        """
+        results = {}
+        lookup_list = []
+
+        for address in set(address_list):
+            found, coords = self.store.get(address)
+            if found:
+                results[address] = coords
+                continue
+            lookup_list.append(address)
+
+        LOG.info("%d addresses stored, %d to look up.",
+                 len(results), len(lookup_list))
+
+        # Shared by the workers, so each address is taken once.
+        pending = iter(lookup_list)
+
+        @gen.coroutine
+        def worker():
+            # pylint: disable=broad-except
+            # One address failing shouldn't stop the rest.
+            for address in pending:
+                try:
+                    coords = yield self.geocode(address)
+                    self.store.set(address, coords)
+                    results[address] = coords
+                    if callback:
+                        callback(address, coords)
+                except GeocodeRetry as e:
+                    LOG.warning("Giving up on %r: %s", address, e)
+                except Exception:
+                    LOG.exception("Failed to geocode %r.", address)
+
+        yield [worker() for _i in range(self.concurrency)]
+
+        return results
+
+    @gen.coroutine
+    def geocode(self, address):
+        """
+        Return coordinates for a single address, backing off while the
+        geocoder is over quota or unreachable. Raises `GeocodeRetry` if it
+        still is after all attempts.
+        """
+        for attempt in range(self.attempts):
+            yield self.bucket.acquire()
+            self.lookups += 1
+            try:
+                coords = yield self.executor.submit(
+                    self.geocoder.geocode, address)
+            except GeocodeRetry:
+                if attempt + 1 == self.attempts:
+                    raise
+                self.retries += 1
+                yield gen.sleep(self.retry_wait * 2 ** attempt)
+                continue
+            return coords
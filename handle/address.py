@@ -5,8 +5,11 @@ from sqlalchemy import and_
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.sql import func
 from sqlalchemy.sql.expression import literal
+from tornado import gen
 from tornado.web import HTTPError
 
+import geo
+
 from model import User, Address, Org, Event, \
     org_address, event_address, detach
 
@@ -140,9 +143,9 @@ class BaseAddressHandler(BaseHandler, MangoBaseEntityHandlerMixin):
 
         return address_v and address_v.a_time or None
 
-    @staticmethod
-    def _before_address_set(address):
-        address.geocode()
+    @gen.coroutine
+    def _before_address_set(self, address):
+        yield self.geocode_address(address)
 
     def _after_address_accept_new(self, address):
         accept_list = [
@@ -422,17 +425,10 @@ class AddressRevisionHandler(BaseAddressHandler):
 
 
 class AddressEntityListHandler(BaseHandler):
-    def get(self):
+    def _get_address_list(self, zoom=None):
         # pylint: disable=singleton-comparison
         # Cannot use `is` in SQLAlchemy filters
 
-        key = "address:%s" % ["public", "all"][self.deep_visible()]
-
-        value = self.cache.get(key)
-        if value:
-            self.write(value)
-            return
-
         address_list = self.orm.query(
             Address.address_id,
             func.coalesce(Address.latitude, Address.manual_latitude),
@@ -470,21 +466,60 @@ class AddressEntityListHandler(BaseHandler):
                 "entity_id", "name", "entity"
             ], result))))
 
-        value = self.dump_json(obj_list)
-        self.cache.set(key, value)
+        if zoom is None:
+            return obj_list
+
+        cluster_list, marker_list = geo.cluster_markers(obj_list, zoom)
+        return {
+            "clusterList": cluster_list,
+            "markerList": marker_list,
+        }
+
+    @gen.coroutine
+    def get(self):
+        # pylint: disable=protected-access
+        # Calling the handler's own methods on its `db_view`.
+        is_json = self.content_type("application/json")
+        zoom = self.get_argument_zoom("zoom", None, is_json=is_json)
+        location = None
+        if zoom is not None:
+            location = self.get_argument_geobox(
+                "location", default=None, is_json=is_json)
+
+        key = "address:%s" % ["public", "all"][self.deep_visible()]
+        if zoom is not None:
+            key += ":zoom:%d" % zoom
+
+        media_type = self.compact_type()
+
+        entry = yield self.cache_fetch_json(
+            key, lambda db: db._get_address_list(zoom),
+            ["address", "org", "event"],
+            None if location else media_type, self.dump_json)
+
+        self.set_cache_control()
+
+        if location:
+            # Clusters for the whole map are cached as JSON for each zoom
+            # level, and only decoded when they change.
+            packet = geo.filter_clusters(
+                self.cache_load_json(entry), location)
+            self.write_json(packet, media_type)
+            return
 
-        self.write(value)
+        self.write_json_entry(entry, media_type)
 
 
 
 class AddressLookupHandler(BaseAddressHandler):
+    @gen.coroutine
     def get(self):
         is_json = self.content_type("application/json")
         postal = self.get_argument("postal", is_json=is_json)
         lookup = self.get_argument("lookup", None, is_json=is_json)
 
         address = Address(postal, None, lookup)
-        address.geocode()
+        yield self.geocode_address(address)
 
         self.write_json(address.obj(
             public=self.moderator,
@@ -200,10 +200,7 @@ class AuthLogoutHandler(BaseHandler):
 
     @authenticated
     def get(self):
-        session = self.get_session(Session)
-        if session:
-            session.close_commit()
-        self.end_session()
+        self.close_session(Session)
         self.clear_cookie("_xsrf")
         if self.next_:
             if (not self.moderator) or self.path_is_authenticated(self.next_):
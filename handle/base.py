@@ -1,7 +1,9 @@
 
 import re
 import sys
+import copy
 import json
+import time
 import hashlib
 import http.client
 import datetime
@@ -16,6 +18,8 @@ from sqlalchemy.sql.expression import exists
 from mako import exceptions
 
 from tornado.web import RequestHandler, HTTPError
+from tornado.ioloop import IOLoop
+from tornado.log import app_log
 # from tornado.web import authenticated as tornado_authenticated
 
 # For _execute replacement
@@ -27,6 +31,7 @@ from tornado.web import _has_stream_request_body
 import firma
 
 import geo
+import compact
 
 from model import Session, User, camel_case
 
@@ -37,6 +42,12 @@ from handle.markdown_safe import markdown_safe, convert_links
 
 GOOGLE_MAPS_API_VERSION = "3"
 
+CACHE_LOCK_TIMEOUT = 30  # Seconds
+CACHE_LOCK_POLL = 0.05  # Seconds, doubling up to `CACHE_LOCK_POLL_MAX`
+CACHE_LOCK_POLL_MAX = 0.8
+CONTENT_ENCODINGS = ("br", "gzip")  # Preferred first
+CACHE_CONTROL_MAX_AGE = 300  # Seconds
+
 
 
 def sha1_concat(*parts):
@@ -203,7 +214,10 @@ class BaseHandler(firma.BaseHandler):
         self.SUPPORTED_METHODS += ("TOUCH", )
         self.messages = []
         self.scripts = []
-        self.orm = self.application.orm()
+        # A session of the request's own, rather than the thread's scoped
+        # session, so concurrent requests don't count each other's queries.
+        self.orm = self.application.orm.session_factory(
+            info={"sql_stats": self.sql_stats})
         self.has_javascript = self.app_get_cookie("javascript", secure=False)
         self.set_parameters()
         self.next_ = self.get_argument("next", None)
@@ -215,8 +229,7 @@ class BaseHandler(firma.BaseHandler):
     def on_finish(self):
         super(BaseHandler, self).on_finish()
 
-        if self.application.orm:
-            self.application.orm.remove()
+        self.orm.close()
 
     def initialize(self, **kwargs):
         self.arg_type_handlers = kwargs.get("types", [])
@@ -360,6 +373,35 @@ class BaseHandler(firma.BaseHandler):
             return name.lower() in self.request.headers["Accept"].lower()
         return False
 
+    def accept_encoding(self, encoding_list):
+        """
+        Return the first content encoding in `encoding_list` the client
+        accepts, if any.
+        """
+        accepted = set()
+        header = self.request.headers.get("Accept-Encoding", "")
+        for part in header.split(","):
+            name, _sep, params = part.partition(";")
+            match = re.search(r"q=([0-9.]+)", params)
+            if match and not float(match.group(1)):
+                continue
+            accepted.add(name.strip().lower())
+        for encoding in encoding_list:
+            if encoding in accepted:
+                return encoding
+        return None
+
+    def compact_type(self):
+        "Return the compact media type the client accepts, if any."
+        # Responses for the same URL depend on `Accept`.
+        self.add_header("Vary", "Accept")
+        # The JSON type contains the binary type, so check it first.
+        if self.accept_type(compact.JSON_TYPE):
+            return compact.JSON_TYPE
+        if self.accept_type(compact.BINARY_TYPE):
+            return compact.BINARY_TYPE
+        return None
+
     def is_local(self):
         return self.request.remote_ip == "127.0.0.1"
 
@@ -490,7 +532,7 @@ class BaseHandler(firma.BaseHandler):
         if self.moderator:
             kwargs.update({
                 "has_queue": has_pending(self.orm),
-                "has_address_not_found": has_address_not_found(self.orm),
+                "has_address_not_found": self.count_address_not_found(),
             })
 
         try:
@@ -504,11 +546,20 @@ class BaseHandler(firma.BaseHandler):
             self.orm.rollback()
 
     # required by tornado auth
+    def count_address_not_found(self):
+        key = "moderation:address-not-found"
+        value = self.cache.get(key)
+        if value is None:
+            cache_tags = self.cache.tag_versions(["org", "address"])
+            value = has_address_not_found(self.orm)
+            self.cache.set(key, value, tags=cache_tags)
+        return int(value)
+
     def get_current_user(self):
-        session = self.get_session(Session)
-        if session:
-            return session.user
-        return None
+        user_id = self.get_session_user_id(Session)
+        if user_id is None:
+            return None
+        return self.orm.query(User).get(user_id)
 
 
     # Entities
@@ -680,6 +731,21 @@ select auto_increment
         return self.get_argument_allowed(
             "view", ("browse", "edit"), None, is_json=is_json)
 
+    def get_argument_zoom(self, name, default=_ARG_DEFAULT_MANGO,
+                          is_json=False):
+        def helper(value):
+            value = int(value)
+            if not 0 <= value <= geo.MAP_MAX_ZOOM:
+                raise ValueError
+            return value
+
+        return self.get_argument_restricted(
+            name,
+            helper,
+            "Value must be a map zoom level from 0 to %d" % geo.MAP_MAX_ZOOM,
+            default,
+            is_json)
+
     def get_argument_geobox(self, name, min_radius=None,
                             default=_ARG_DEFAULT_MANGO, is_json=False):
         value = self.get_argument(name, default, is_json=is_json)
@@ -760,10 +826,63 @@ select auto_increment
     def dump_json(obj):
         return json.dumps(obj, indent=2)
 
-    def write_json(self, obj):
-        self.set_header("Content-Type", "application/json; charset=UTF-8")
+    def _set_json_content_type(self, media_type):
+        if media_type == compact.BINARY_TYPE:
+            self.set_header("Content-Type", media_type)
+        else:
+            self.set_header("Content-Type", "%s; charset=UTF-8" % (
+                media_type or "application/json"))
+
+    def write_json(self, obj, media_type=None):
+        """
+        `media_type`:  A compact type from `compact_type`, or `None`
+                       for plain JSON.
+        """
+        self._set_json_content_type(media_type)
+        if media_type:
+            self.write(compact.DUMPS[media_type](obj))
+            return
         self.write(self.dump_json(obj))
 
+    def set_cache_control(self, max_age=CACHE_CONTROL_MAX_AGE):
+        """
+        Allow browsers and proxies to reuse the response for `max_age`
+        seconds, and then to revalidate it with its ETag.
+
+        Responses with a moderator's visibility are only reused by
+        the moderator's browser.
+        """
+        if self.parameters.get("visibility", None):
+            self.set_header("Cache-Control", "private, no-cache")
+            return
+        self.set_header("Cache-Control", "public, max-age=%d" % max_age)
+
+    def write_json_entry(self, entry, media_type=None):
+        """
+        Write a cached JSON document using its precomputed ETag,
+        and precompressed value if the client accepts it.
+
+        `media_type`:  As passed to `cache_fetch_json`.
+        """
+        self._set_json_content_type(media_type)
+
+        value = entry.value
+        etag = entry.etag
+        encoding = self.accept_encoding(
+            [v for v in CONTENT_ENCODINGS if v in entry.encoded])
+        if encoding:
+            # Tornado's own compression skips encoded responses.
+            self.set_header("Content-Encoding", encoding)
+            value = entry.encoded[encoding]
+            etag = '%s-%s"' % (etag[:-1], encoding)
+
+        # Tornado only checks `If-None-Match` when it computes the ETag.
+        self.set_header("Etag", etag)
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        self.write(value)
+
     def filter_visibility(self, query, Entity, visibility=None,
                           secondary=False, null_column=False):
         """
@@ -814,7 +933,6 @@ select auto_increment
             self.orm.commit()
         except IntegrityError as e:
             raise HTTPError(500, e.message)
-        self.application.increment_cache()
 
     @property
     def moderator(self):
@@ -828,6 +946,179 @@ select auto_increment
     def cache(self):
         return self.application.cache
 
+    @gen.coroutine
+    def cache_fetch(self, key, compute, tags=None, search=False):
+        """
+        Returns a `CacheEntry` for `key`, calling `compute(db)` to
+        generate its value if necessary and caching it against `tags`.
+        `db` is as passed by `run_db`, or `run_search` if `search`.
+
+        Stale values are returned immediately, and recomputed in the
+        background after the request has finished.
+
+        Only one request at a time, across all processes, computes
+        a given key. Concurrent requests for a missing key wait for
+        the result, until the lock expires.
+        """
+        deadline = time.time() + CACHE_LOCK_TIMEOUT
+        poll = CACHE_LOCK_POLL
+        while True:
+            entry = yield self.run_cache(self.cache.get_entry, key)
+            if entry and entry.fresh:
+                return entry
+            token = yield self.run_cache(
+                self.cache.lock, key, CACHE_LOCK_TIMEOUT)
+            if entry:
+                if token:
+                    # The request's session is closed when it finishes.
+                    IOLoop.current().spawn_callback(
+                        self._cache_refresh, key, compute, tags, token,
+                        self.db_view(), search)
+                return entry
+            if token or time.time() > deadline:
+                break
+            yield gen.sleep(poll)
+            poll = min(poll * 2, CACHE_LOCK_POLL_MAX)
+
+        try:
+            cache_tags = yield self.run_cache(
+                self.cache.tag_versions, tags or [])
+            if search:
+                value = yield self.run_search(compute)
+            else:
+                value = yield self.run_db(compute)
+            entry = yield self.run_cache(
+                self.cache.set, key, value, tags=cache_tags)
+        finally:
+            if token:
+                yield self.run_cache(self.cache.unlock, key, token)
+
+        return entry
+
+    @gen.coroutine
+    def cache_fetch_json(self, key, compute, tags=None, media_type=None,
+                         dump=json.dumps, search=False):
+        """
+        Like `cache_fetch`, but `compute` returns an object, which is
+        cached as JSON using `dump`, or separately in the compact
+        encoding `media_type`.
+        """
+        if media_type:
+            key = "%s:%s" % (key, media_type)
+            dump = compact.DUMPS[media_type]
+        entry = yield self.cache_fetch(
+            key, lambda db: dump(compute(db)), tags, search)
+        return entry
+
+    def cache_load_json(self, entry):
+        """
+        Returns the object cached as JSON in `entry`, decoded once per
+        process for each value. The object is shared, so don't modify it.
+        """
+        json_cache = self.application.json_cache
+        obj = json_cache and json_cache.get(entry.etag)
+        if obj is None:
+            obj = json.loads(entry.value.decode("utf-8"))
+            if json_cache:
+                json_cache.set(entry.etag, obj, len(entry.value))
+        return obj
+
+    @gen.coroutine
+    def _cache_refresh(self, key, compute, tags, token, db, search):
+        # pylint: disable=broad-except
+        # Background task has no request to report errors to.
+
+        try:
+            cache_tags = yield self.run_cache(
+                self.cache.tag_versions, tags or [])
+            executor = self.application.db_executor or (
+                search and self.application.search_executor)
+            if executor:
+                value = yield executor.submit(self._run_db, compute, db)
+            else:
+                value = self._run_db(compute, db)
+            yield self.run_cache(self.cache.set, key, value, tags=cache_tags)
+        except Exception:
+            app_log.exception("Failed to refresh cache key %s", key)
+        finally:
+            yield self.run_cache(self.cache.unlock, key, token)
+
+    def db_view(self):
+        """
+        Returns a shallow copy of the handler with a session of its own
+        as `orm`, for database work on another thread or after the
+        request has finished. The caller closes `orm`.
+
+        The copy shares the request and response, so it should only
+        query and return plain data, not render or write.
+        """
+        # Load the user with the request's own session.
+        self.current_user  # pylint: disable=pointless-statement
+        db = copy.copy(self)
+        db.orm = self.application.orm.session_factory(
+            info={"sql_stats": self.sql_stats})
+        return db
+
+    @gen.coroutine
+    def run_db(self, func, *args, **kwargs):
+        """
+        Calls `func(db, *args, **kwargs)` on the application's database
+        thread pool, where `db` is a `db_view` of the handler, or with
+        the handler itself if there is no pool.
+
+        `func` should return plain data rather than ORM objects, and
+        leave rendering to the caller.
+        """
+        executor = self.application.db_executor
+        if not executor:
+            return func(self, *args, **kwargs)
+        result = yield executor.submit(
+            self._run_db, func, self.db_view(), *args, **kwargs)
+        return result
+
+    @gen.coroutine
+    def run_search(self, func, *args, **kwargs):
+        """
+        Like `run_db`, but for work that queries Elasticsearch, which
+        always runs on a thread: the search thread pool if there is no
+        database pool.
+        """
+        executor = self.application.db_executor or \
+            self.application.search_executor
+        result = yield executor.submit(
+            self._run_db, func, self.db_view(), *args, **kwargs)
+        return result
+
+    @gen.coroutine
+    def run_cache(self, method, *args, **kwargs):
+        """
+        Calls the cache `method` on the application's cache thread pool,
+        so that a slow Redis doesn't block the IOLoop, or directly if
+        there is no pool.
+        """
+        executor = self.application.cache_executor
+        if not executor:
+            return method(*args, **kwargs)
+        result = yield executor.submit(method, *args, **kwargs)
+        return result
+
+    @gen.coroutine
+    def geocode_address(self, address):
+        """
+        Geocodes `address` on the application's geocoding thread pool,
+        so a slow geocoder doesn't hold up other requests.
+
+        `address` should not be attached to a session.
+        """
+        yield self.application.geocode_executor.submit(address.geocode)
+
+    @staticmethod
+    def _run_db(func, db, *args, **kwargs):
+        try:
+            return func(db, *args, **kwargs)
+        finally:
+            db.orm.close()
+
 
 
 class DefaultHandler(BaseHandler):
@@ -913,7 +1204,7 @@ class MangoBaseEntityHandlerMixin(RequestHandler):
 
 
     def _get_entity(self, Entity, entity_id, entity_type, id_,
-                    required=True):
+                    required=True, options=None):
 
         query = self.orm.query(Entity) \
             .filter(getattr(Entity, entity_id) == id_)
@@ -922,6 +1213,10 @@ class MangoBaseEntityHandlerMixin(RequestHandler):
             query = query \
                 .filter_by(public=True)
 
+        if options:
+            query = query \
+                .options(*options)
+
         try:
             entity = query.one()
         except NoResultFound:
@@ -1020,6 +1315,7 @@ class MangoEntityHandlerMixin(BaseHandler):
     def _before_delete(self, entity):
         pass
 
+    @gen.coroutine
     def _before_set(self, entity):
         pass
 
@@ -1062,16 +1358,19 @@ class MangoEntityHandlerMixin(BaseHandler):
 
 
     @authenticated
+    @gen.coroutine
     def put(self, entity_id):
-        old_entity = self._get(entity_id, required=False)
-        pre_entity = self._get_v(entity_id)
-
+        # `_before_set` may wait on the geocoder, so call it before loading
+        # anything, and load, modify and commit without yielding after it.
         if self.moderator:
             new_entity = self._create(id_=entity_id)
         else:
             new_entity = self._create_v(entity_id)
         if self._before_set:
-            self._before_set(new_entity)
+            yield self._before_set(new_entity)
+
+        old_entity = self._get(entity_id, required=False)
+        pre_entity = self._get_v(entity_id)
 
         if self.moderator and old_entity:
             if old_entity.content_same(new_entity):
@@ -1099,22 +1398,33 @@ class MangoEntityHandlerMixin(BaseHandler):
 
 
 class MangoEntityListHandlerMixin(RequestHandler):
+    @gen.coroutine
     def _before_set(self, entity):
         pass
 
     @authenticated
+    @gen.coroutine
     def post(self):
         if not (self.moderator or hasattr(self, "Entity_v")):
             raise HTTPError(405, "Method not allowed.")
 
+        # `_before_set` may wait on the geocoder, so call it before loading
+        # anything, and load, modify and commit without yielding after it.
+        new_entity = self._create()
+        new_entity_v = None
+        if not self.moderator:
+            # Its ID is set once `new_entity` has reserved one.
+            new_entity_v = self._create_v(None)
+        if self._before_set:
+            yield self._before_set(new_entity)
+            if new_entity_v:
+                yield self._before_set(new_entity_v)
+
         if hasattr(self, "Entity_v"):
             # Fix MySQL autoincrement reset
             self._update_entity_autoincrement(
                 self.Entity, self.Entity_v, self.entity_id)
 
-        new_entity = self._create()
-        if self._before_set:
-            self._before_set(new_entity)
         self.orm.add(new_entity)
         self.orm_commit()
         if self.moderator:
@@ -1130,9 +1440,7 @@ class MangoEntityListHandlerMixin(RequestHandler):
             .delete()
         self.orm_commit()
 
-        new_entity_v = self._create_v(id_)
-        if self._before_set:
-            self._before_set(new_entity_v)
+        setattr(new_entity_v, self.entity_id, id_)
         self.orm.add(new_entity_v)
         self.orm_commit()
         return self.redirect_next(new_entity_v.url)
@@ -3,10 +3,12 @@ import datetime
 
 from collections import OrderedDict
 
-from sqlalchemy import and_, exists
+from sqlalchemy import exists
 from sqlalchemy.sql import func
 from tornado.web import HTTPError
 
+import geo
+
 from model import User, Event, Address, Eventtag, detach, event_eventtag
 
 from model_v import Event_v, \
@@ -23,13 +25,14 @@ MAX_ADDRESS_PAGES = 3
 
 
 class BaseEventHandler(BaseHandler, MangoBaseEntityHandlerMixin):
-    def _get_event(self, event_id, required=True):
+    def _get_event(self, event_id, required=True, options=None):
         return self._get_entity(
             Event,
             "event_id",
             "event",
             event_id,
             required,
+            options,
         )
 
     def _get_event_v(self, event_v_id):
@@ -204,7 +207,8 @@ class BaseEventHandler(BaseHandler, MangoBaseEntityHandlerMixin):
                                  location=None,
                                  visibility=None,
                                  offset=None,
-                                 page_view="entity"):
+                                 page_view="entity",
+                                 zoom=None):
 
         event_query = self._get_event_search_query(
             name=name, name_search=name_search,
@@ -239,15 +243,8 @@ class BaseEventHandler(BaseHandler, MangoBaseEntityHandlerMixin):
             secondary=True, null_column=Address.address_id)
 
         if location:
-            event_address_query = event_address_query \
-                .filter(and_(
-                    Address.latitude != None,
-                    Address.latitude >= location.south,
-                    Address.latitude <= location.north,
-                    Address.longitude != None,
-                    Address.longitude >= location.west,
-                    Address.longitude <= location.east,
-                    ))
+            event_address_query = Address.filter_geobox(
+                event_address_query, location)
 
         if past:
             event_address_query = event_address_query \
@@ -270,6 +267,9 @@ class BaseEventHandler(BaseHandler, MangoBaseEntityHandlerMixin):
                     "latitude": address and address.latitude,
                     "longitude": address and address.longitude,
                 })
+            if zoom is not None:
+                event_packet["clusterList"], event_packet["markerList"] = \
+                    geo.cluster_markers(event_packet["markerList"], zoom)
         elif page_view == "map":
             if (
                     event_address_query.count() >
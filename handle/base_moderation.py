@@ -1,53 +1,134 @@
 
-from sqlalchemy import alias
+import logging
+
+from sqlalchemy import alias, literal
 from sqlalchemy.inspection import inspect
-from sqlalchemy.sql.expression import and_, exists
+from sqlalchemy.sql import func
+from sqlalchemy.sql.expression import and_, or_, exists
 
 from model import User, Org, Event, Address, Contact, \
     org_address
 
 from model_v import Org_v, Event_v, Address_v, Contact_v, \
     org_address_v, event_address_v, \
-    org_contact_v, event_contact_v
+    org_contact_v, event_contact_v, \
+    moderation_pending
 
 
 
-def get_pending_entity_id(orm, Entity_v, Entity, desc_attr):
+LOG = logging.getLogger('moderation')
+
+PENDING_ENTITY_LIST = [
+    (Org_v, Org),
+    (Event_v, Event),
+    (Address_v, Address),
+    (Contact_v, Contact),
+]
+
+
+
+def rebuild_moderation_pending(orm):
+    """
+    Refill `moderation_pending` from the version tables, which is slow.
+    Triggers maintain it from then on, but not when a user's moderator
+    status changes.
+    """
     # pylint: disable=invalid-name,singleton-comparison
     # Allow `Entity_v` and `Entity` as abstract class names.
     # Cannot use `is` in SQLAlchemy filters
 
-    Entity_v2 = alias(Entity_v)
-    entity_id_name = inspect(Entity).primary_key[0].name
-    entity_v_id_name = inspect(Entity_v).primary_key[0].name
+    LOG.info("Rebuilding moderation pending table.")
 
-    # "order by" and "group by" together give undefined results
-    # in MySQL, so we have to use a "not exists" query.
+    orm.execute(moderation_pending.delete())
+
+    for Entity_v, Entity in PENDING_ENTITY_LIST:
+        Entity_v2 = alias(Entity_v)
+        entity_id_name = inspect(Entity).primary_key[0].name
+        entity_v_id_name = inspect(Entity_v).primary_key[0].name
+
+        # "order by" and "group by" together give undefined results
+        # in MySQL, so we have to use a "not exists" query.
+
+        latest = orm.query(
+            literal(Entity.__tablename__),
+            Entity_v.entity_id,
+            Entity_v.entity_v_id,
+        ) \
+            .join((User, User.user_id == Entity_v.moderation_user_id)) \
+            .filter(User.moderator == False) \
+            .filter(~exists().where(and_(
+                Entity_v2.c[entity_id_name] == Entity_v.entity_id,
+                Entity_v2.c[entity_v_id_name] > Entity_v.entity_v_id
+            )))
+
+        orm.execute(moderation_pending.insert().from_select(
+            ["entity_type", "entity_id", "entity_v_id"],
+            latest.statement))
+
+    orm.commit()
 
-    latest = orm.query(
-        Entity_v.entity_id.label("entity_id"),
-        getattr(Entity_v, desc_attr).label("desc"),
-        Entity_v.moderation_user_id
-    ) \
-        .filter(~exists().where(and_(
-            Entity_v2.c[entity_id_name] == Entity_v.entity_id,
-            Entity_v2.c[entity_v_id_name] > Entity_v.entity_v_id
-        ))) \
-        .subquery()
 
-    latest = orm.query(
-        latest.c.entity_id,
-        latest.c.desc,
-        latest.c.moderation_user_id
-    ) \
-        .group_by(latest.c.entity_id) \
-        .subquery()
 
-    results = orm.query(latest.c.entity_id, latest.c.desc) \
-        .join((User, User.user_id == latest.c.moderation_user_id)) \
-        .outerjoin((Entity, Entity.entity_id == latest.c.entity_id)) \
+def verify_moderation_pending(orm):
+    """
+    Rebuild `moderation_pending` if any of its rows is not the latest
+    revision of its entity, or is by a user who is now a moderator.
+
+    Only rows in the table are checked, so run `rebuild_moderation_pending`
+    after removing a user's moderator status.
+    """
+    # pylint: disable=invalid-name,singleton-comparison
+    # Allow `Entity_v` and `Entity` as abstract class names.
+    # Cannot use `is` in SQLAlchemy filters
+
+    for Entity_v, Entity in PENDING_ENTITY_LIST:
+        Entity_v2 = alias(Entity_v)
+        entity_id_name = inspect(Entity).primary_key[0].name
+        entity_v_id_name = inspect(Entity_v).primary_key[0].name
+
+        stale = orm.query(moderation_pending.c.entity_id) \
+            .outerjoin((Entity_v, and_(
+                Entity_v.entity_id == moderation_pending.c.entity_id,
+                Entity_v.entity_v_id == moderation_pending.c.entity_v_id,
+            ))) \
+            .outerjoin((User, User.user_id == Entity_v.moderation_user_id)) \
+            .filter(moderation_pending.c.entity_type == Entity.__tablename__) \
+            .filter(or_(
+                User.user_id == None,
+                User.moderator == True,
+                exists().where(and_(
+                    Entity_v2.c[entity_id_name] == Entity_v.entity_id,
+                    Entity_v2.c[entity_v_id_name] > Entity_v.entity_v_id
+                )),
+            )) \
+            .first()
+
+        if stale:
+            LOG.warning(
+                "Moderation pending table has a stale %s row for ID %d.",
+                Entity.__tablename__, stale[0])
+            rebuild_moderation_pending(orm)
+            return
+
+    LOG.debug("Moderation pending table is consistent.")
+
+
+
+def get_pending_entity_id(orm, Entity_v, Entity, desc_attr):
+    # pylint: disable=invalid-name
+    # Allow `Entity_v` and `Entity` as abstract class names.
+
+    results = orm.query(
+        Entity_v.entity_id,
+        getattr(Entity_v, desc_attr)
+    ) \
+        .join((moderation_pending, and_(
+            moderation_pending.c.entity_type == Entity.__tablename__,
+            moderation_pending.c.entity_v_id == Entity_v.entity_v_id,
+        ))) \
+        .join((User, User.user_id == Entity_v.moderation_user_id)) \
+        .outerjoin((Entity, Entity.entity_id == Entity_v.entity_id)) \
         .add_columns(Entity.entity_id, getattr(Entity, desc_attr), User.name) \
-        .filter(User.moderator == False) \
         .limit(20)
 
     results = list(results)
@@ -81,16 +162,9 @@ def get_pending_contact_id(orm):
 
 
 def has_pending(orm):
-    count = 0
-    for f in [
-            get_pending_org_id,
-            get_pending_event_id,
-            get_pending_address_id,
-            get_pending_contact_id
-    ]:
-        pending = f(orm)
-        count += len(pending)
-    return count
+    return orm.query(func.count()) \
+        .select_from(moderation_pending) \
+        .scalar()
 
 
 
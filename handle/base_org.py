@@ -1,11 +1,19 @@
 
 from collections import OrderedDict
 
-from sqlalchemy import and_, exists
+import Levenshtein
+
+from sqlalchemy import or_, exists, tuple_
 from sqlalchemy.sql import func, literal
-from sqlalchemy.sql.expression import case
+from sqlalchemy.sql.expression import case, false
+
+from tornado.log import app_log
+
+import geo
+from search import search
 
-from model import User, Org, Address, Orgalias, Orgtag, detach, org_orgtag
+from model import User, Org, Address, Orgalias, Orgtag, detach, org_orgtag, \
+    org_name, org_name_search_subquery
 
 from model_v import Org_v, \
     accept_org_address_v
@@ -15,17 +23,20 @@ from handle.base import BaseHandler, MangoBaseEntityHandlerMixin
 MAX_ORG_PER_PAGE = 20
 MAX_ADDRESS_PER_PAGE = 26
 MAX_ADDRESS_PAGES = 3
+MAX_NAME_SEARCH_PER_PAGE = 10
+MAX_NAME_SEARCH_HITS = 1000  # Elasticsearch matches to list with tags
 
 
 
 class BaseOrgHandler(BaseHandler, MangoBaseEntityHandlerMixin):
-    def _get_org(self, org_id, required=True):
+    def _get_org(self, org_id, required=True, options=None):
         return self._get_entity(
             Org,
             "org_id",
             "org",
             org_id,
             required,
+            options,
         )
 
     def _get_org_v(self, org_v_id):
@@ -127,57 +138,74 @@ class BaseOrgHandler(BaseHandler, MangoBaseEntityHandlerMixin):
         accept_org_address_v(self.orm, org.org_id)
 
     def _get_name_search_query(self, name=None, name_search=None,
-                               visibility=None):
+                               visibility=None, name_hits=None):
         """
         name:         Full name match.
         name_search:  Name contains search, matches from start first.
         visibility:   "public", "pending", "private", "all". Unknown = "public".
+        name_hits:    Ranked list of (org_id, name) matches from
+                      `_search_org_names`, used instead of `name_search`.
 
         Returns:      A matching list of tuples like (org_id, orgalias_id) where
-                      orgalias_id may be None.
+                      orgalias_id may be None, and if there are `name_hits`,
+                      the rank.
         """
-        # pylint: disable=no-member
-        # (`Orgalias.org` is generated)
-
-        org_name_query = self.orm.query(
-            Org.name.label("name"),
-            Org.org_id.label("org_id"),
-            literal(None).label('orgalias_id')
-            )
-        org_name_query = self.filter_visibility(
-            org_name_query, Org, visibility)
-        orgalias_name_query = self.orm.query(
-            Orgalias.name.label("name"),
-            Org.org_id.label("org_id"),
-            Orgalias.orgalias_id.label('orgalias_id')
-            ) \
-            .join(Orgalias.org)
-        # Non-private orgaliases are not for the site, only robots
-        orgalias_name_query = self.filter_visibility(
-            orgalias_name_query, Orgalias, True)
-        # Orgs get filtered on visibility just the same
-        orgalias_name_query = self.filter_visibility(
-            orgalias_name_query, Org, visibility)
-        name_subquery = org_name_query.union_all(orgalias_name_query).subquery()
+        # pylint: disable=singleton-comparison
+        # Cannot use `is` in SQLAlchemy filters
 
         name_query = self.orm.query(
-            name_subquery.c.org_id,
+            org_name.c.org_id,
             case(
                 [(
-                    func.count("*") > func.count(name_subquery.c.orgalias_id),
+                    func.count("*") > func.count(org_name.c.orgalias_id),
                     literal(None),
                 )],
-                else_=func.min(name_subquery.c.orgalias_id),
+                else_=func.min(org_name.c.orgalias_id),
             ).label("orgalias_id")
-        )
+        ) \
+            .join(Org, Org.org_id == org_name.c.org_id) \
+            .outerjoin(Orgalias, Orgalias.orgalias_id == org_name.c.orgalias_id)
+
+        # Non-private orgaliases are not for the site, only robots
+        name_query = name_query \
+            .filter(or_(
+                org_name.c.orgalias_id == None,
+                Orgalias.public == True,
+            ))
+        # Orgs get filtered on visibility just the same
+        name_query = self.filter_visibility(
+            name_query, Org, visibility)
 
         if name:
             name_query = name_query \
-                .filter(name_subquery.c.name == name)
+                .filter(org_name.c.name == name)
+        elif name_hits == []:
+            name_query = name_query \
+                .filter(false())
+        elif name_hits:
+            rank = func.min(case(
+                {org_id: i for i, (org_id, _name) in enumerate(name_hits)},
+                value=org_name.c.org_id,
+            )).label("rank")
+            name_query = name_query \
+                .add_columns(rank) \
+                .filter(tuple_(org_name.c.org_id, org_name.c.name)
+                        .in_(name_hits)) \
+                .order_by(rank)
         elif name_search:
-            name_column = func.lower(name_subquery.c.name)
+            name_column = func.lower(org_name.c.name)
             name_value = name_search.lower()
 
+            if not ("%" in name_value or "_" in name_value):
+                # Restrict to trigram candidates. `contains` below treats
+                # wildcards as such, so they cannot use the index.
+                candidate_subquery = org_name_search_subquery(
+                    self.orm, name_value)
+                name_query = name_query \
+                    .join(candidate_subquery,
+                          candidate_subquery.c.org_name_id ==
+                          org_name.c.org_name_id)
+
             name_query = name_query \
                 .filter(name_column.contains(name_value)) \
                 .order_by(
@@ -186,25 +214,129 @@ class BaseOrgHandler(BaseHandler, MangoBaseEntityHandlerMixin):
                 )
         else:
             name_query = name_query \
-                .order_by(name_subquery.c.name)
+                .order_by(org_name.c.name)
 
         name_query = name_query \
-            .group_by(name_subquery.c.org_id)
+            .group_by(org_name.c.org_id)
 
         return name_query
 
 
 
+    def _search_org_names_es(self, name_search, visibility=None,
+                             offset=0, limit=MAX_NAME_SEARCH_PER_PAGE):
+        """
+        Returns a ranked list of dictionaries of "org_id", "name",
+        "alias", "public" and "score" for orgs whose name or public
+        aliases match `name_search` in Elasticsearch, where "alias" is the
+        matching name most like `name_search`, or `None` if that is the
+        org name.
+
+        Non-public orgs are included if visible to moderators, but not
+        filtered further by `visibility`.
+
+        Returns `None` if Elasticsearch is unavailable.
+        """
+        es = self.orm.get_bind().search
+        if not es:
+            return None
+
+        public = not (self.moderator and visibility in [
+            "pending", "private", "all"])
+        try:
+            hits = search.search_org_names(
+                es, name_search, public, offset, limit)
+        except search.SEND_ERRORS as e:
+            app_log.warning("Org name search failed: %s", e)
+            return None
+
+        value = name_search.lower()
+        hit_list = []
+        for hit in hits:
+            source = hit["_source"]
+            alias = max(
+                source["alias_public"],
+                key=lambda alias: Levenshtein.ratio(value, alias.lower()))
+            hit_list.append({
+                "org_id": source["org_id"],
+                "name": source["name"],
+                "alias": alias if alias != source["name"] else None,
+                "public": source["public"],
+                "score": hit["_score"],
+            })
+        return hit_list
+
+
+
+    def _search_org_names_local(self, name_search, visibility=None,
+                                offset=0, limit=MAX_NAME_SEARCH_PER_PAGE):
+        """
+        Like `_search_org_names_es`, but using the org name search table.
+        Scores are `None`.
+        """
+        name_query = self._get_name_search_query(
+            name_search=name_search, visibility=visibility)
+        row_list = name_query.offset(offset).limit(limit).all()
+        if not row_list:
+            return []
+
+        org_dict = {
+            org.org_id: org for org in self.orm.query(Org)
+            .filter(Org.org_id.in_([org_id for org_id, _ in row_list]))
+        }
+        alias_id_list = [
+            orgalias_id for _, orgalias_id in row_list if orgalias_id]
+        alias_dict = {}
+        if alias_id_list:
+            alias_dict = {
+                orgalias.orgalias_id: orgalias for orgalias
+                in self.orm.query(Orgalias)
+                .filter(Orgalias.orgalias_id.in_(alias_id_list))
+            }
+
+        hit_list = []
+        for org_id, orgalias_id in row_list:
+            org = org_dict[org_id]
+            hit_list.append({
+                "org_id": org_id,
+                "name": org.name,
+                "alias": orgalias_id and alias_dict[orgalias_id].name,
+                "public": org.public,
+                "score": None,
+            })
+        return hit_list
+
+
+
+    def _search_org_names(self, name_search, visibility=None,
+                          offset=0, limit=MAX_NAME_SEARCH_PER_PAGE):
+        """
+        Search org names and public aliases in Elasticsearch, or in the
+        org name search table if Elasticsearch is unavailable.
+
+        Elasticsearch calls block, so call with `run_search`.
+        """
+        hit_list = self._search_org_names_es(
+            name_search, visibility, offset, limit)
+        if hit_list is None:
+            hit_list = self._search_org_names_local(
+                name_search, visibility, offset, limit)
+        return hit_list
+
+
+
     def _get_org_alias_search_query(
             self,
             name=None,
             name_search=None,
             tag_name_list=None,
             tag_all=False,
-            visibility=None
+            visibility=None,
+            name_hits=None
     ):
 
-        name_query = self._get_name_search_query(name, name_search, visibility)
+        name_query = self._get_name_search_query(
+            name, name_search, visibility, name_hits)
         name_subquery = name_query.subquery()
 
         org_alias_query = self.orm.query(Org, Orgalias) \
@@ -212,6 +344,10 @@ class BaseOrgHandler(BaseHandler, MangoBaseEntityHandlerMixin):
             .outerjoin(Orgalias,
                        Orgalias.orgalias_id == name_subquery.c.orgalias_id)
 
+        if name_hits:
+            org_alias_query = org_alias_query \
+                .order_by(name_subquery.c.rank)
+
         if tag_name_list:
             if tag_all:
                 for tag_name in tag_name_list:
@@ -237,7 +373,18 @@ class BaseOrgHandler(BaseHandler, MangoBaseEntityHandlerMixin):
                                location=None,
                                visibility=None,
                                offset=None,
-                               page_view="entity"):
+                               page_view="entity",
+                               zoom=None):
+
+        name_hits = None
+        if name_search and not name:
+            hit_list = self._search_org_names_es(
+                name_search, visibility, limit=MAX_NAME_SEARCH_HITS)
+            if hit_list is not None:
+                name_hits = [
+                    (hit["org_id"], hit["alias"] or hit["name"])
+                    for hit in hit_list
+                ]
 
         org_alias_query = self._get_org_alias_search_query(
             name=name,
@@ -245,6 +392,7 @@ class BaseOrgHandler(BaseHandler, MangoBaseEntityHandlerMixin):
             tag_name_list=tag_name_list,
             tag_all=tag_all,
             visibility=visibility,
+            name_hits=name_hits,
             )
 
         if location:
@@ -262,15 +410,8 @@ class BaseOrgHandler(BaseHandler, MangoBaseEntityHandlerMixin):
             secondary=True, null_column=Address.address_id)
 
         if location:
-            org_alias_address_query = org_alias_address_query \
-                .filter(and_(
-                    Address.latitude != None,
-                    Address.latitude >= location.south,
-                    Address.latitude <= location.north,
-                    Address.longitude != None,
-                    Address.longitude >= location.west,
-                    Address.longitude <= location.east,
-                    )) \
+            org_alias_address_query = Address.filter_geobox(
+                org_alias_address_query, location)
 
         org_packet = {
             "location": location and location.to_obj(),
@@ -287,6 +428,9 @@ class BaseOrgHandler(BaseHandler, MangoBaseEntityHandlerMixin):
                     "latitude": address and address.latitude,
                     "longitude": address and address.longitude,
                 })
+            if zoom is not None:
+                org_packet["clusterList"], org_packet["markerList"] = \
+                    geo.cluster_markers(org_packet["markerList"], zoom)
         elif page_view == "map":
             if (
                     org_alias_address_query.count() >
@@ -1,10 +1,10 @@
 
-from sqlalchemy.sql import func
+from sqlalchemy.sql import func, and_
 from sqlalchemy.orm.exc import NoResultFound
 
 from tornado.web import HTTPError
 
-from model import short_name, detach, URL_DIRECTORY
+from model import short_name, detach, tag_count, URL_DIRECTORY
 
 from handle.base import BaseHandler, MangoBaseEntityHandlerMixin
 
@@ -93,17 +93,29 @@ class BaseTagHandler(BaseHandler, MangoBaseEntityHandlerMixin):
 
         return [entry.path for entry in path_list]
 
+    def _tag_count_column(self, visibility=None):
+        """
+        The column of `tag_count` for the entities matched by
+        `filter_visibility` with `visibility`.
+        """
+        if self.moderator and visibility:
+            if visibility == "pending":
+                return tag_count.c.pending_count
+            if visibility == "all":
+                return tag_count.c.public_count + \
+                    tag_count.c.pending_count + tag_count.c.private_count
+            if visibility == "private":
+                return tag_count.c.private_count
+        return tag_count.c.public_count
+
     def _get_tag_entity_count_search(
             self,
             name=None, name_short=None, base=None, base_short=None,
             path=None, search=None, sort=None, visibility=None):
 
         tag_list = self.orm.query(self.Tag)
-        entity_q = self.orm.query(self.Entity)
 
         tag_list = self.filter_visibility(tag_list, self.Tag, visibility)
-        entity_q = self.filter_visibility(
-            entity_q, self.Entity, visibility).subquery()
 
         if name:
             tag_list = tag_list.filter_by(name=name)
@@ -130,22 +142,15 @@ class BaseTagHandler(BaseHandler, MangoBaseEntityHandlerMixin):
             tag_list = tag_list \
                 .filter(search_member.contains(search))
 
-        cross_tag_id = getattr(self.cross_table.c, self.tag_id)
-        cross_entity_id = getattr(self.cross_table.c, self.entity_id)
-        entity_id = getattr(entity_q.c, self.entity_id)
-
-        s = self.orm.query(
-            cross_tag_id,
-            func.count(cross_entity_id).label("count")
-            )\
-            .join((entity_q, entity_id == cross_entity_id))\
-            .group_by(cross_tag_id)\
-            .subquery()
+        # Untagged tags have no count, rather than zero.
+        count = func.nullif(self._tag_count_column(visibility), 0)
 
         results = tag_list\
-            .add_columns(s.c.count)\
-            .outerjoin((s, getattr(self.Tag, self.tag_id) ==
-                        getattr(s.c, self.tag_id)))
+            .add_columns(count)\
+            .outerjoin((tag_count, and_(
+                tag_count.c.tag_type == self.tag_type,
+                tag_count.c.tag_id == getattr(self.Tag, self.tag_id),
+            )))
 
         if search:
             results = results\
@@ -156,7 +161,7 @@ class BaseTagHandler(BaseHandler, MangoBaseEntityHandlerMixin):
                 "name": getattr(self.Tag,
                                 "name_short" if path else "base_short"),
                 "date": getattr(self.Tag, "a_time").desc(),
-                "freq": s.c.count.desc(),
+                "freq": count.desc(),
                 }
 
             results = results\
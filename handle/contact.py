@@ -1,5 +1,6 @@
 
 from sqlalchemy.orm.exc import NoResultFound
+from tornado import gen
 from tornado.web import HTTPError
 
 from model import User, Medium, Contact, \
@@ -140,6 +141,7 @@ class BaseContactHandler(BaseHandler, MangoBaseEntityHandlerMixin):
 
         return contact_v and contact_v.a_time or None
 
+    @gen.coroutine
     def _before_contact_set(self, contact):
         pass
 
@@ -2,6 +2,7 @@
 import json
 
 from sqlalchemy.orm.exc import NoResultFound
+from tornado import gen
 from tornado.web import HTTPError
 
 from model import Event, Note, Address, Contact, Eventtag
@@ -46,7 +47,7 @@ class EventListHandler(BaseEventHandler, BaseEventtagHandler,
 
     @staticmethod
     def _cache_key(name_search, past, tag_name_list, tag_all,
-                   page_view, visibility, moderator):
+                   page_view, visibility, moderator, zoom=None):
         if not visibility:
             visibility = "public"
         return sha1_concat(json.dumps({
@@ -57,6 +58,7 @@ class EventListHandler(BaseEventHandler, BaseEventtagHandler,
             "visibility": visibility,
             "moderator": moderator,
             "pageView": page_view,
+            "zoom": zoom,
         }))
 
     def get(self):
@@ -78,6 +80,7 @@ class EventListHandler(BaseEventHandler, BaseEventtagHandler,
         page_view = self.get_argument_allowed(
             "pageView", ["entity", "map", "marker"],
             default="entity", is_json=is_json)
+        zoom = self.get_argument_zoom("zoom", None, is_json=is_json)
 
         if not self.accept_type("json"):
             if self.has_javascript:
@@ -104,6 +107,7 @@ class EventListHandler(BaseEventHandler, BaseEventtagHandler,
                 page_view,
                 self.parameters.get("visibility", None),
                 self.moderator,
+                zoom,
                 )
             value = self.cache.get(cache_key)
             if value:
@@ -112,6 +116,8 @@ class EventListHandler(BaseEventHandler, BaseEventtagHandler,
                 self.write(value)
                 self.finish()
                 return
+            cache_tags = self.cache.tag_versions(
+                ["event", "eventtag", "address"])
 
         event_packet = self._get_event_packet_search(
             name=name,
@@ -123,10 +129,12 @@ class EventListHandler(BaseEventHandler, BaseEventtagHandler,
             visibility=self.parameters.get("visibility", None),
             offset=offset,
             page_view=page_view,
+            zoom=zoom,
             )
 
         if cache_key:
-            self.cache.set(cache_key, json.dumps(event_packet))
+            self.cache.set(
+                cache_key, json.dumps(event_packet), tags=cache_tags)
 
         if self.accept_type("json"):
             self.write_json(event_packet)
@@ -213,7 +221,9 @@ class EventHandler(BaseEventHandler, MangoEntityHandlerMixin):
             event_v = self._get_event_v(event_id)
             if event_v:
                 required = False
-        event = self._get_event(event_id, required=required)
+        event = self._get_event(
+            event_id, required=required,
+            options=Event.detail_options(all_visible=self.deep_visible()))
 
         if self.moderator and not event:
             self.next_ = "%s/revision" % event_v.url
@@ -471,7 +481,13 @@ class EventAddressListHandler(BaseEventHandler, BaseAddressHandler):
             )
 
     @authenticated
+    @gen.coroutine
     def post(self, event_id):
+        # Geocode before loading anything, and load, modify and commit
+        # without yielding after it.
+        address = self._create_address()
+        yield self._before_address_set(address)
+
         required = True
         if self.contributor:
             event_v = self._get_event_v(event_id)
@@ -483,8 +499,6 @@ class EventAddressListHandler(BaseEventHandler, BaseAddressHandler):
         self._update_entity_autoincrement(
             Address, Address_v, "address_id")
 
-        address = self._create_address()
-        self._before_address_set(address)
         self.orm.add(address)
         self.orm_commit()
         if self.moderator:
@@ -571,6 +585,7 @@ class EventContactListHandler(BaseEventHandler, BaseContactHandler):
             )
 
     @authenticated
+    @gen.coroutine
     def post(self, event_id):
         required = True
         if self.contributor:
@@ -584,7 +599,7 @@ class EventContactListHandler(BaseEventHandler, BaseContactHandler):
             Contact, Contact_v, "contact_id")
 
         contact = self._create_contact()
-        self._before_contact_set(contact)
+        yield self._before_contact_set(contact)
         self.orm.add(contact)
         self.orm_commit()
         if self.moderator:
@@ -955,7 +970,9 @@ class EventDuplicateHandler(BaseEventHandler):
                 moderation_user=self.current_user,
                 public=address.public
                 )
-            address2.geocode()
+            # Same address, so no need to geocode again.
+            address2.latitude = address.latitude
+            address2.longitude = address.longitude
             event2.address_list.append(address2)
 
         for eventtag in event.eventtag_list:
@@ -1,7 +1,8 @@
 
+from tornado import gen
 from tornado.web import HTTPError
 
-from model_v import get_history
+from model_v import get_history, parse_history_cursor
 
 from handle.base import BaseHandler, authenticated
 
@@ -9,14 +10,22 @@ from handle.base import BaseHandler, authenticated
 
 class HistoryHandler(BaseHandler):
     @authenticated
+    @gen.coroutine
     def get(self):
         if not self.current_user.moderator:
             raise HTTPError(404)
 
         is_json = self.content_type("application/json")
-        offset = self.get_argument_int("offset", None, is_json=is_json)
-
-        history = get_history(self.orm, offset=offset, limit=50)
+        before = self.get_argument_restricted(
+            "before", parse_history_cursor,
+            "Value must be a history cursor", None, is_json)
+        after = self.get_argument_restricted(
+            "after", parse_history_cursor,
+            "Value must be a history cursor", None, is_json)
+
+        history = yield self.run_db(
+            lambda db: get_history(
+                db.orm, limit=50, before=before, after=after))
 
         self.render(
             'history.html',
@@ -3,6 +3,8 @@ import json
 
 from sqlalchemy.sql import func
 
+from tornado import gen
+
 from model import Org, Orgtag, org_orgtag
 
 from handle.base import BaseHandler
@@ -44,21 +46,7 @@ class FairMixin(object):
 
 
 class HomeTargetListHandler(FairMixin, BaseHandler):
-    def get(self):
-        visibility = self.parameters.get("visibility", None)
-
-        cache_key = "country-tag-%s-%s" % (self.tag_name or "home", visibility)
-
-        value = self.cache.get(cache_key)
-        if value:
-            self.set_header(
-                "Content-Type",
-                "application/json; charset=UTF-8"
-            )
-            self.write(value)
-            self.finish()
-            return
-
+    def _get_target_list(self, visibility):
         q1 = self.orm.query(Org.org_id.label("org_id"))
         q1 = self.filter_visibility(
             q1, Org, visibility)
@@ -91,24 +79,28 @@ class HomeTargetListHandler(FairMixin, BaseHandler):
             "countries": results
         }
 
-        self.cache.set(cache_key, json.dumps(data))
-        self.write_json(data)
+        return json.dumps(data)
 
+    @gen.coroutine
+    def get(self):
+        # pylint: disable=protected-access
+        # Calling the handler's own methods on its `db_view`.
+        visibility = self.parameters.get("visibility", None)
 
+        cache_key = "country-tag-%s-%s" % (self.tag_name or "home", visibility)
 
-class HomeOrgListHandler(BaseHandler):
-    def get(self):
-        cache_key = "home-org"
-        value = self.cache.get(cache_key)
-        if value:
-            self.set_header(
-                "Content-Type",
-                "application/json; charset=UTF-8"
-            )
-            self.write(value)
-            self.finish()
-            return
+        entry = yield self.cache_fetch(
+            cache_key,
+            lambda db: db._get_target_list(visibility),
+            ["org", "orgtag"])
 
+        self.set_cache_control()
+        self.write_json_entry(entry)
+
+
+
+class HomeOrgListHandler(BaseHandler):
+    def _get_org_list(self):
         org_list = []
 
         for org in self.orm.query(Org).filter_by(public=True).all():
@@ -123,8 +115,18 @@ class HomeOrgListHandler(BaseHandler):
             org_list.append(obj)
 
         org_list.sort(key=lambda x: x["label"])
-        self.cache.set(cache_key, json.dumps(org_list))
-        self.write_json(org_list)
+        return org_list
+
+    @gen.coroutine
+    def get(self):
+        # pylint: disable=protected-access
+        # Calling the handler's own methods on its `db_view`.
+        media_type = self.compact_type()
+        entry = yield self.cache_fetch_json(
+            "home-org", lambda db: db._get_org_list(), ["org"], media_type)
+
+        self.set_cache_control()
+        self.write_json_entry(entry, media_type)
 
 
 
@@ -145,17 +147,7 @@ class FairOrgListHandler(FairMixin, BaseHandler):
     def org_cache_key(self):
         return self.tag_name and ("%s-org" % self.tag_name)
 
-    def get(self):
-        value = self.cache.get(self.org_cache_key)
-        if value:
-            self.set_header(
-                "Content-Type",
-                "application/json; charset=UTF-8"
-            )
-            self.write(value)
-            self.finish()
-            return
-
+    def _get_org_list(self):
         tag = self.orm.query(Orgtag) \
             .filter(Orgtag.base_short == self.tag_name) \
             .first()
@@ -175,8 +167,19 @@ class FairOrgListHandler(FairMixin, BaseHandler):
                 org_list.append(obj)
 
         org_list.sort(key=lambda x: x["label"])
-        self.cache.set(self.org_cache_key, json.dumps(org_list))
-        self.write_json(org_list)
+        return org_list
+
+    @gen.coroutine
+    def get(self):
+        # pylint: disable=protected-access
+        # Calling the handler's own methods on its `db_view`.
+        media_type = self.compact_type()
+        entry = yield self.cache_fetch_json(
+            self.org_cache_key, lambda db: db._get_org_list(),
+            ["org", "orgtag"], media_type)
+
+        self.set_cache_control()
+        self.write_json_entry(entry, media_type)
 
 
 
@@ -1,22 +1,21 @@
 
 import json
 import random
-from collections import OrderedDict
-
-import Levenshtein
+from collections import OrderedDict, namedtuple
 
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.sql import func
 from sqlalchemy.sql.expression import literal_column, or_, and_, not_
 from sqlalchemy.exc import InternalError
 
+from tornado import gen
 from tornado.web import HTTPError
 from tornado.log import app_log
 
 import geo
 
 from model import Org, Note, Address, Orgalias, Orgtag, Contact, \
-    org_orgtag, org_address, org_note
+    org_orgtag, org_address, org_note, tag_count
 
 from model_v import Org_v, Address_v, Contact_v, \
     mango_entity_append_suggestion
@@ -212,7 +211,7 @@ class OrgListHandler(BaseOrgHandler, BaseOrgtagHandler,
 
     @staticmethod
     def _cache_key(name_search, tag_name_list, tag_all, page_view,
-                   visibility, moderator):
+                   visibility, moderator, zoom=None):
         if not visibility:
             visibility = "public"
         return sha1_concat(json.dumps({
@@ -222,6 +221,7 @@ class OrgListHandler(BaseOrgHandler, BaseOrgtagHandler,
             "visibility": visibility,
             "moderator": moderator,
             "pageView": page_view,
+            "zoom": zoom,
         }))
 
     @staticmethod
@@ -260,25 +260,32 @@ class OrgListHandler(BaseOrgHandler, BaseOrgtagHandler,
             'activity',
         ]
 
-        results = []
-        for path_short in include:
-            q = self.orm.query(
-                Orgtag.base_short,
-                func.count(Org.org_id).label("freq")
+        q = self.orm.query(
+            Orgtag.path_short,
+            Orgtag.base_short,
+            tag_count.c.public_count.label("freq")
+        ) \
+            .join(tag_count, and_(
+                tag_count.c.tag_type == "orgtag",
+                tag_count.c.tag_id == Orgtag.orgtag_id,
+            )) \
+            .filter(
+                Orgtag.public == True,
+                Orgtag.is_virtual == None,
+                Orgtag.path_short.in_(include),
+                tag_count.c.public_count > 0
             ) \
-                .join(org_orgtag, org_orgtag.c.orgtag_id == Orgtag.orgtag_id) \
-                .join(Org, Org.org_id == org_orgtag.c.org_id) \
-                .filter(
-                    Orgtag.public == True,
-                    Orgtag.is_virtual == None,
-                    Orgtag.path_short == path_short,
-                    Org.public == True
-                ) \
-                .group_by(Orgtag.orgtag_id) \
-                .order_by(func.count(Org.org_id).desc()) \
-                .limit(10)
+            .order_by(tag_count.c.public_count.desc())
+
+        # The 10 most frequent tags of each path.
+        path_results = {path_short: [] for path_short in include}
+        for path_short, base_short, freq in q:
+            if len(path_results[path_short]) < 10:
+                path_results[path_short].append((base_short, freq))
 
-            results += list(q.all())
+        results = []
+        for path_short in include:
+            results += path_results[path_short]
 
         return self._get_random_suggestions(results, 2)
 
@@ -322,6 +329,7 @@ class OrgListHandler(BaseOrgHandler, BaseOrgtagHandler,
 
         return suggestions
 
+    @gen.coroutine
     def get(self):
         # pylint: disable=redefined-variable-type
         # Pylint thinks `page_view` is first defined as a list
@@ -340,8 +348,13 @@ class OrgListHandler(BaseOrgHandler, BaseOrgtagHandler,
         page_view = self.get_argument_allowed(
             "pageView", ["entity", "map", "marker"],
             default="entity", is_json=is_json)
+        zoom = self.get_argument_zoom("zoom", None, is_json=is_json)
 
-        if not self.accept_type("json"):
+        # Only markers have a compact encoding.
+        media_type = page_view == "marker" and self.compact_type() or None
+        accept_json = bool(self.accept_type("json") or media_type)
+
+        if not accept_json:
             if self.has_javascript:
                 self.load_map = True
                 self.render(
@@ -357,8 +370,27 @@ class OrgListHandler(BaseOrgHandler, BaseOrgtagHandler,
             if page_view == "entity":
                 page_view = "map"
 
-        cache_key = None
-        if self.accept_type("json") and not location and not offset:
+        def get_org_packet(db):
+            # pylint: disable=protected-access
+            # Calling the handler's own methods on its `db_view`.
+            org_packet = db._get_org_packet_search(
+                name=name,
+                name_search=name_search,
+                tag_name_list=tag_name_list,
+                tag_all=tag_all,
+                location=location,
+                visibility=self.parameters.get("visibility", None),
+                offset=offset,
+                page_view=page_view,
+                zoom=zoom,
+                )
+
+            org_packet["hint"] = db._get_suggestions(
+                tag_name_list, bool(name or name_search))
+
+            return org_packet
+
+        if accept_json and not location and not offset:
             cache_key = self._cache_key(
                 name_search,
                 tag_name_list,
@@ -366,34 +398,24 @@ class OrgListHandler(BaseOrgHandler, BaseOrgtagHandler,
                 page_view,
                 self.parameters.get("visibility", None),
                 self.moderator,
+                zoom,
                 )
-            value = self.cache.get(cache_key)
-            if value:
-                self.set_header(
-                    "Content-Type", "application/json; charset=UTF-8")
-                self.write(value)
-                self.finish()
-                return
-
-        org_packet = self._get_org_packet_search(
-            name=name,
-            name_search=name_search,
-            tag_name_list=tag_name_list,
-            tag_all=tag_all,
-            location=location,
-            visibility=self.parameters.get("visibility", None),
-            offset=offset,
-            page_view=page_view,
-            )
-
-        org_packet["hint"] = self._get_suggestions(
-            tag_name_list, bool(name or name_search))
+            entry = yield self.cache_fetch_json(
+                cache_key,
+                get_org_packet,
+                ["org", "orgtag", "address"],
+                media_type,
+                search=bool(name_search))
+            self.write_json_entry(entry, media_type)
+            return
 
-        if cache_key:
-            self.cache.set(cache_key, json.dumps(org_packet))
+        if name_search:
+            org_packet = yield self.run_search(get_org_packet)
+        else:
+            org_packet = yield self.run_db(get_org_packet)
 
-        if self.accept_type("json"):
-            self.write_json(org_packet)
+        if accept_json:
+            self.write_json(org_packet, media_type)
         else:
             self.load_map = True
             self.render(
@@ -424,73 +446,37 @@ class OrgNewHandler(BaseOrgHandler):
 
 
 class OrgSearchHandler(BaseOrgHandler):
+    @gen.coroutine
     def get(self):
+        # pylint: disable=protected-access
+        # Calling the handler's own methods on its `db_view`.
         is_json = self.content_type("application/json")
         name = self.get_argument("name", None, is_json=is_json)
-        public = not self.moderator
-
-        search = self.orm.get_bind().search
-
-        if search:
-            data = {
-                "query": {
-                    "multi_match": {
-                        "fields": [
-                            "alias_public.straight^3",
-                            "alias_public.fuzzy",
-                            ],
-                        "query": name
-                        }
-                    }
-                }
-            if public:
-                data = {
-                    "query": {
-                        "filtered": {
-                            "filter": {
-                                "term": {
-                                    "public": 1
-                                    }
-                                },
-                            "query": {
-                                "multi_match": {
-                                    "fields": [
-                                        "alias_public.straight^3",
-                                        "alias_public.fuzzy",
-                                        ],
-                                    "query": name
-                                    }
-                                }
-                            }
-                        }
-                    }
+        offset = self.get_argument_int("offset", None, is_json=is_json)
 
-            results = search.search(data, index="mango", doc_type="org")
-            org_list = []
-            for hit in results["hits"]["hits"]:
-                source = hit["_source"]
-                max_ratio = None
-                max_alias = None
-                for alias in source["alias_public"]:
-                    ratio = Levenshtein.ratio(name.lower(), alias.lower())
-                    if max_alias is None or ratio > max_ratio:
-                        max_alias = alias
-                        max_ratio = ratio
-                if max_alias == source["name"]:
-                    max_alias = None
-                org = {
-                    "orgId": source["org_id"],
-                    "name": source["name"],
-                    "alias": max_alias,
-                    "score": hit["_score"],
-                    }
-                if not public:
-                    org["public"] = source["public"]
-                org_list.append(org)
-            self.write_json(org_list)
+        if not name:
+            self.write_json([])
             return
 
-        self.write_json(1)
+        hit_list = yield self.run_search(
+            lambda db: db._search_org_names(
+                name,
+                visibility=self.moderator and "all" or None,
+                offset=offset or 0,
+            ))
+
+        org_list = []
+        for hit in hit_list:
+            org = {
+                "orgId": hit["org_id"],
+                "name": hit["name"],
+                "alias": hit["alias"],
+                "score": hit["score"],
+                }
+            if self.moderator:
+                org["public"] = hit["public"]
+            org_list.append(org)
+        self.write_json(org_list)
 
 
 
@@ -559,7 +545,9 @@ class OrgHandler(BaseOrgHandler, MangoEntityHandlerMixin):
             org_v = self._get_org_v(org_id)
             if org_v:
                 required = False
-        org = self._get_org(org_id, required=required)
+        org = self._get_org(
+            org_id, required=required,
+            options=Org.detail_options(all_visible=self.deep_visible()))
 
         if self.moderator and not org:
             self.next_ = "%s/revision" % org_v.url
@@ -826,7 +814,21 @@ class OrgAddressListHandler(BaseOrgHandler, BaseAddressHandler):
             )
 
     @authenticated
+    @gen.coroutine
     def post(self, org_id):
+        # Geocode before loading anything, and load, modify and commit
+        # without yielding after it.
+        address = self._create_address()
+        address_v = None
+        if not self.moderator:
+            # Its ID is set once `address` has reserved one.
+            address_v = self._create_address_v(None)
+        yield self._before_address_set(address)
+        if address_v:
+            # Same address, so no need to geocode again.
+            address_v.latitude = address.latitude
+            address_v.longitude = address.longitude
+
         required = True
         if self.contributor:
             org_v = self._get_org_v(org_id)
@@ -838,8 +840,6 @@ class OrgAddressListHandler(BaseOrgHandler, BaseAddressHandler):
         self._update_entity_autoincrement(
             Address, Address_v, "address_id")
 
-        address = self._create_address()
-        self._before_address_set(address)
         self.orm.add(address)
         self.orm_commit()
         if self.moderator:
@@ -857,8 +857,7 @@ class OrgAddressListHandler(BaseOrgHandler, BaseAddressHandler):
             .delete()
         self.orm_commit()
 
-        address_v = self._create_address_v(id_)
-        self._before_address_set(address_v)
+        address_v.address_id = id_
         self.orm.add(address_v)
         self.orm_commit()
 
@@ -927,6 +926,7 @@ class OrgContactListHandler(BaseOrgHandler, BaseContactHandler):
             )
 
     @authenticated
+    @gen.coroutine
     def post(self, org_id):
         required = True
         if self.contributor:
@@ -940,7 +940,7 @@ class OrgContactListHandler(BaseOrgHandler, BaseContactHandler):
             Contact, Contact_v, "contact_id")
 
         contact = self._create_contact()
-        self._before_contact_set(contact)
+        yield self._before_contact_set(contact)
         self.orm.add(contact)
         self.orm_commit()
         if self.moderator:
@@ -959,7 +959,7 @@ class OrgContactListHandler(BaseOrgHandler, BaseContactHandler):
         self.orm_commit()
 
         contact_v = self._create_contact_v(id_)
-        self._before_contact_set(contact_v)
+        yield self._before_contact_set(contact_v)
         self.orm.add(contact_v)
         self.orm_commit()
 
@@ -1343,8 +1343,8 @@ class ModerationOrgDescHandler(BaseOrgHandler):
         offset = self.get_argument_int("offset", None, is_json=is_json)
 
         name_subquery = self._get_name_search_query(
-            name=None,
-            name_search=None,
+            name=name,
+            name_search=name_search,
             visibility=self.parameters.get("visibility", None),
             ).subquery()
 
@@ -1386,6 +1386,10 @@ class ModerationOrgDescHandler(BaseOrgHandler):
 
 
 
+IncludeOrg = namedtuple("IncludeOrg", ["url", "name"])
+
+
+
 class ModerationOrgIncludeHandler(BaseOrgHandler):
     # pylint: disable=singleton-comparison
     # Cannot use `is` in SQLAlchemy filters
@@ -1409,10 +1413,22 @@ class ModerationOrgIncludeHandler(BaseOrgHandler):
         )
 
     @authenticated
+    @gen.coroutine
     def get(self):
+        # pylint: disable=protected-access
+        # Calling the handler's own methods on its `db_view`.
         if not self.moderator:
             raise HTTPError(404)
 
+        packet = yield self.run_db(lambda db: db._get_include_packet())
+
+        self.render(
+            'moderation-org-include.html',
+            packet=packet,
+            max_block_length=200
+        )
+
+    def _get_include_packet(self):
         act_query = self.orm.query(
             func.count(Orgtag.orgtag_id).label("count")
         ) \
@@ -1505,18 +1521,11 @@ class ModerationOrgIncludeHandler(BaseOrgHandler):
 
         def location_subquery(location, min_radius=16):  # 10 miles
             location = geo.bounds(location, min_radius=min_radius)
-            return self.orm.query(func.count(Address.address_id) \
+            query = self.orm.query(func.count(Address.address_id) \
                                            .label("count")) \
                 .join(org_address) \
-                .add_columns(org_address.c.org_id) \
-                .filter(and_(
-                    Address.latitude != None,
-                    Address.longitude != None,
-                    Address.latitude >= location.south,
-                    Address.latitude <= location.north,
-                    Address.longitude >= location.west,
-                    Address.longitude <= location.east,
-                )) \
+                .add_columns(org_address.c.org_id)
+            return Address.filter_geobox(query, location) \
                 .group_by(org_address.c.org_id) \
                 .subquery()
 
@@ -1593,66 +1602,64 @@ class ModerationOrgIncludeHandler(BaseOrgHandler):
                 act, addr, dseitag, saptag, tag, sap2017, dsei2015,
                 israel, canterbury, sipri, note
         ) in org_query:
+            # Only plain data leaves the session.
+            include_org = IncludeOrg(url=org.url, name=org.name)
             if act:
                 if org.public:
                     if not addr:
                         packet["addr_public"] \
-                            .append((org, dseitag, saptag, tag))
+                            .append((include_org, dseitag, saptag, tag))
                     elif include:
                         packet["act_include_public"] += 1
                     else:
                         packet["act_exclude_public"] \
-                            .append((org, dseitag, saptag, tag))
+                            .append((include_org, dseitag, saptag, tag))
                 elif org.public == False:
                     if not include:
                         packet["act_exclude_private"] += 1
                     else:
                         packet["act_include_private"] \
-                            .append((org, dseitag, saptag, tag))
+                            .append((include_org, dseitag, saptag, tag))
                 else:
                     if not include:
                         packet["act_exclude_pending"] \
-                            .append((org, dseitag, saptag, tag))
+                            .append((include_org, dseitag, saptag, tag))
                     else:
                         packet["act_include_pending"] \
-                            .append((org, dseitag, saptag, tag))
+                            .append((include_org, dseitag, saptag, tag))
             elif org.public:
                 packet["remove_public"] \
-                    .append((org, dseitag, saptag, tag))
+                    .append((include_org, dseitag, saptag, tag))
             elif org.public == False:
                 packet["remove_private"] \
-                    .append((org, dseitag, saptag, tag))
+                    .append((include_org, dseitag, saptag, tag))
             else:
                 # Pending
                 if org.description:
                     packet["desc_pending"] \
-                        .append((org, dseitag, saptag, tag))
+                        .append((include_org, dseitag, saptag, tag))
                 elif note > 3:
                     packet["note_pending"] \
-                        .append((org, dseitag, saptag, tag))
+                        .append((include_org, dseitag, saptag, tag))
                 elif sap2017:
                     packet["sap2017_pending"] \
-                        .append((org, dseitag, saptag, tag))
+                        .append((include_org, dseitag, saptag, tag))
                 elif dsei2015:
                     packet["dsei2015_pending"] \
-                        .append((org, dseitag, saptag, tag))
+                        .append((include_org, dseitag, saptag, tag))
                 elif israel:
                     packet["israel_pending"] \
-                        .append((org, dseitag, saptag, tag))
+                        .append((include_org, dseitag, saptag, tag))
                 elif canterbury:
                     packet["canterbury_pending"] \
-                        .append((org, dseitag, saptag, tag))
+                        .append((include_org, dseitag, saptag, tag))
                 elif sipri:
                     packet["sipri_pending"] \
-                        .append((org, dseitag, saptag, tag))
+                        .append((include_org, dseitag, saptag, tag))
                 elif include:
                     packet["include_pending"] \
-                        .append((org, dseitag, saptag, tag))
+                        .append((include_org, dseitag, saptag, tag))
                 else:
                     packet["exclude_pending"] += 1
 
-        self.render(
-            'moderation-org-include.html',
-            packet=packet,
-            max_block_length=200
-        )
+        return packet
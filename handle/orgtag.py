@@ -1,8 +1,8 @@
 
-from sqlalchemy.sql import func
+from sqlalchemy.sql import func, and_
 from tornado.web import HTTPError
 
-from model import Org, Orgtag, org_orgtag
+from model import Org, Orgtag, org_orgtag, tag_count
 
 from handle.base import authenticated, \
     MangoEntityHandlerMixin, MangoEntityListHandlerMixin
@@ -263,22 +263,20 @@ class OrgtagActivityHandler(BaseOrgtagHandler):
 
         visibility = self.parameters.get("visibility", None)
 
-        q1 = self.orm.query(org_orgtag.c.orgtag_id) \
-            .join(Org, org_orgtag.c.org_id == Org.org_id) \
-            .add_columns(Org.org_id)
-        q1 = self.filter_visibility(q1, Org, visibility=visibility)
-        s1 = q1.subquery()
+        count = self._tag_count_column(visibility)
 
         q2 = self.orm.query(Orgtag) \
-             .outerjoin(s1, Orgtag.orgtag_id == s1.c.orgtag_id) \
-             .add_columns(func.count(s1.c.org_id).label("count"))
+             .outerjoin(tag_count, and_(
+                 tag_count.c.tag_type == self.tag_type,
+                 tag_count.c.tag_id == Orgtag.orgtag_id,
+             )) \
+             .add_columns(func.coalesce(count, 0).label("count"))
         q2 = self.filter_visibility(q2, Orgtag, visibility='all')
         q2 = q2 \
             .filter(
                 Orgtag.path_short.in_(path_list),
                 Orgtag.is_virtual == None,
             ) \
-            .group_by(Orgtag.orgtag_id) \
             .order_by(Orgtag.path_short, Orgtag.name_short)
 
         orgtag_list = []
@@ -4,6 +4,7 @@
 # Allow aliased abstract class names
 
 
+from tornado import gen
 from tornado.web import HTTPError
 from sqlalchemy.orm import aliased
 from sqlalchemy.sql.expression import exists, and_, or_
@@ -12,7 +13,7 @@ from sqlalchemy.orm.exc import NoResultFound
 from model import Org, Event, Address, Contact, User
 from model_v import Org_v, Event_v, Address_v, Contact_v, \
     org_address_v, event_address_v, org_contact_v, event_contact_v, \
-    get_history
+    get_history, parse_history_cursor
 
 from handle.base import BaseHandler, authenticated
 
@@ -388,6 +389,7 @@ class UserListHandler(BaseHandler):
 
 class UserHandler(BaseHandler):
     @authenticated
+    @gen.coroutine
     def get(self, user_id):
         if user_id == "self":
             user_url = "/user/%d" % self.current_user.user_id
@@ -399,14 +401,21 @@ class UserHandler(BaseHandler):
             raise HTTPError(404, "%d: No such user" % user_id)
 
         is_json = self.content_type("application/json")
-        offset = self.get_argument_int("offset", None, is_json=is_json)
+        before = self.get_argument_restricted(
+            "before", parse_history_cursor,
+            "Value must be a history cursor", None, is_json)
+        after = self.get_argument_restricted(
+            "after", parse_history_cursor,
+            "Value must be a history cursor", None, is_json)
 
         submissions = {}
         history = None
 
         if self.moderator:
-            history = get_history(
-                self.orm, user.user_id, offset=offset, limit=50)
+            history = yield self.run_db(
+                lambda db: get_history(
+                    db.orm, user.user_id, limit=50,
+                    before=before, after=after))
         else:
             if user != self.current_user:
                 raise HTTPError(404)
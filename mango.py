@@ -2,14 +2,13 @@
 
 import re
 import sys
-import datetime
-
-import redis
+from concurrent.futures import ThreadPoolExecutor
 
 from mako.lookup import TemplateLookup
 
 import tornado.httpserver
 import tornado.ioloop
+import tornado.process
 import tornado.web
 from tornado.options import define, options
 
@@ -17,8 +16,12 @@ from sqlalchemy import create_engine, __version__ as sqlalchemy_version
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.orm.query import Query
 from sqlalchemy.exc import SQLAlchemyError, OperationalError
+from sqlalchemy import event as sqla_event
 
 import firma
+import compact
+
+from cache import RedisCache, MemoryCache
 
 from handle.base import \
     DefaultHandler, \
@@ -79,8 +82,14 @@ from handle.contact import ContactHandler, \
     ContactRevisionListHandler, ContactRevisionHandler
 from handle.history import HistoryHandler
 from handle.moderation import ModerationQueueHandler
-
-from model import mysql, Org, attach_search
+from handle.base_moderation import rebuild_moderation_pending, \
+    verify_moderation_pending
+
+from model import mysql, Org, Session, attach_search, verify_org_name, \
+    rebuild_tag_count, verify_tag_count
+from model_v import verify_history
+from model import cache_tags_flush_listener, cache_tags_rollback_listener, \
+    pop_cache_tags
 from model import CONF_PATH, DATABASE_NAMES
 
 
@@ -97,6 +106,29 @@ define("offsite", type=bool, default=None,
 define("events", type=bool, default=True, help="Enable events. Default is 1.")
 define("verify_search", type=bool, default=True,
        help="Verify Elasticsearch data on startup. Default is 1.")
+define("verify_org_names", type=bool, default=False,
+       help="Compare every org name with the name search table on "
+       "startup, rather than only counts and lengths. Default is 0.")
+define("rebuild_moderation", type=bool, default=False,
+       help="Rebuild the moderation queue on startup, rather than only "
+       "when it is found to be stale. Default is 0.")
+define("rebuild_tag_count", type=bool, default=False,
+       help="Rebuild tag counts on startup, rather than only when their "
+       "totals are found to be wrong. Default is 0.")
+define("cache_memory", type=int, default=64,
+       help="Size of the in-process cache in megabytes. 0 disables. "
+       "Default is 64.")
+define("db_threads", type=int, default=0,
+       help="Number of threads for slow database work. 0 runs it on the "
+       "IOLoop. Default is 0.")
+define("cache_threads", type=int, default=2,
+       help="Number of threads for Redis calls from coroutines. 0 makes "
+       "them on the IOLoop. Default is 2.")
+define("search_threads", type=int, default=2,
+       help="Number of threads for Elasticsearch queries when there are no "
+       "database threads. Default is 2.")
+define("geocode_threads", type=int, default=4,
+       help="Number of threads for geocoding lookups. Default is 4.")
 
 
 
@@ -104,61 +136,6 @@ FORWARDING_SERVER_LIST = [
     "127.0.0.1",
     ]
 
-DEFAULT_CACHE_PERIOD = 60 * 60 * 8  # 8 hours
-
-
-
-class RedisCache(object):
-    def __init__(self, namespace):
-        super(RedisCache, self).__init__()
-        self._cache = redis.StrictRedis()
-        self.set_namespace(namespace)
-
-    def set_namespace(self, namespace):
-        self._namespace = namespace
-        return self._namespace
-
-    def get_namespace(self):
-        return self._namespace
-
-    def key(self, key):
-        return self._namespace + ":" + key
-
-    @property
-    def name(self):
-        return "redis"
-
-    @property
-    def connected(self):
-        try:
-            self._cache.ping()
-        except (redis.ConnectionError, redis.exceptions.ResponseError):
-            return False
-        return True
-
-    def get(self, key):
-        try:
-            value = self._cache.get(self.key(key))
-        except (redis.ConnectionError, redis.exceptions.ResponseError):
-            value = None
-        if value:
-            value = str(value, "utf-8")
-        return value
-
-    def set(self, key, value, period=DEFAULT_CACHE_PERIOD):
-        try:
-            self._cache.set(self.key(key), str(value))
-            if period:
-                self._cache.expire(self.key(key), period)
-        except (redis.ConnectionError, redis.exceptions.ResponseError):
-            pass
-
-    def delete(self, key):
-        try:
-            self._cache.delete(self.key(key))
-        except (redis.ConnectionError, redis.exceptions.ResponseError):
-            pass
-
 
 
 def SafeQueryClass(retry=3):
@@ -200,6 +177,8 @@ class MangoApplication(firma.Application):
     title = "Mapping Application for NGOs (Mango)"
     sqlite_path = "mango.db"
     max_age = 86400 * 365 * 10  # 10 years
+    compress_types = (compact.JSON_TYPE, compact.BINARY_TYPE)
+    session_model = Session
 
     def cache_namespace(self, offset=""):
         hash_ = sha1_concat(
@@ -235,14 +214,27 @@ class MangoApplication(firma.Application):
             regex_handlers.append((regex, handler, kwargs))
         return regex_handlers
 
-    def increment_cache(self):
-        offset = datetime.datetime.utcnow().isoformat()
-        namespace = self.cache_namespace(offset)
-        self.cache.set_namespace(namespace)
+    def cache_registry(self):
+        "Key of the set of cache namespaces used by this database."
+        hash_ = sha1_concat(self.database_namespace)
+        return "%s:namespace:%s" % (self.name, hash_[:7])
+
+    def cache_commit_listener(self, session):
+        self.cache.invalidate(pop_cache_tags(session))
+
+    def server_status(self):
+        return {
+            "cache": self.cache.stats(),
+        }
 
     def __init__(self):
         self.orm = None
+        self.db_executor = None
+        self.cache_executor = None
+        self.search_executor = None
+        self.geocode_executor = None
         self.cache = None
+        self.json_cache = None
         self.cache_log = None
         self.database_namespace = None
         self.skin = None
@@ -456,23 +448,54 @@ class MangoApplication(firma.Application):
 
         self.database_namespace = 'mysql://%s' % conf.database
         self.cache = RedisCache(
-            self.cache_namespace(datetime.datetime.utcnow().isoformat()))
+            self.cache_namespace(self.started.isoformat()),
+            registry=self.cache_registry(),
+            memory=options.cache_memory * 1024 * 1024,
+            compress_min_length=(
+                options.compress_min_length if options.compress else None))
+        self.cache.purge()
+        self.session_cache = self.cache
+        # Decoded values of `self.cache` that requests filter, by ETag.
+        self.json_cache = options.cache_memory and MemoryCache(
+            options.cache_memory * 1024 * 1024) or None
 
         signature = "%s@%s" % (conf.app_username, conf.database)
         connection_url = mysql.connection_url_app(CONF_PATH)
 
         engine = create_engine(
             connection_url,
+            pool_size=5 + options.db_threads,  # Default plus one per thread
             pool_recycle=3600  # Expire connections after 1 hours
         )                      # (MySQL disconnects unilaterally after 8)
 
         mysql.engine_disable_mode(engine, "ONLY_FULL_GROUP_BY")
 
-        self.orm = scoped_session(sessionmaker(
+        session_factory = sessionmaker(
             bind=engine,
             autocommit=False,
             query_cls=SafeQueryClass(),
-        ))
+        )
+
+        # Invalidate cache tags of entities changed by each commit.
+        sqla_event.listen(
+            session_factory, "after_flush", cache_tags_flush_listener)
+        sqla_event.listen(
+            session_factory, "after_commit", self.cache_commit_listener)
+        sqla_event.listen(
+            session_factory, "after_rollback", cache_tags_rollback_listener)
+
+        # Count statements and time spent in the database per request.
+        firma.sql_stats_listen(engine, session_factory)
+
+        self.orm = scoped_session(session_factory)
+        if options.db_threads:
+            self.db_executor = ThreadPoolExecutor(options.db_threads)
+        if options.cache_threads:
+            self.cache_executor = ThreadPoolExecutor(options.cache_threads)
+        self.search_executor = ThreadPoolExecutor(
+            max(1, options.search_threads))
+        self.geocode_executor = ThreadPoolExecutor(
+            max(1, options.geocode_threads))
 
         try:
             self.orm.query(Org).first()
@@ -480,16 +503,43 @@ class MangoApplication(firma.Application):
             sys.stderr.write(
                 "Cannot connect to database %s.\n" % signature)
             sys.exit(1)
-        attach_search(engine, self.orm, verify=options.verify_search)
+        # Only the first process repairs derived tables and the index.
+        attach_search(
+            engine, self.orm,
+            verify=options.verify_search and not tornado.process.task_id())
+        if not tornado.process.task_id():
+            verify_org_name(self.orm, names=options.verify_org_names)
+            if options.rebuild_moderation:
+                rebuild_moderation_pending(self.orm)
+            else:
+                verify_moderation_pending(self.orm)
+            if options.rebuild_tag_count:
+                rebuild_tag_count(self.orm)
+            else:
+                verify_tag_count(self.orm)
+            verify_history(self.orm)
         self.orm.remove()
 
         self.add_stat("MySQL", "Connected (%s)" % signature)
+        self.add_stat(
+            "Database threads",
+            options.db_threads and "%d" % options.db_threads or "IOLoop")
+        self.add_stat(
+            "Search threads",
+            options.db_threads and "Database threads" or
+            "%d" % max(1, options.search_threads))
+        self.add_stat(
+            "Geocoding threads", "%d" % max(1, options.geocode_threads))
 
         self.add_stat("Cache", "%s (%s) %s" % (
             self.cache.name,
             self.cache.connected and "active" or "inactive",
             self.cache.get_namespace()
         ))
+        self.add_stat(
+            "Memory cache",
+            options.cache_memory and "%d MB" % options.cache_memory or
+            "Disabled")
 
         # Secondary Databases
 
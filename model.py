@@ -15,13 +15,17 @@ import argparse
 import datetime
 
 from sqlalchemy import create_engine
-from sqlalchemy import Column, Table, text
-from sqlalchemy import ForeignKey, UniqueConstraint, CheckConstraint
+from sqlalchemy import Column, Table, text, and_, or_, bindparam
+from sqlalchemy import ForeignKey, UniqueConstraint, CheckConstraint, Index
 from sqlalchemy.orm import relationship, object_session, reconstructor
+from sqlalchemy.orm import selectinload, sessionmaker
+from sqlalchemy.orm.session import Session as OrmSession
+from sqlalchemy.orm.attributes import get_history
 from sqlalchemy.orm.util import has_identity
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.sql import func
+from sqlalchemy.sql import func, select, literal
+from sqlalchemy.sql.expression import case
 
 from sqlalchemy import Boolean, Integer, Float as FloatOrig, Date, Time
 from sqlalchemy import Unicode as UnicodeOrig, String as StringOrig
@@ -55,6 +59,7 @@ CONF_PATH = ".mango.conf"
 DATABASE_NAMES = mysql.load_database_names(CONF_PATH)
 
 SYSTEM_USER_ID = -1
+ORG_NAME_BUCKET = 1000  # Org IDs per name search consistency check
 IGNORE_ORG_NAME_WORDS = None
 IGNORE_ORG_NAME_CSV_PATH = os.path.join(
     os.path.dirname(os.path.realpath(__file__)),
@@ -358,6 +363,14 @@ class MangoEntity(object):
         return (getattr(self, "entity_v_id", None) and
                 getattr(self, self.entity_v_id.key, None))
 
+    @property
+    def cache_tag_list(self):
+        "Tags of cached data that depend on this entity."
+        if getattr(self, "entity_v_id", None):
+            # Revisions are not cached.
+            return []
+        return [self.__tablename__]
+
 
 
 
@@ -545,6 +558,45 @@ note_fts = Table(
 
 
 
+# Denormalised org and orgalias names for name search.
+# Maintained by the `Org` and `Orgalias` listeners below.
+
+org_name = Table(
+    'org_name', Base.metadata,
+    Column('org_name_id', Integer, primary_key=True),
+    Column('org_id', Integer, nullable=False, index=True),
+    Column('orgalias_id', Integer, index=True),
+    Column('name', Unicode(), nullable=False),
+    mysql_engine='InnoDB',
+)
+
+
+
+org_name_trigram = Table(
+    'org_name_trigram', Base.metadata,
+    Column('trigram', UnicodeKey(), primary_key=True),
+    Column('org_name_id', Integer, ForeignKey('org_name.org_name_id'),
+           primary_key=True, index=True),
+    mysql_engine='InnoDB',
+)
+
+
+
+# Number of orgs or events with each tag, by visibility of the entity.
+# Maintained by triggers on the tag association and entity tables.
+
+tag_count = Table(
+    'tag_count', Base.metadata,
+    Column('tag_type', StringOrig(16), primary_key=True),
+    Column('tag_id', Integer, primary_key=True),
+    Column('public_count', Integer, nullable=False, server_default=text("0")),
+    Column('pending_count', Integer, nullable=False, server_default=text("0")),
+    Column('private_count', Integer, nullable=False, server_default=text("0")),
+    mysql_engine='InnoDB',
+)
+
+
+
 
 
 
@@ -874,6 +926,19 @@ class Org(Base, MangoEntity, NotableEntity):
     def _dummy(cls, _orm):
         return cls("dummy")
 
+    @classmethod
+    def detail_options(cls, all_visible=None):
+        "Query options that load each list on the org page in one query."
+        suffix = not all_visible and "_public" or ""
+        return [
+            selectinload(getattr(cls, "address_list" + suffix)),
+            selectinload(getattr(cls, "orgtag_list" + suffix)),
+            selectinload(getattr(cls, "event_list" + suffix)),
+            selectinload(getattr(cls, "orgalias_list" + suffix)),
+            selectinload(getattr(cls, "contact_list" + suffix))
+            .joinedload(Contact.medium),
+        ]
+
     @reconstructor
     def _reconstruct(self):
         # pylint: disable=attribute-defined-outside-init
@@ -1016,6 +1081,11 @@ class Orgalias(Base, MangoEntity):
         self.a_time = 0
         self.public = public
 
+    @property
+    def cache_tag_list(self):
+        # Aliases are cached as part of their org.
+        return ["org"]
+
     def __unicode__(self):
         return "<Orgalias-%s (%s) '%s':%d>" % (
             self.orgalias_id or "?",
@@ -1175,6 +1245,18 @@ class Event(Base, MangoEntity, NotableEntity):
         return cls("dummy",
                    datetime.date(1970, 1, 1), datetime.date(1970, 1, 1))
 
+    @classmethod
+    def detail_options(cls, all_visible=None):
+        "Query options that load each list on the event page in one query."
+        suffix = not all_visible and "_public" or ""
+        return [
+            selectinload(getattr(cls, "org_list" + suffix)),
+            selectinload(getattr(cls, "address_list" + suffix)),
+            selectinload(getattr(cls, "eventtag_list" + suffix)),
+            selectinload(getattr(cls, "contact_list" + suffix))
+            .joinedload(Contact.medium),
+        ]
+
     def __init__(self,
                  name, start_date, end_date,
                  description=None, start_time=None, end_time=None,
@@ -1232,9 +1314,14 @@ class Event(Base, MangoEntity, NotableEntity):
 
 class Address(Base, MangoEntity, NotableEntity):
     __tablename__ = 'address'
-    __table_args__ = {
-        "mysql_engine": 'InnoDB',
-    }
+    __table_args__ = (
+        # Serves `filter_geobox`. A B-tree only narrows by latitude;
+        # longitude is checked within that range.
+        Index("address_latitude_longitude", "latitude", "longitude"),
+        {
+            "mysql_engine": 'InnoDB',
+        }
+    )
 
     address_id = Column(Integer, primary_key=True)
 
@@ -1407,6 +1494,29 @@ class Address(Base, MangoEntity, NotableEntity):
     def scale(latitude):
         return math.cos(math.radians(latitude))
 
+    @staticmethod
+    def filter_geobox(query, geobox):
+        """
+        Filter `query` to addresses within `geobox`, using range
+        predicates that the latitude/longitude index can serve.
+        """
+        if geobox.is_inverse():
+            # Crosses the antimeridian.
+            longitude = or_(
+                Address.longitude >= geobox.west,
+                Address.longitude <= geobox.east,
+            )
+        else:
+            longitude = and_(
+                Address.longitude >= geobox.west,
+                Address.longitude <= geobox.east,
+            )
+        return query.filter(and_(
+            Address.latitude >= geobox.south,
+            Address.latitude <= geobox.north,
+            longitude,
+        ))
+
     @staticmethod
     def order_distance(query, latlon):
         # Very simplistic
@@ -1441,8 +1551,7 @@ class Address(Base, MangoEntity, NotableEntity):
 class Orgtag(Base, MangoEntity, NotableEntity):
     """
     is_virtual:  None = normal
-                 True = virtual
-                 False = virtual, currently active in an event
+                 True = virtual, maintained by `update_virtual_orgtags`
     """
 
     __tablename__ = 'orgtag'
@@ -1882,8 +1991,17 @@ class Contact(Base, MangoEntity):
 
 
 
+def query_search_orgs(orm, org_id_list):
+    "Orgs with the aliases needed for their search documents."
+    return orm.query(Org) \
+        .options(selectinload(Org.orgalias_list)) \
+        .filter(Org.org_id.in_(org_id_list))
+
+
+
 def attach_search(engine, orm, enabled=True, verify=True):
     engine.search = None
+    engine.search_queue = None
     if not enabled:
         return
     engine.search = search.get_search()
@@ -1893,6 +2011,9 @@ def attach_search(engine, orm, enabled=True, verify=True):
     if verify:
         search.verify(engine.search, orm, Org, Orgalias)
 
+    engine.search_queue = search.IndexQueue(
+        engine.search, sessionmaker(bind=engine), query_search_orgs)
+
 
 
 VIRTUAL_ORGTAG_LIST = [
@@ -1919,116 +2040,161 @@ VIRTUAL_ORGTAG_LIST = [
 
 
 
-def virtual_org_orgtag_all(org):
+def virtual_orgtag_list(connection):
+    """
+    Returns a list of `(orgtag_id, filter_search)` for the virtual tags in
+    `VIRTUAL_ORGTAG_LIST` that exist, cached on the engine once they all
+    do.
+    """
     # pylint: disable=singleton-comparison
     # Cannot use `is` in SQLAlchemy filters
 
-    if not VIRTUAL_ORGTAG_LIST:
-        return
+    engine = connection.engine
+    virtual_list = getattr(engine, "virtual_orgtag_list", None)
+    if virtual_list is None:
+        id_dict = dict(connection.execute(
+            select([Orgtag.name, Orgtag.orgtag_id])
+            .where(Orgtag.name.in_(
+                [virtual_name for virtual_name, _ in VIRTUAL_ORGTAG_LIST]))
+            .where(Orgtag.is_virtual == True)
+        ).fetchall())
+        virtual_list = [
+            (id_dict[virtual_name], filter_search)
+            for virtual_name, filter_search in VIRTUAL_ORGTAG_LIST
+            if virtual_name in id_dict
+        ]
+        if len(virtual_list) == len(VIRTUAL_ORGTAG_LIST):
+            engine.virtual_orgtag_list = virtual_list
+    return virtual_list
 
-    orm = object_session(org)
-    if not orm:
-        raise Exception("Neither org or orgtag attached to session.")
 
-    for virtual_name, filter_search in VIRTUAL_ORGTAG_LIST:
-        LOG.debug("\nVirtual tag: %s", virtual_name)
 
-        virtual_tag = orm.query(Orgtag) \
-            .filter_by(name=virtual_name) \
-            .filter_by(is_virtual=True) \
-            .first()
+def clear_virtual_orgtag_list(connection):
+    "Forget the cached virtual tag IDs, eg. after creating virtual tags."
+    connection.engine.virtual_orgtag_list = None
 
-        if not virtual_tag:
-            LOG.debug("  Virtual tag does not exist.")
-            continue
 
-        has_virtual_tag = orm.query(Orgtag) \
-            .join(Org, Orgtag.org_list) \
-            .filter(Org.org_id == org.org_id) \
-            .filter(Orgtag.is_virtual == None) \
-            .filter(filter_search)
-
-        LOG.debug("  Has %d child tags.", has_virtual_tag.count())
-        if LOG.level == logging.DEBUG:
-            for child_tag in has_virtual_tag:
-                LOG.debug("    %s", child_tag.name_short)
-
-        if has_virtual_tag.count():
-            if virtual_tag not in org.orgtag_list:
-                LOG.debug("  Adding parent tag.")
-                # Flag the virtual tag so it doesn't trigger a value error
-                virtual_tag.is_virtual = False
-                org.orgtag_list.append(virtual_tag)
-            else:
-                LOG.debug("  Already has parent tag.")
-        else:
-            if virtual_tag in org.orgtag_list:
-                LOG.debug("  Removing parent tag.")
-                # Flag the virtual tag so it doesn't trigger a value error
-                virtual_tag.is_virtual = False
-                org.orgtag_list.remove(virtual_tag)
-            else:
-                LOG.debug("  Doesn't have parent tag.")
 
+def update_virtual_orgtags(connection, org_id_list):
+    """
+    Give each org in `org_id_list` the virtual tags whose filters match
+    any of its other tags, and remove the rest, reading the tags of all
+    the orgs in one query.
+    """
+    # pylint: disable=singleton-comparison
+    # Cannot use `is` in SQLAlchemy filters
 
+    virtual_list = virtual_orgtag_list(connection)
+    if not (virtual_list and org_id_list):
+        return
 
-def virtual_org_orgtag_edit(org, orgtag, add=None):
+    virtual_id_set = set([orgtag_id for orgtag_id, _ in virtual_list])
+
+    query = select([org_orgtag.c.org_id, org_orgtag.c.orgtag_id] + [
+        case([(and_(Orgtag.is_virtual == None, filter_search), 1)], else_=0)
+        for _, filter_search in virtual_list
+    ]) \
+        .select_from(org_orgtag.join(
+            Orgtag.__table__, Orgtag.orgtag_id == org_orgtag.c.orgtag_id)) \
+        .where(org_orgtag.c.org_id.in_(org_id_list))
+
+    current = set()
+    wanted = set()
+    for row in connection.execute(query):
+        org_id, orgtag_id = row[0], row[1]
+        if orgtag_id in virtual_id_set:
+            current.add((org_id, orgtag_id))
+        for (virtual_id, _), match in zip(virtual_list, row[2:]):
+            if match:
+                wanted.add((org_id, virtual_id))
+
+    if wanted - current:
+        LOG.debug("Adding %d virtual tags.", len(wanted - current))
+        connection.execute(org_orgtag.insert(), [
+            {"org_id": org_id, "orgtag_id": orgtag_id}
+            for org_id, orgtag_id in sorted(wanted - current)
+        ])
+    if current - wanted:
+        LOG.debug("Removing %d virtual tags.", len(current - wanted))
+        connection.execute(
+            org_orgtag.delete()
+            .where(org_orgtag.c.org_id == bindparam("_org_id"))
+            .where(org_orgtag.c.orgtag_id == bindparam("_orgtag_id")),
+            [
+                {"_org_id": org_id, "_orgtag_id": orgtag_id}
+                for org_id, orgtag_id in sorted(current - wanted)
+            ])
+
+
+
+def update_all_virtual_orgtags(orm):
     """
-    Gets called:
-      before the orgtag is appended,
-      after the orgtag is removed.
+    Recompute the virtual tags of all orgs, with two statements for each
+    virtual tag.
     """
+    # pylint: disable=singleton-comparison
+    # Cannot use `is` in SQLAlchemy filters
 
-    if not VIRTUAL_ORGTAG_LIST:
-        return
+    connection = orm.connection()
+    clear_virtual_orgtag_list(connection)
+
+    for virtual_id, filter_search in virtual_orgtag_list(connection):
+        # `distinct` makes MySQL materialise the subquery, since it
+        # cannot otherwise select from the table being modified.
+        matching = select([org_orgtag.c.org_id]) \
+            .select_from(org_orgtag.join(
+                Orgtag.__table__,
+                Orgtag.orgtag_id == org_orgtag.c.orgtag_id)) \
+            .where(Orgtag.is_virtual == None) \
+            .where(filter_search) \
+            .distinct() \
+            .alias("matching")
+        tagged = org_orgtag.alias("tagged")
+
+        removed = connection.execute(
+            org_orgtag.delete()
+            .where(org_orgtag.c.orgtag_id == virtual_id)
+            .where(~org_orgtag.c.org_id.in_(select([matching.c.org_id])))
+        ).rowcount
+        added = connection.execute(
+            org_orgtag.insert().from_select(
+                ["org_id", "orgtag_id"],
+                select([matching.c.org_id, literal(virtual_id)])
+                .where(~matching.c.org_id.in_(
+                    select([tagged.c.org_id])
+                    .where(tagged.c.orgtag_id == virtual_id)))
+            )
+        ).rowcount
+        LOG.info("Virtual tag %d: added %d orgs, removed %d.",
+                 virtual_id, added, removed)
 
-    if orgtag.is_virtual:
-        LOG.debug("Cannot edit the membership of a virtual tag (%s).",
-                  orgtag.name)
-        return
+    orm.commit()
 
-    if orgtag.is_virtual is False:
-        # We're adding a virtual tag for a parent function call
-        orgtag.is_virtual = True
-        return
 
-    orm = object_session(org) or object_session(orgtag)
-    if not orm:
-        raise Exception("Neither org or orgtag attached to session.")
 
-    for virtual_name, filter_search in VIRTUAL_ORGTAG_LIST:
-        virtual_tag = orm.query(Orgtag) \
-            .filter_by(name=virtual_name) \
-            .filter_by(is_virtual=True) \
-            .first()
+def add_virtual_orgs(session, org_list):
+    "Update the virtual tags of `org_list` when `session` is next flushed."
+    session.info.setdefault("virtual_orgs", set()).update(org_list)
 
-        if not virtual_tag:
-            continue
 
-        has_virtual_tag_this = orm.query(Orgtag) \
-            .filter(Orgtag.orgtag_id == orgtag.orgtag_id) \
-            .filter(filter_search)
 
-        has_virtual_tag_others = orm.query(Orgtag) \
-            .filter_by(is_virtual=None) \
-            .join(Org, Orgtag.org_list) \
-            .filter(Org.org_id == org.org_id) \
-            .filter(filter_search)
+def virtual_orgtag_flush_listener(session, _flush_context):
+    org_set = session.info.pop("virtual_orgs", None)
+    if not org_set:
+        return
+
+    update_virtual_orgtags(session.connection(), [
+        org.org_id for org in org_set if org.org_id is not None])
+
+    # Reload the tag lists, which no longer match the database.
+    for org in org_set:
+        if org in session:
+            session.expire(org, ["orgtag_list"])
 
 
-        if (
-                (add and has_virtual_tag_this.count()) or
-                has_virtual_tag_others.count()
-        ):
-            if virtual_tag not in org.orgtag_list:
-                # Flag the virtual tag so it doesn't trigger a value error
-                virtual_tag.is_virtual = False
-                org.orgtag_list.append(virtual_tag)
-        else:
-            if virtual_tag in org.orgtag_list:
-                # Flag the virtual tag so it doesn't trigger a value error
-                virtual_tag.is_virtual = False
-                org.orgtag_list.remove(virtual_tag)
+
+def virtual_orgtag_rollback_listener(session):
+    session.info.pop("virtual_orgs", None)
 
 
 
@@ -2087,27 +2253,399 @@ def calculate_orgalias_visibility(org, connection=False):
 
 
 
+def org_name_trigrams(name):
+    """
+    Lowercase trigrams of `name`, padded at the end so that every
+    substring of one or two characters begins at least one trigram.
+    """
+    name = name.lower() + "  "
+    return set([name[i:i + 3] for i in range(len(name) - 2)])
+
+
+
+def org_name_search_subquery(orm, name_search):
+    """
+    Returns a subquery of `org_name_id` for names that may contain
+    `name_search`, using the trigram index. Candidates must still be
+    filtered by a case-insensitive "contains" to remove false positives.
+    """
+    value = name_search.lower()
+
+    query = orm.query(org_name_trigram.c.org_name_id.label("org_name_id"))
+    if len(value) < 3:
+        query = query \
+            .filter(org_name_trigram.c.trigram.startswith(value)) \
+            .distinct()
+    else:
+        trigram_list = set([value[i:i + 3] for i in range(len(value) - 2)])
+        query = query \
+            .filter(org_name_trigram.c.trigram.in_(trigram_list)) \
+            .group_by(org_name_trigram.c.org_name_id) \
+            .having(func.count() == len(trigram_list))
+
+    return query.subquery()
+
+
+
+def index_org_name(connection, org_id, orgalias_id, name):
+    """
+    Add an org name, or an orgalias name if `orgalias_id` is supplied,
+    to the name search table.
+    """
+    result = connection.execute(org_name.insert().values(
+        org_id=org_id,
+        orgalias_id=orgalias_id,
+        name=name,
+    ))
+    org_name_id = result.inserted_primary_key[0]
+
+    trigram_list = org_name_trigrams(name)
+    if trigram_list:
+        connection.execute(org_name_trigram.insert(), [
+            {"trigram": trigram, "org_name_id": org_name_id}
+            for trigram in trigram_list
+        ])
+
+
+
+def unindex_org_name(connection, org_id, orgalias_id=None, all_names=False):
+    """
+    Remove an org name, or an orgalias name if `orgalias_id` is supplied,
+    from the name search table. `all_names` removes the org name and
+    all its orgalias names.
+    """
+    # pylint: disable=singleton-comparison
+    # Cannot use `is` in SQLAlchemy filters
+
+    if all_names:
+        where = org_name.c.org_id == org_id
+    elif orgalias_id:
+        where = org_name.c.orgalias_id == orgalias_id
+    else:
+        where = (org_name.c.org_id == org_id) & \
+            (org_name.c.orgalias_id == None)
+
+    connection.execute(
+        org_name_trigram.delete().where(
+            org_name_trigram.c.org_name_id.in_(
+                select([org_name.c.org_name_id]).where(where)))
+    )
+    connection.execute(org_name.delete().where(where))
+
+
+
+def _org_name_rows(orm, start, end):
+    "Returns the expected rows of the name search table for a bucket."
+    query = orm.query(Org.org_id, Org.name) \
+        .filter(Org.org_id >= start, Org.org_id < end)
+    row_list = [(org_id, None, name) for org_id, name in query]
+    row_list += orm.query(
+        Orgalias.org_id, Orgalias.orgalias_id, Orgalias.name) \
+        .filter(Orgalias.org_id >= start, Orgalias.org_id < end) \
+        .all()
+    return row_list
+
+
+
+def _index_org_names(connection, start, end, row_list):
+    """
+    Add `(org_id, orgalias_id, name)` rows for a bucket of org IDs
+    to the name search table, in one statement per table.
+    """
+    if not row_list:
+        return
+    connection.execute(org_name.insert(), [{
+        "org_id": org_id,
+        "orgalias_id": orgalias_id,
+        "name": name,
+    } for org_id, orgalias_id, name in row_list])
+
+    # `executemany` doesn't return the new IDs, so read them back.
+    query = select([org_name.c.org_name_id, org_name.c.name]) \
+        .where(and_(org_name.c.org_id >= start, org_name.c.org_id < end))
+    trigram_list = [
+        {"trigram": trigram, "org_name_id": org_name_id}
+        for org_name_id, name in connection.execute(query)
+        for trigram in org_name_trigrams(name)
+    ]
+    if trigram_list:
+        connection.execute(org_name_trigram.insert(), trigram_list)
+
+
+
+def _unindex_org_names(connection, start, end):
+    where = and_(org_name.c.org_id >= start, org_name.c.org_id < end)
+    connection.execute(
+        org_name_trigram.delete().where(
+            org_name_trigram.c.org_name_id.in_(
+                select([org_name.c.org_name_id]).where(where)))
+    )
+    connection.execute(org_name.delete().where(where))
+
+
+
+def _org_name_buckets(orm):
+    max_org_id = max(
+        orm.query(func.max(Org.org_id)).scalar() or 0,
+        orm.query(func.max(org_name.c.org_id)).scalar() or 0,
+    )
+    for start in range(0, max_org_id + 1, ORG_NAME_BUCKET):
+        yield start, start + ORG_NAME_BUCKET
+
+
+
+def rebuild_org_name(orm):
+    LOG.info("Rebuilding org name search table.")
+
+    connection = orm.connection()
+    connection.execute(org_name_trigram.delete())
+    connection.execute(org_name.delete())
+
+    for start, end in _org_name_buckets(orm):
+        _index_org_names(
+            connection, start, end, _org_name_rows(orm, start, end))
+
+    orm.commit()
+
+
+
+def _org_name_checksum(orm, column, org_id_column, start, end):
+    return tuple(
+        int(value or 0) for value in orm.query(
+            func.count(), func.sum(func.length(column)))
+        .filter(org_id_column >= start, org_id_column < end)
+        .one()
+    )
+
+
+
+def _org_name_bucket_differs(orm, start, end, names):
+    if names:
+        query = orm.query(
+            org_name.c.org_id, org_name.c.orgalias_id, org_name.c.name) \
+            .filter(org_name.c.org_id >= start, org_name.c.org_id < end)
+        # `orgalias_id` may be `None`, which doesn't compare with integers.
+        indexed = sorted([tuple(row) for row in query], key=repr)
+        expected = sorted(
+            [tuple(row) for row in _org_name_rows(orm, start, end)],
+            key=repr)
+        return indexed != expected
+
+    indexed = _org_name_checksum(
+        orm, org_name.c.name, org_name.c.org_id, start, end)
+    org_count, org_length = _org_name_checksum(
+        orm, Org.name, Org.org_id, start, end)
+    alias_count, alias_length = _org_name_checksum(
+        orm, Orgalias.name, Orgalias.org_id, start, end)
+    return indexed != (org_count + alias_count, org_length + alias_length)
+
+
+
+def verify_org_name(orm, names=False):
+    """
+    Compare the org name search table with the orgs and orgaliases in
+    buckets of org IDs, and reindex buckets that differ.
+
+    Buckets are compared by their number of names and total name length
+    in the database, or name by name if `names` is true, which reads
+    every name.
+    """
+    connection = orm.connection()
+    repaired = 0
+
+    for start, end in _org_name_buckets(orm):
+        if not _org_name_bucket_differs(orm, start, end, names):
+            continue
+        _unindex_org_names(connection, start, end)
+        _index_org_names(
+            connection, start, end, _org_name_rows(orm, start, end))
+        repaired += 1
+
+    if not repaired:
+        LOG.debug("Org name search table is consistent.")
+        return
+
+    LOG.warning(
+        "Reindexed %d buckets of %d org IDs in the org name search table.",
+        repaired, ORG_NAME_BUCKET)
+    orm.commit()
+
+
+
+def _tag_count_sources():
+    return (
+        ("orgtag", Org, Org.org_id,
+         org_orgtag.c.org_id, org_orgtag.c.orgtag_id),
+        ("eventtag", Event, Event.event_id,
+         event_eventtag.c.event_id, event_eventtag.c.eventtag_id),
+    )
+
+
+
+def _tag_count_columns(Entity):
+    # pylint: disable=invalid-name,singleton-comparison
+    # Allow `Entity` as abstract class name.
+    # Cannot use `is` in SQLAlchemy filters
+    return [
+        func.sum(case([(Entity.public == True, 1)], else_=0)),
+        func.sum(case([(Entity.public == None, 1)], else_=0)),
+        func.sum(case([(Entity.public == False, 1)], else_=0)),
+    ]
+
+
+
+def rebuild_tag_count(orm):
+    """
+    Refill `tag_count` from the tag association tables. Triggers
+    maintain it from then on.
+    """
+    # pylint: disable=invalid-name
+    # Allow `Entity` as abstract class name.
+
+    LOG.info("Rebuilding tag count table.")
+
+    orm.execute(tag_count.delete())
+
+    for tag_type, Entity, entity_id, cross_entity_id, cross_tag_id in \
+            _tag_count_sources():
+        count_query = orm.query(
+            literal(tag_type),
+            cross_tag_id,
+            *_tag_count_columns(Entity)
+        ) \
+            .join(Entity, entity_id == cross_entity_id) \
+            .group_by(cross_tag_id)
+
+        orm.execute(tag_count.insert().from_select(
+            ["tag_type", "tag_id",
+             "public_count", "pending_count", "private_count"],
+            count_query.statement))
+
+    orm.commit()
+
+
+
+def verify_tag_count(orm):
+    """
+    Rebuild the tag count table if its totals for each tag type and
+    visibility do not match the tag association tables.
+    """
+    # pylint: disable=invalid-name
+    # Allow `Entity` as abstract class name.
+
+    for tag_type, Entity, entity_id, cross_entity_id, _cross_tag_id in \
+            _tag_count_sources():
+        count = orm.query(
+            func.sum(tag_count.c.public_count),
+            func.sum(tag_count.c.pending_count),
+            func.sum(tag_count.c.private_count),
+        ) \
+            .filter(tag_count.c.tag_type == tag_type) \
+            .one()
+        expected = orm.query(*_tag_count_columns(Entity)) \
+            .select_from(cross_entity_id.table) \
+            .join(Entity, entity_id == cross_entity_id) \
+            .one()
+        count = [int(value or 0) for value in count]
+        expected = [int(value or 0) for value in expected]
+
+        if count != expected:
+            LOG.warning(
+                "Tag count table has %s totals %s, but %s were expected.",
+                tag_type, count, expected)
+            rebuild_tag_count(orm)
+            return
+
+    LOG.debug("Tag count table is consistent.")
+
+
+
+def add_cache_tags(session, tag_list):
+    "Invalidate cache tags when `session` is next committed."
+    session.info.setdefault("cache_tags", set()).update(tag_list)
+
+
+def pop_cache_tags(session):
+    return session.info.pop("cache_tags", set())
+
+
+def cache_tags_flush_listener(session, _flush_context):
+    # `new`, `dirty` and `deleted` still show the pre-flush state.
+    for entity in session.new | session.dirty | session.deleted:
+        tag_list = getattr(entity, "cache_tag_list", None)
+        if tag_list:
+            add_cache_tags(session, tag_list)
+
+
+def cache_tags_rollback_listener(session):
+    pop_cache_tags(session)
+
+
+def add_search_orgs(session, org_id_list, operation=search.IndexQueue.INDEX):
+    "Send orgs to the search index when `session` is next committed."
+    operations = session.info.setdefault("search_orgs", {})
+    for org_id in org_id_list:
+        if org_id is not None:
+            operations[org_id] = operation
+
+
+def search_commit_listener(session):
+    operations = session.info.pop("search_orgs", None)
+    if not operations:
+        return
+    queue = getattr(session.get_bind(), "search_queue", None)
+    if queue:
+        queue.put(operations)
+
+
+def search_rollback_listener(session):
+    session.info.pop("search_orgs", None)
 
 
 def org_after_insert_listener(_mapper, connection, target):
+    index_org_name(connection, target.org_id, None, target.name)
     if connection.engine.search:
-        search.index_org(connection.engine.search, target)
+        add_search_orgs(object_session(target), [target.org_id])
 
 def org_after_update_listener(_mapper, connection, target):
+    if get_history(target, "name").has_changes():
+        unindex_org_name(connection, target.org_id)
+        index_org_name(connection, target.org_id, None, target.name)
     if connection.engine.search:
-        search.index_org(connection.engine.search, target)
+        add_search_orgs(object_session(target), [target.org_id])
 
 
 def org_after_delete_listener(_mapper, connection, target):
+    unindex_org_name(connection, target.org_id, all_names=True)
     if connection.engine.search:
-        search.delete_org(connection.engine.search, target)
+        add_search_orgs(
+            object_session(target), [target.org_id],
+            search.IndexQueue.DELETE)
 
 
 def orgalias_listener(_mapper, connection, target):
     calculate_orgalias_visibility(target.org, connection=connection)
     if connection.engine.search:
-        orm = object_session(target)
-        search.index_orgalias(connection.engine.search, target, orm, Orgalias)
+        # Also reindex the previous org of a moved alias.
+        add_search_orgs(
+            object_session(target),
+            [target.org_id] + list(get_history(target, "org_id").deleted))
+
+
+def orgalias_after_insert_listener(_mapper, connection, target):
+    index_org_name(connection, target.org_id, target.orgalias_id, target.name)
+
+def orgalias_after_update_listener(_mapper, connection, target):
+    if (
+            get_history(target, "name").has_changes() or
+            get_history(target, "org_id").has_changes()
+    ):
+        unindex_org_name(connection, target.org_id, target.orgalias_id)
+        index_org_name(
+            connection, target.org_id, target.orgalias_id, target.name)
+
+def orgalias_after_delete_listener(_mapper, connection, target):
+    unindex_org_name(connection, target.org_id, target.orgalias_id)
 
 
 def address_sanitise_listener(_mapper, _connection, address):
@@ -2126,12 +2664,19 @@ def tag_set_name_listener(_mapper, _connection, tag):
     tag.base_short = short_name(tag.base)
     tag.path_short = short_name(tag.path)
 
-def org_orgtag_append_listener(org, orgtag, _initiator):
-    virtual_org_orgtag_edit(org, orgtag, add=True)
+def org_orgtag_edit_listener(org, orgtag, _initiator):
+    orm = object_session(org) or object_session(orgtag)
+    if not orm:
+        raise Exception("Neither org or orgtag attached to session.")
+    add_virtual_orgs(orm, [org])
 
-def org_orgtag_remove_listener(org, orgtag, _initiator):
-    virtual_org_orgtag_edit(org, orgtag, add=False)
 
+sqla_event.listen(OrmSession, "after_commit", search_commit_listener)
+sqla_event.listen(OrmSession, "after_rollback", search_rollback_listener)
+sqla_event.listen(
+    OrmSession, "after_flush_postexec", virtual_orgtag_flush_listener)
+sqla_event.listen(
+    OrmSession, "after_rollback", virtual_orgtag_rollback_listener)
 
 sqla_event.listen(Org, "after_insert", org_after_insert_listener)
 sqla_event.listen(Org, "after_update", org_after_update_listener)
@@ -2140,6 +2685,10 @@ sqla_event.listen(Org, "after_delete", org_after_delete_listener)
 for event_name in ("after_insert", "after_update", "after_delete"):
     sqla_event.listen(Orgalias, event_name, orgalias_listener)
 
+sqla_event.listen(Orgalias, "after_insert", orgalias_after_insert_listener)
+sqla_event.listen(Orgalias, "after_update", orgalias_after_update_listener)
+sqla_event.listen(Orgalias, "after_delete", orgalias_after_delete_listener)
+
 sqla_event.listen(Address, 'before_insert', address_sanitise_listener)
 sqla_event.listen(Address, 'before_update', address_sanitise_listener)
 
@@ -2148,8 +2697,8 @@ sqla_event.listen(Orgtag, 'before_update', tag_set_name_listener)
 sqla_event.listen(Eventtag, 'before_insert', tag_set_name_listener)
 sqla_event.listen(Eventtag, 'before_update', tag_set_name_listener)
 
-sqla_event.listen(Org.orgtag_list, 'append', org_orgtag_append_listener)
-sqla_event.listen(Org.orgtag_list, 'remove', org_orgtag_remove_listener)
+sqla_event.listen(Org.orgtag_list, 'append', org_orgtag_edit_listener)
+sqla_event.listen(Org.orgtag_list, 'remove', org_orgtag_edit_listener)
 
 
 
@@ -5,8 +5,10 @@
 # and lowercase association table names for SQLAlchemy declarative
 # Allow calling `insert` on association tables without argument `dml`.
 
-from sqlalchemy import Column, Table
-from sqlalchemy import and_
+import logging
+
+from sqlalchemy import Column, Table, Index
+from sqlalchemy import and_, or_, func, text
 from sqlalchemy import ForeignKey, CheckConstraint
 
 from sqlalchemy import Boolean, Integer, Float as FloatOrig, Date, Time
@@ -24,7 +26,11 @@ from model import Base, User, Medium, MangoEntity, \
     org_address, event_address, \
     org_contact, event_contact
 
-from model import sanitise_name, sanitise_address
+from model import sanitise_name, sanitise_address, add_cache_tags
+
+
+
+LOG = logging.getLogger('model_v')
 
 Float = lambda: FloatOrig
 String = lambda: StringOrig
@@ -93,172 +99,238 @@ event_contact_v = Table(
     )
 
 
-def get_history(session, user_id=None, limit=20, offset=None):
-    if offset is None:
-        offset = 0
+
+# Entities whose latest revision is by a non-moderator.
+# Maintained by triggers on the version tables.
+moderation_pending = Table(
+    'moderation_pending', Base.metadata,
+    Column('entity_type', StringOrig(16), primary_key=True),
+    Column('entity_id', Integer, primary_key=True),
+    Column('entity_v_id', Integer, nullable=False),
+    )
+
+
+# Append-only feed of revisions for the history pages.
+# Maintained by triggers on the version and tag association tables.
+history = Table(
+    'history', Base.metadata,
+    Column('history_id', Integer, primary_key=True),
+    Column('type', StringOrig(16), nullable=False),
+    Column('entity_id', Integer, nullable=False),
+    Column('entity_v_id', Integer, nullable=False),
+    Column('parent_id', Integer),
+    Column('a_time', Float(), nullable=False),
+    Column('existence_v', Boolean),
+    Column('name', Unicode()),
+    Column('moderation_user_id', Integer),
+    Index('a_time', 'a_time', 'history_id'),
+    Index('moderation_user_id', 'moderation_user_id', 'a_time', 'history_id'),
+    )
+
+
+
+def verify_history(session):
+    """
+    Fill `history` from the version tables if it is empty, which is slow.
+    Triggers append to it from then on.
+    """
+
+    if session.query(history.c.history_id).first():
+        return
+
+    LOG.info("Filling history table.")
+
+    session.connection().execute("""
+insert into history (
+  type, entity_id, entity_v_id, parent_id, a_time, existence_v, name,
+  moderation_user_id)
+select * from (
+  select "organisation" as type, org_id as entity_id, org_v_id as entity_v_id, null as parent_id, a_time, existence as existence_v, name, moderation_user_id from org_v
+  union all
+  select "event", event_id, event_v_id, null, a_time, existence, name, moderation_user_id from event_v
+  union all
+  select "address", address_id, address_v_id, null, a_time, existence, postal, moderation_user_id from address_v
+  union all
+  select "contact", contact_id, contact_v_id, null, a_time, existence, text, moderation_user_id from contact_v
+  union all
+  select "organisation-tag", orgtag_id, orgtag_v_id, null, a_time, existence, name, moderation_user_id from orgtag_v
+  union all
+  select "organisation-tag", orgtag_id, -1, org_id, org_orgtag.a_time, null, orgtag.name, null from org_orgtag join orgtag using (orgtag_id)
+  union all
+  select "event-tag", eventtag_id, eventtag_v_id, null, a_time, existence, name, moderation_user_id from eventtag_v
+  union all
+  select "event-tag", eventtag_id, -1, event_id, event_eventtag.a_time, null, eventtag.name, null from event_eventtag join eventtag using (eventtag_id)
+  union all
+  select "note", note_id, note_v_id, null, a_time, existence, text, moderation_user_id from note_v
+  ) as T
+order by a_time
+""")
+    session.commit()
+
+
+
+def history_cursor(item):
+    """
+    Return a pagination cursor for a history item.
+    """
+    return "%r:%d" % (item["date"], item["history_id"])
+
+
+
+def parse_history_cursor(text):
+    """
+    Return `(a_time, history_id)` from a pagination cursor.
+    Raises `ValueError` if `text` is malformed.
+    """
+    a_time, history_id = text.split(":")
+    return float(a_time), int(history_id)
+
+
+
+def get_history(session, user_id=None, limit=20, before=None, after=None):
+    """
+    Return a page of the revision history, newest first.
+
+    `before` and `after` are `(a_time, history_id)` tuples from
+    `parse_history_cursor`, so pages are found with an index range
+    instead of an offset.
+    """
+
     if limit is None:
         limit = 20
 
-    if user_id:
-        user_sql_1 = ""
-        user_sql_2 = """
-where user.user_id = %d
-""" % user_id
-    else:
-        user_sql_1 = """
-, user_id, user.name as user_name, auth.gravatar_hash
-"""
-        user_sql_2 = ""
-
-    core_sql = """
-from
-  (
-  select "organisation" as type, org_v.org_id as entity_id, org_v_id as entity_v_id, org_v.a_time, org.org_id and 1 as existence, existence as existence_v, org_v.name as name, null as parent_id, null as parent_existence, null as parent_name, org_v.moderation_user_id from org_v left outer join org using (org_id)
-  union
-  select "event" as type, event_v.event_id as entity_id, event_v_id as entity_v_id, event_v.a_time, event.event_id and 1 as existence, existence as existence_v, event_v.name as name, null as parent_id, null as parent_existence, null as parent_name, event_v.moderation_user_id from event_v left outer join event using (event_id)
-  union
-  select
-      "address" as type,
-      address_v.address_id as entity_id,
-      address_v_id as entity_v_id,
-      address_v.a_time,
-      address.address_id and 1 as existence,
-      existence as existence_v,
-      address_v.postal as name,
-      org.org_id as parent_id,
-      org.org_id and 1 as parent_existence,
-      org.name as parent_name,
-      address_v.moderation_user_id
-    from address_v
-    left outer join address using (address_id)
-    left outer join org_address on (address.address_id = org_address.address_id)
-    left outer join org on (org_address.org_id = org.org_id)
-  union
-  select
-      "contact" as type,
-      contact_v.contact_id as entity_id,
-      contact_v_id as entity_v_id,
-      contact_v.a_time,
-      contact.contact_id and 1 as existence,
-      existence as existence_v,
-      contact_v.text as name,
-      org.org_id as parent_id,
-      org.org_id and 1 as parent_existence,
-      org.name as parent_name,
-      contact_v.moderation_user_id
-    from contact_v
-    left outer join contact using (contact_id)
-    left outer join org_contact on (contact.contact_id = org_contact.contact_id)
-    left outer join org on (org_contact.org_id = org.org_id)
-  union
-  select "organisation-tag" as type, orgtag_v.orgtag_id as entity_id, orgtag_v_id as entity_v_id, orgtag_v.a_time, orgtag.orgtag_id and 1 as existence, existence as existence_v, orgtag_v.name as name, null as parent_id, null as parent_existence, null as parent_name, orgtag_v.moderation_user_id from orgtag_v left outer join orgtag using (orgtag_id)
-  union
-  select
-      "organisation-tag" as type,
-      orgtag.orgtag_id as entity_id,
-      -1 as entity_v_id,
-      org_orgtag.a_time,
-      orgtag.orgtag_id and 1 as existence,
-      null as existence_v,
-      orgtag.name as name,
-      org.org_id as parent_id,
-      org.org_id and 1 as parent_existence,
-      org.name as parent_name,
-      null as moderation_user_id
-    from org_orgtag
-    left outer join orgtag using (orgtag_id)
-    left outer join org using (org_id)
-  union
-  select "event-tag" as type, eventtag_v.eventtag_id as entity_id, eventtag_v_id as entity_v_id, eventtag_v.a_time, eventtag.eventtag_id and 1 as existence, existence as existence_v, eventtag_v.name as name, null as parent_id, null as parent_existence, null as parent_name, eventtag_v.moderation_user_id from eventtag_v left outer join eventtag using (eventtag_id)
-  union
-  select
-      "event-tag" as type,
-      eventtag.eventtag_id as entity_id,
-      -1 as entity_v_id,
-      event_eventtag.a_time,
-      eventtag.eventtag_id and 1 as existence,
-      null as existence_v,
-      eventtag.name as name,
-      event.event_id as parent_id,
-      event.event_id and 1 as parent_existence,
-      event.name as parent_name,
-      null as moderation_user_id
-    from event_eventtag
-    left outer join eventtag using (eventtag_id)
-    left outer join event using (event_id)
-  union
-  select
-      "note" as type,
-      note_v.note_id as entity_id,
-      note_v_id as entity_v_id,
-      note_v.a_time,
-      note.note_id and 1 as existence,
-      existence as existence_v,
-      note_v.text as name,
-      org.org_id as parent_id,
-      org.org_id and 1 as parent_existence,
-      org.name as parent_name,
-      note_v.moderation_user_id
-    from note_v
-    left outer join note using (note_id)
-    left outer join org_note on (note.note_id = org_note.note_id)
-    left outer join org on (org_note.org_id = org.org_id)
-  ) as T
-left outer join user on (moderation_user_id = user_id)
-left outer join auth using (auth_id)
-%s
-""" % (
-    user_sql_2,
-)
+    history_sql = "select * from history"
+    order = "desc"
+    params = {
+        "limit": limit,
+    }
 
-    count_sql = """select count(*)
-%s
-""" % (
-    core_sql,
-)
+    where_list = []
+    if user_id:
+        where_list.append("moderation_user_id = :user_id")
+        params["user_id"] = user_id
+    if before or after:
+        operator = before and "<" or ">"
+        where_list.append(
+            "(a_time %s :a_time or "
+            "(a_time = :a_time and history_id %s :history_id))" % (
+                operator, operator))
+        params["a_time"], params["history_id"] = before or after
+        if after:
+            order = "asc"
+    if where_list:
+        history_sql += "\nwhere " + " and ".join(where_list)
 
     data_sql = """
 select
-  type,
-  entity_id,
-  entity_v_id,
-  existence,
-  existence_v,
-  parent_id,
-  parent_existence,
-  parent_name,
-  a_time as date,
-  T.name%s
+  T.history_id,
+  T.type,
+  T.entity_id,
+  T.entity_v_id,
+  coalesce(
+    org.org_id, event.event_id, address.address_id, contact.contact_id,
+    orgtag.orgtag_id, eventtag.eventtag_id, note.note_id
+  ) is not null as existence,
+  T.existence_v,
+  coalesce(parent_org.org_id, parent_event.event_id) as parent_id,
+  coalesce(parent_org.org_id, parent_event.event_id) is not null
+    as parent_existence,
+  coalesce(parent_org.name, parent_event.name) as parent_name,
+  T.a_time as date,
+  T.name,
+  T.moderation_user_id as user_id,
+  user.name as user_name,
+  auth.gravatar_hash
+from
+  (
   %s
-order by a_time desc
-limit %d
-offset %d
+  order by a_time %s, history_id %s
+  limit :limit
+  ) as T
+left outer join org on (T.type = "organisation" and org.org_id = T.entity_id)
+left outer join event on (T.type = "event" and event.event_id = T.entity_id)
+left outer join address on (T.type = "address" and address.address_id = T.entity_id)
+left outer join contact on (T.type = "contact" and contact.contact_id = T.entity_id)
+left outer join orgtag on (T.type = "organisation-tag" and orgtag.orgtag_id = T.entity_id)
+left outer join eventtag on (T.type = "event-tag" and eventtag.eventtag_id = T.entity_id)
+left outer join note on (T.type = "note" and note.note_id = T.entity_id)
+left outer join org_address on (address.address_id = org_address.address_id)
+left outer join org_contact on (contact.contact_id = org_contact.contact_id)
+left outer join org_note on (note.note_id = org_note.note_id)
+left outer join org as parent_org on (parent_org.org_id = case T.type
+  when "organisation-tag" then T.parent_id
+  when "address" then org_address.org_id
+  when "contact" then org_contact.org_id
+  when "note" then org_note.org_id
+  end)
+left outer join event as parent_event on (T.type = "event-tag" and parent_event.event_id = T.parent_id)
+left outer join user on (T.moderation_user_id = user.user_id)
+left outer join auth using (auth_id)
+order by T.a_time desc, T.history_id desc
 """ % (
-    user_sql_1,
-    core_sql,
-    limit,
-    offset
+    history_sql,
+    order,
+    order,
 )
 
-    for row in session.connection().execute(count_sql):
-        count = row[0]
-
-    results = session.connection().execute(data_sql)
-
-    history = {
-        "offset": offset,
+    history_page = {
         "limit": limit,
-        "count": count,
-        "items": []
+        "count": count_history(session, user_id),
+        "newer": None,
+        "older": None,
+        "items": [],
     }
+
+    results = session.connection().execute(text(data_sql), params)
     for row in results:
         row_dict = {}
         for column in list(row.keys()):
             row_dict[column] = getattr(row, column)
         if not user_id and not row_dict.get("gravatar_hash", None):
             row_dict["gravatar_hash"] = gravatar_hash(str(row.user_id))
-        history["items"].append(row_dict)
-    return history
+        history_page["items"].append(row_dict)
+
+    if history_page["items"]:
+        newer = history_cursor(history_page["items"][0])
+        older = history_cursor(history_page["items"][-1])
+        if _history_exists(session, user_id, ">", newer):
+            history_page["newer"] = newer
+        if _history_exists(session, user_id, "<", older):
+            history_page["older"] = older
+
+    return history_page
+
+
+
+def _history_exists(session, user_id, operator, cursor):
+    a_time, history_id = parse_history_cursor(cursor)
+    query = session.query(history.c.history_id) \
+        .filter(or_(
+            history.c.a_time.op(operator)(a_time),
+            and_(
+                history.c.a_time == a_time,
+                history.c.history_id.op(operator)(history_id),
+            )))
+    if user_id:
+        query = query.filter(history.c.moderation_user_id == user_id)
+    return query.first() is not None
+
+
+
+def count_history(session, user_id=None):
+    """
+    Return the number of history items, approximate if `user_id` is not
+    given.
+    """
+    if user_id:
+        return session.query(func.count(history.c.history_id)) \
+            .filter(history.c.moderation_user_id == user_id) \
+            .scalar()
+
+    # The feed is append-only, so the highest ID is the count less any
+    # IDs skipped by rolled back transactions. Unlike `count(*)`, it
+    # doesn't need to scan the table.
+    return session.query(func.max(history.c.history_id)).scalar() or 0
 
 
 
@@ -300,6 +372,7 @@ def accept_address_org_v(orm, address_id):
         "a_time": 0,
     }]
     orm.connection().engine.execute(org_address.insert(), *items)
+    add_cache_tags(orm, ["address", "org"])
     orm.commit()
     return True
 
@@ -341,6 +414,7 @@ def accept_address_event_v(orm, address_id):
         "a_time": 0,
     }]
     orm.connection().execute(event_address.insert(), *items)
+    add_cache_tags(orm, ["address", "event"])
     orm.commit()
     return True
 
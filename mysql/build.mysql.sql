@@ -278,3 +278,33 @@ CREATE TABLE event_contact_v (
     KEY contact_id (contact_id)
 ) DEFAULT CHARSET=utf8 COLLATE=utf8_bin;
 
+
+
+-- Moderation
+
+CREATE TABLE moderation_pending (
+    entity_type VARCHAR(16) NOT NULL,
+    entity_id INTEGER NOT NULL,
+    entity_v_id INTEGER NOT NULL,
+    PRIMARY KEY (entity_type, entity_id)
+) DEFAULT CHARSET=utf8 COLLATE=utf8_bin;
+
+
+
+-- History
+
+-- Append-only feed of revisions, newest last.
+
+CREATE TABLE history (
+    history_id INTEGER NOT NULL PRIMARY KEY AUTO_INCREMENT, --
+    type VARCHAR(16) NOT NULL,
+    entity_id INTEGER NOT NULL,
+    entity_v_id INTEGER NOT NULL,
+    parent_id INTEGER,
+    a_time DOUBLE NOT NULL,
+    existence_v BOOLEAN,
+    name LONGTEXT,
+    moderation_user_id INTEGER,
+    KEY a_time (a_time, history_id),
+    KEY moderation_user_id (moderation_user_id, a_time, history_id)
+) DEFAULT CHARSET=utf8 COLLATE=utf8_bin;
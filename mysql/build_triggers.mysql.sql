@@ -55,6 +55,17 @@ for each row begin
 	new.moderation_user_id, 0, new.public, 1,
 	new.name, new.description, new.end_date
 	);
+
+    if not (old.public <=> new.public) then
+	update tag_count
+	  join org_orgtag on org_orgtag.orgtag_id = tag_count.tag_id
+	  set
+	    public_count = public_count - (old.public <=> 1) + (new.public <=> 1),
+	    pending_count = pending_count - (old.public is null) + (new.public is null),
+	    private_count = private_count - (old.public <=> 0) + (new.public <=> 0)
+	  where tag_count.tag_type = "orgtag"
+	  and org_orgtag.org_id = new.org_id;
+    end if;
 end $$
 
 create trigger org_delete_before before delete on org
@@ -179,6 +190,17 @@ for each row begin
 	new.name, new.start_date, new.end_date,
         new.description, new.start_time, new.end_time
 	);
+
+    if not (old.public <=> new.public) then
+	update tag_count
+	  join event_eventtag on event_eventtag.eventtag_id = tag_count.tag_id
+	  set
+	    public_count = public_count - (old.public <=> 1) + (new.public <=> 1),
+	    pending_count = pending_count - (old.public is null) + (new.public is null),
+	    private_count = private_count - (old.public <=> 0) + (new.public <=> 0)
+	  where tag_count.tag_type = "eventtag"
+	  and event_eventtag.event_id = new.event_id;
+    end if;
 end $$
 
 create trigger event_delete_before before delete on event
@@ -380,6 +402,9 @@ for each row begin
 	old.moderation_user_id, 0, old.public, 0,
 	old.name, old.name_short, old.base, old.base_short, old.path, old.path_short, description, is_virtual
 	);
+
+    delete from tag_count
+      where tag_type = "orgtag" and tag_id = old.orgtag_id;
 end $$
 
 -- eventtag
@@ -435,6 +460,9 @@ for each row begin
 	old.moderation_user_id, 0, old.public, 0,
 	old.name, old.name_short, old.base, old.base_short, old.path, old.path_short, description, is_virtual
 	);
+
+    delete from tag_count
+      where tag_type = "eventtag" and tag_id = old.eventtag_id;
 end $$
 
 -- contact
@@ -587,6 +615,24 @@ for each row begin
     insert into org_orgtag_v (org_id, orgtag_id, a_time, existence)
       values (
 	new.org_id, new.orgtag_id, 0, 1);
+
+    insert into history (
+	type, entity_id, entity_v_id, parent_id, a_time, name)
+      select "organisation-tag", new.orgtag_id, -1, new.org_id,
+	  new.a_time, orgtag.name
+	from orgtag
+	where orgtag.orgtag_id = new.orgtag_id;
+
+    insert into tag_count (
+	tag_type, tag_id, public_count, pending_count, private_count)
+      select "orgtag", new.orgtag_id,
+	  org.public <=> 1, org.public is null, org.public <=> 0
+	from org
+	where org.org_id = new.org_id
+      on duplicate key update
+	public_count = public_count + values(public_count),
+	pending_count = pending_count + values(pending_count),
+	private_count = private_count + values(private_count);
 end $$
 
 create trigger org_orgtag_update_before before update on org_orgtag
@@ -596,6 +642,26 @@ for each row begin
     insert into org_orgtag_v (org_id, orgtag_id, a_time, existence)
       values (
 	new.org_id, new.orgtag_id, 0, 1);
+
+    update tag_count
+      join org on org.org_id = old.org_id
+      set
+	public_count = public_count - (org.public <=> 1),
+	pending_count = pending_count - (org.public is null),
+	private_count = private_count - (org.public <=> 0)
+      where tag_count.tag_type = "orgtag"
+      and tag_count.tag_id = old.orgtag_id;
+
+    insert into tag_count (
+	tag_type, tag_id, public_count, pending_count, private_count)
+      select "orgtag", new.orgtag_id,
+	  org.public <=> 1, org.public is null, org.public <=> 0
+	from org
+	where org.org_id = new.org_id
+      on duplicate key update
+	public_count = public_count + values(public_count),
+	pending_count = pending_count + values(pending_count),
+	private_count = private_count + values(private_count);
 end $$
 
 create trigger org_orgtag_delete_before before delete on org_orgtag
@@ -603,6 +669,15 @@ for each row begin
     insert into org_orgtag_v (org_id, orgtag_id, a_time, existence)
       values (
 	old.org_id, old.orgtag_id, 0, 0);
+
+    update tag_count
+      join org on org.org_id = old.org_id
+      set
+	public_count = public_count - (org.public <=> 1),
+	pending_count = pending_count - (org.public is null),
+	private_count = private_count - (org.public <=> 0)
+      where tag_count.tag_type = "orgtag"
+      and tag_count.tag_id = old.orgtag_id;
 end $$
 
 -- orgtag_note
@@ -727,6 +802,24 @@ for each row begin
     insert into event_eventtag_v (event_id, eventtag_id, a_time, existence)
       values (
 	new.event_id, new.eventtag_id, 0, 1);
+
+    insert into history (
+	type, entity_id, entity_v_id, parent_id, a_time, name)
+      select "event-tag", new.eventtag_id, -1, new.event_id,
+	  new.a_time, eventtag.name
+	from eventtag
+	where eventtag.eventtag_id = new.eventtag_id;
+
+    insert into tag_count (
+	tag_type, tag_id, public_count, pending_count, private_count)
+      select "eventtag", new.eventtag_id,
+	  event.public <=> 1, event.public is null, event.public <=> 0
+	from event
+	where event.event_id = new.event_id
+      on duplicate key update
+	public_count = public_count + values(public_count),
+	pending_count = pending_count + values(pending_count),
+	private_count = private_count + values(private_count);
 end $$
 
 create trigger event_eventtag_update_before before update on event_eventtag
@@ -736,6 +829,26 @@ for each row begin
     insert into event_eventtag_v (event_id, eventtag_id, a_time, existence)
       values (
 	new.event_id, new.eventtag_id, 0, 1);
+
+    update tag_count
+      join event on event.event_id = old.event_id
+      set
+	public_count = public_count - (event.public <=> 1),
+	pending_count = pending_count - (event.public is null),
+	private_count = private_count - (event.public <=> 0)
+      where tag_count.tag_type = "eventtag"
+      and tag_count.tag_id = old.eventtag_id;
+
+    insert into tag_count (
+	tag_type, tag_id, public_count, pending_count, private_count)
+      select "eventtag", new.eventtag_id,
+	  event.public <=> 1, event.public is null, event.public <=> 0
+	from event
+	where event.event_id = new.event_id
+      on duplicate key update
+	public_count = public_count + values(public_count),
+	pending_count = pending_count + values(pending_count),
+	private_count = private_count + values(private_count);
 end $$
 
 create trigger event_eventtag_delete_before before delete on event_eventtag
@@ -743,6 +856,15 @@ for each row begin
     insert into event_eventtag_v (event_id, eventtag_id, a_time, existence)
       values (
 	old.event_id, old.eventtag_id, 0, 0);
+
+    update tag_count
+      join event on event.event_id = old.event_id
+      set
+	public_count = public_count - (event.public <=> 1),
+	pending_count = pending_count - (event.public is null),
+	private_count = private_count - (event.public <=> 0)
+      where tag_count.tag_type = "eventtag"
+      and tag_count.tag_id = old.eventtag_id;
 end $$
 
 -- eventtag_note
@@ -922,5 +1044,171 @@ for each row begin
 end $$
 
 
-delimiter ;
 
+-- moderation_pending
+
+-- Entities whose latest revision is by a non-moderator.
+
+create trigger org_v_insert_after after insert on org_v
+for each row begin
+    insert into history (
+	type, entity_id, entity_v_id, a_time, existence_v, name,
+	moderation_user_id)
+      values (
+	"organisation", new.org_id, new.org_v_id, new.a_time, new.existence,
+	new.name, new.moderation_user_id);
+
+    delete from moderation_pending
+      where entity_type = "org" and entity_id = new.org_id;
+    insert into moderation_pending (entity_type, entity_id, entity_v_id)
+      select "org", new.org_id, new.org_v_id
+	from user
+	where user.user_id = new.moderation_user_id
+	and user.moderator = 0;
+end $$
+
+create trigger org_v_delete_after after delete on org_v
+for each row begin
+    delete from moderation_pending
+      where entity_type = "org" and entity_id = old.org_id;
+    insert into moderation_pending (entity_type, entity_id, entity_v_id)
+      select "org", org_v.org_id, org_v.org_v_id
+	from org_v
+	join user on user.user_id = org_v.moderation_user_id
+	where org_v.org_v_id = (
+	  select max(org_v_id) from org_v where org_id = old.org_id)
+	and user.moderator = 0;
+end $$
+
+create trigger event_v_insert_after after insert on event_v
+for each row begin
+    insert into history (
+	type, entity_id, entity_v_id, a_time, existence_v, name,
+	moderation_user_id)
+      values (
+	"event", new.event_id, new.event_v_id, new.a_time, new.existence,
+	new.name, new.moderation_user_id);
+
+    delete from moderation_pending
+      where entity_type = "event" and entity_id = new.event_id;
+    insert into moderation_pending (entity_type, entity_id, entity_v_id)
+      select "event", new.event_id, new.event_v_id
+	from user
+	where user.user_id = new.moderation_user_id
+	and user.moderator = 0;
+end $$
+
+create trigger event_v_delete_after after delete on event_v
+for each row begin
+    delete from moderation_pending
+      where entity_type = "event" and entity_id = old.event_id;
+    insert into moderation_pending (entity_type, entity_id, entity_v_id)
+      select "event", event_v.event_id, event_v.event_v_id
+	from event_v
+	join user on user.user_id = event_v.moderation_user_id
+	where event_v.event_v_id = (
+	  select max(event_v_id) from event_v where event_id = old.event_id)
+	and user.moderator = 0;
+end $$
+
+create trigger address_v_insert_after after insert on address_v
+for each row begin
+    insert into history (
+	type, entity_id, entity_v_id, a_time, existence_v, name,
+	moderation_user_id)
+      values (
+	"address", new.address_id, new.address_v_id, new.a_time, new.existence,
+	new.postal, new.moderation_user_id);
+
+    delete from moderation_pending
+      where entity_type = "address" and entity_id = new.address_id;
+    insert into moderation_pending (entity_type, entity_id, entity_v_id)
+      select "address", new.address_id, new.address_v_id
+	from user
+	where user.user_id = new.moderation_user_id
+	and user.moderator = 0;
+end $$
+
+create trigger address_v_delete_after after delete on address_v
+for each row begin
+    delete from moderation_pending
+      where entity_type = "address" and entity_id = old.address_id;
+    insert into moderation_pending (entity_type, entity_id, entity_v_id)
+      select "address", address_v.address_id, address_v.address_v_id
+	from address_v
+	join user on user.user_id = address_v.moderation_user_id
+	where address_v.address_v_id = (
+	  select max(address_v_id) from address_v where address_id = old.address_id)
+	and user.moderator = 0;
+end $$
+
+create trigger contact_v_insert_after after insert on contact_v
+for each row begin
+    insert into history (
+	type, entity_id, entity_v_id, a_time, existence_v, name,
+	moderation_user_id)
+      values (
+	"contact", new.contact_id, new.contact_v_id, new.a_time, new.existence,
+	new.text, new.moderation_user_id);
+
+    delete from moderation_pending
+      where entity_type = "contact" and entity_id = new.contact_id;
+    insert into moderation_pending (entity_type, entity_id, entity_v_id)
+      select "contact", new.contact_id, new.contact_v_id
+	from user
+	where user.user_id = new.moderation_user_id
+	and user.moderator = 0;
+end $$
+
+create trigger contact_v_delete_after after delete on contact_v
+for each row begin
+    delete from moderation_pending
+      where entity_type = "contact" and entity_id = old.contact_id;
+    insert into moderation_pending (entity_type, entity_id, entity_v_id)
+      select "contact", contact_v.contact_id, contact_v.contact_v_id
+	from contact_v
+	join user on user.user_id = contact_v.moderation_user_id
+	where contact_v.contact_v_id = (
+	  select max(contact_v_id) from contact_v where contact_id = old.contact_id)
+	and user.moderator = 0;
+end $$
+
+
+-- history
+
+-- Append-only feed of revisions. Triggers on `org_v`, `event_v`,
+-- `address_v`, `contact_v`, `org_orgtag` and `event_eventtag` also
+-- insert into it.
+
+create trigger orgtag_v_insert_after after insert on orgtag_v
+for each row begin
+    insert into history (
+	type, entity_id, entity_v_id, a_time, existence_v, name,
+	moderation_user_id)
+      values (
+	"organisation-tag", new.orgtag_id, new.orgtag_v_id, new.a_time, new.existence,
+	new.name, new.moderation_user_id);
+end $$
+
+create trigger eventtag_v_insert_after after insert on eventtag_v
+for each row begin
+    insert into history (
+	type, entity_id, entity_v_id, a_time, existence_v, name,
+	moderation_user_id)
+      values (
+	"event-tag", new.eventtag_id, new.eventtag_v_id, new.a_time, new.existence,
+	new.name, new.moderation_user_id);
+end $$
+
+create trigger note_v_insert_after after insert on note_v
+for each row begin
+    insert into history (
+	type, entity_id, entity_v_id, a_time, existence_v, name,
+	moderation_user_id)
+      values (
+	"note", new.note_id, new.note_v_id, new.a_time, new.existence,
+	new.text, new.moderation_user_id);
+end $$
+
+
+delimiter ;
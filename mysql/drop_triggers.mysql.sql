@@ -84,3 +84,14 @@ drop trigger if exists org_event_v_insert_before;
 drop trigger if exists org_event_insert_after;
 drop trigger if exists org_event_update_before;
 drop trigger if exists org_event_delete_before;
+drop trigger if exists org_v_insert_after;
+drop trigger if exists org_v_delete_after;
+drop trigger if exists event_v_insert_after;
+drop trigger if exists event_v_delete_after;
+drop trigger if exists address_v_insert_after;
+drop trigger if exists address_v_delete_after;
+drop trigger if exists contact_v_insert_after;
+drop trigger if exists contact_v_delete_after;
+drop trigger if exists orgtag_v_insert_after;
+drop trigger if exists eventtag_v_insert_after;
+drop trigger if exists note_v_insert_after;
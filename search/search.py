@@ -3,19 +3,27 @@
 import os
 import sys
 import json
+import time
+import atexit
+import hashlib
 import inspect
 import logging
 import argparse
+import threading
+from collections import OrderedDict
 
 import pyelasticsearch
 
 
 
 log = logging.getLogger('search')
+# Index operations that could not be sent, one JSON object per line.
+dead_letter_log = logging.getLogger('search.dead_letter')
 setting_path = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 es_path = "http://localhost:9200/"
 es_index = "mango"
 es_doc_type = "org"
+bucket_size = 1000  # Org IDs per verification bucket
 
 logging.getLogger('elasticsearch.trace').setLevel(logging.WARNING)
 
@@ -37,41 +45,198 @@ def count_org(search):
 
 
 
-def verify_org(es, orm, Org, Orgalias):
-    len_alias_orm = orm.query(Org).count()
-    len_alias_es = count_org(es)
-    return len_alias_orm == len_alias_es
+def name_search_query(name, public=True, offset=0, size=10):
+    """
+    Orgs whose name or public aliases match `name`, whole words ranked
+    above fuzzy matches, and equal scores in order of org ID so that
+    pages don't overlap.
+    """
+    query = {
+        "multi_match": {
+            "fields": [
+                "alias_public.straight^3",
+                "alias_public.fuzzy",
+                ],
+            "query": name
+            }
+        }
+    if public:
+        query = {
+            "filtered": {
+                "filter": {
+                    "term": {
+                        "public": 1
+                        }
+                    },
+                "query": query
+                }
+            }
+    return {
+        "query": query,
+        "sort": ["_score", {"org_id": {"order": "asc"}}],
+        "track_scores": True,
+        "from": offset,
+        "size": size,
+        }
+
+
+
+def search_org_names(es, name, public=True, offset=0, size=10,
+                     index=es_index):
+    "Returns the hits of `name_search_query`."
+    results = es.search(
+        name_search_query(name, public, offset, size),
+        index=index, doc_type=es_doc_type)
+    return results["hits"]["hits"]
 
 
 
 def verify(es, orm, Org, Orgalias):
     print("Verifying Elasticsearch")
     try:
-        if verify_org(es, orm, Org, Orgalias):
-            return
+        reindexed, deleted = verify_buckets(es, orm, Org, Orgalias)
     except pyelasticsearch.exceptions.ElasticHttpError:
-        pass
+        print("Rebuilding Elasticsearch")
+        rebuild(es, orm, Org, Orgalias)
+        return
+
+    if reindexed or deleted:
+        print("Reindexed %d and deleted %d orgs in Elasticsearch" % (
+            reindexed, deleted))
+
 
-    print("Rebuilding Elasticsearch")
-    rebuild(es, orm, Org, Orgalias)
+
+def make_org_doc(org_id, name, public, alias_list):
+    "`alias_list` is a list of `(name, public)` pairs."
+    return {
+        "org_id": org_id,
+        "name": name,
+        "public": public,
+        "alias_public": [name] + [
+            alias for alias, alias_public in alias_list if alias_public],
+        "alias_all": [name] + [alias for alias, _public in alias_list],
+        }
 
 
 
 def org_doc(org):
-    alias_public_list = [
-        orgalias.name for orgalias in org.orgalias_list_public]
-    alias_all_list = [
-        orgalias.name for orgalias in org.orgalias_list]
+    return make_org_doc(org.org_id, org.name, org.public, [
+        (orgalias.name, orgalias.public) for orgalias in org.orgalias_list])
+
+
+
+def org_docs(orm, Org, Orgalias, start, end):
+    """
+    Returns an ordered dictionary of org ID to document for orgs with
+    IDs from `start` up to `end`, loading their aliases in one query.
+    """
+    alias_dict = {}
+    alias_query = orm.query(Orgalias.org_id, Orgalias.name, Orgalias.public) \
+        .filter(Orgalias.org_id >= start, Orgalias.org_id < end) \
+        .order_by(Orgalias.orgalias_id)
+    for org_id, name, public in alias_query:
+        alias_dict.setdefault(org_id, []).append((name, public))
+
+    docs = OrderedDict()
+    org_query = orm.query(Org.org_id, Org.name, Org.public) \
+        .filter(Org.org_id >= start, Org.org_id < end) \
+        .order_by(Org.org_id)
+    for org_id, name, public in org_query:
+        docs[org_id] = make_org_doc(
+            org_id, name, public, alias_dict.get(org_id, []))
+    return docs
+
+
+
+def indexed_docs(es, start, end, index=es_index):
+    "Like `org_docs`, but for the documents in the index."
+    results = es.search({
+        "query": {
+            "range": {
+                "org_id": {
+                    "gte": start,
+                    "lt": end,
+                    }
+                }
+            },
+        "size": end - start,
+        }, index=index, doc_type=es_doc_type)
     return {
-        "org_id": org.org_id,
-        "name": org.name,
-        "public": org.public,
-        "alias_public": [org.name] + alias_public_list,
-        "alias_all": [org.name] + alias_all_list,
+        hit["_source"]["org_id"]: hit["_source"]
+        for hit in results["hits"]["hits"]
         }
 
 
 
+def doc_hash(doc):
+    "Hash of the content of a document, ignoring the order of aliases."
+    doc = dict(doc)
+    for key in ("alias_public", "alias_all"):
+        doc[key] = doc[key][:1] + sorted(doc[key][1:])
+    return hashlib.sha1(
+        json.dumps(doc, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+
+def max_org_id(orm, Org):
+    return orm.query(Org.org_id) \
+        .order_by(Org.org_id.desc()) \
+        .limit(1) \
+        .scalar() or 0
+
+
+
+def max_indexed_org_id(es, index=es_index):
+    results = es.search({
+        "size": 1,
+        "sort": [{"org_id": "desc"}],
+        }, index=index, doc_type=es_doc_type)
+    for hit in results["hits"]["hits"]:
+        return hit["_source"]["org_id"]
+    return 0
+
+
+
+def verify_buckets(es, orm, Org, Orgalias, index=es_index):
+    """
+    Compare hashes of the documents in each bucket of org IDs in the
+    database and the index, and send only the orgs that differ.
+
+    Returns the numbers of orgs reindexed and deleted.
+    """
+    reindexed = 0
+    deleted = 0
+
+    end_id = max(max_org_id(orm, Org), max_indexed_org_id(es, index))
+    for start in range(0, end_id + 1, bucket_size):
+        end = start + bucket_size
+        docs = org_docs(orm, Org, Orgalias, start, end)
+        db_hashes = {
+            org_id: doc_hash(doc) for org_id, doc in docs.items()}
+        es_hashes = {
+            org_id: doc_hash(doc)
+            for org_id, doc in indexed_docs(es, start, end, index).items()
+            }
+        if db_hashes == es_hashes:
+            continue
+
+        actions = []
+        for org_id, doc in docs.items():
+            if db_hashes[org_id] != es_hashes.get(org_id, None):
+                actions.append(es.index_op(doc, id=org_id))
+                reindexed += 1
+        for org_id in es_hashes:
+            if org_id not in db_hashes:
+                actions.append(es.delete_op(id=org_id))
+                deleted += 1
+        log.info("Org IDs %d to %d differ in %d documents.",
+                 start, end - 1, len(actions))
+        es.bulk(actions, doc_type=es_doc_type, index=index)
+
+    return reindexed, deleted
+
+
+
 def index_org(es, org):
     es.index(
         es_index,
@@ -82,42 +247,242 @@ def index_org(es, org):
 
 
 
-def index_orgalias(es, orgalias, orm, Orgalias):
-    index_org(es, orgalias.org)
+def delete_org(es, org):
+    es.delete(es_index, es_doc_type, id=org.org_id)
+
 
 
+SEND_ERRORS = (
+    pyelasticsearch.exceptions.ConnectionError,
+    pyelasticsearch.exceptions.Timeout,
+    pyelasticsearch.exceptions.ElasticHttpError,
+    pyelasticsearch.exceptions.InvalidJsonResponseError,
+)
+
+
+
+class IndexQueue(object):
+    """
+    Sends org index and delete operations to Elasticsearch in `_bulk`
+    batches from a background thread.
+
+    Operations are queued by org ID, so an org changed several times
+    before its batch is sent is only indexed once. Documents are built
+    when the batch is sent, with a session from `session_factory`, and
+    `query_orgs(orm, org_id_list)` to load the orgs.
+
+    Batches that still fail after `attempts` tries are written to
+    `dead_letter_log`.
+    """
+
+    INDEX = "index"
+    DELETE = "delete"
+
+    def __init__(self, es, session_factory, query_orgs,
+                 batch_size=500, attempts=3, retry_wait=1):
+        self.es = es
+        self.session_factory = session_factory
+        self.query_orgs = query_orgs
+        self.batch_size = batch_size
+        self.attempts = attempts
+        self.retry_wait = retry_wait
+
+        self.pending = OrderedDict()
+        self.busy = False
+        self.condition = threading.Condition()
+        self.sent = 0
+        self.batches = 0
+        self.retries = 0
+        self.dead_letters = 0
+
+        thread = threading.Thread(target=self.run, name="search-index")
+        thread.daemon = True
+        thread.start()
+
+        # Send what is queued before the process exits.
+        atexit.register(self.join, 30)
+
+    def put(self, operations):
+        "Queue a dictionary of org ID to `INDEX` or `DELETE`."
+        with self.condition:
+            for org_id, operation in operations.items():
+                self.pending.pop(org_id, None)
+                self.pending[org_id] = operation
+            self.condition.notify_all()
+
+    def join(self, timeout=None):
+        "Wait until all queued operations have been sent."
+        deadline = timeout and time.time() + timeout
+        with self.condition:
+            while self.pending or self.busy:
+                wait = deadline and deadline - time.time()
+                if wait is not None and wait <= 0:
+                    return False
+                self.condition.wait(wait)
+        return True
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                batch = OrderedDict()
+                while self.pending and len(batch) < self.batch_size:
+                    org_id, operation = self.pending.popitem(last=False)
+                    batch[org_id] = operation
+                self.busy = True
+            try:
+                self.send(batch)
+            finally:
+                with self.condition:
+                    self.busy = False
+                    self.condition.notify_all()
+
+    def actions(self, batch):
+        orm = self.session_factory()
+        try:
+            index_list = [
+                org_id for org_id, operation in batch.items()
+                if operation == self.INDEX
+            ]
+            org_dict = {}
+            if index_list:
+                for org in self.query_orgs(orm, index_list):
+                    org_dict[org.org_id] = org
+
+            action_list = []
+            for org_id, operation in batch.items():
+                org = org_dict.get(org_id, None)
+                if org:
+                    action_list.append(self.es.index_op(
+                        org_doc(org), id=org_id))
+                else:
+                    # Deleted, or deleted since it was queued.
+                    action_list.append(self.es.delete_op(id=org_id))
+            return action_list
+        finally:
+            orm.close()
+
+    def send(self, batch):
+        # pylint: disable=broad-except
+        # Background thread has no caller to report errors to.
+
+        for attempt in range(self.attempts):
+            try:
+                self.es.bulk(
+                    self.actions(batch), doc_type=es_doc_type, index=es_index)
+            except pyelasticsearch.exceptions.BulkError as e:
+                failed = self.failed(batch, e.errors)
+                self.sent += len(batch) - len(failed)
+                batch = failed
+                if not batch:
+                    break
+                error = e
+            except Exception as e:
+                error = e
+            else:
+                self.sent += len(batch)
+                break
+            if attempt + 1 < self.attempts:
+                self.retries += 1
+                time.sleep(self.retry_wait * 2 ** attempt)
+        else:
+            self.dead_letter(batch, error)
+            return
 
-def delete_org(es, org):
-    es.delete(es_index, es_doc_type, id=org.org_id)
+        self.batches += 1
+
+    def failed(self, batch, error_list):
+        "Return the operations in `batch` that failed, for retrying."
+        failed = OrderedDict()
+        for item in error_list:
+            ((operation, result), ) = item.items()
+            if operation == self.DELETE and result.get("status") == 404:
+                # Already gone.
+                continue
+            org_id = int(result["_id"])
+            if org_id in batch:
+                failed[org_id] = batch[org_id]
+        return failed
+
+    def dead_letter(self, batch, error):
+        self.dead_letters += len(batch)
+        log.error(
+            "Failed to send %d index operations to Elasticsearch: %s",
+            len(batch), error)
+        for org_id, operation in batch.items():
+            dead_letter_log.error(json.dumps({
+                "time": time.time(),
+                "orgId": org_id,
+                "operation": operation,
+                "error": str(error),
+            }))
+
+    def stats(self):
+        with self.condition:
+            pending = len(self.pending)
+        return {
+            "pending": pending,
+            "sent": self.sent,
+            "batches": self.batches,
+            "retries": self.retries,
+            "deadLetters": self.dead_letters,
+        }
 
 
 
-def build_org(es, orm, Org, Orgalias):
+def build_org(es, orm, Org, Orgalias, index=es_index):
     log.warning("Bulk adding org : start")
 
     def docs():
-        for org in orm.query(Org):
-            yield es.index_op(org_doc(org), id=org.org_id)
+        for start in range(0, max_org_id(orm, Org) + 1, bucket_size):
+            for org_id, doc in org_docs(
+                    orm, Org, Orgalias, start, start + bucket_size).items():
+                yield es.index_op(doc, id=org_id)
 
     for chunk in pyelasticsearch.bulk_chunks(
             docs(), docs_per_chunk=500, bytes_per_chunk=10000):
-        es.bulk(chunk, doc_type=es_doc_type, index=es_index)
+        es.bulk(chunk, doc_type=es_doc_type, index=index)
 
     log.warning("Bulk adding org : end")
 
 
 
 def rebuild(es, orm, Org, Orgalias):
+    """
+    Build a new index, then atomically point the `es_index` alias at it
+    and delete the old one, so searches never see a partial index.
+    """
     settings_path = os.path.join(setting_path, "mango.json")
-
-    log.warning("Deleting ES index.")
-    try:
-        es.delete_index('mango')
-    except:
-        pass
-
     settings = json.load(open(settings_path))
 
-    es.create_index(es_index, settings)
+    index = "%s-%s" % (es_index, time.strftime("%Y%m%d%H%M%S"))
+    log.warning("Building ES index %s.", index)
+    es.create_index(index, settings)
+    build_org(es, orm, Org, Orgalias, index=index)
+    es.refresh(index)
 
-    build_org(es, orm, Org, Orgalias)
+    try:
+        old_index_list = list(es.get_settings(es_index))
+    except pyelasticsearch.exceptions.ElasticHttpNotFoundError:
+        old_index_list = []
+    if es_index in old_index_list:
+        # An index from before the alias was used must be deleted
+        # before the alias can take its name.
+        log.warning("Deleting ES index %s.", es_index)
+        es.delete_index(es_index)
+        old_index_list.remove(es_index)
+
+    actions = [
+        {"remove": {"index": old_index, "alias": es_index}}
+        for old_index in old_index_list
+        ]
+    actions.append({"add": {"index": index, "alias": es_index}})
+    es.update_aliases(actions)
+
+    for old_index in old_index_list:
+        log.warning("Deleting ES index %s.", old_index)
+        es.delete_index(old_index)
+
+    # Catch changes written to the old index while building.
+    verify_buckets(es, orm, Org, Orgalias)
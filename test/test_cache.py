@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+# pylint: disable=wrong-import-position,import-error
+# Allow appending to import path before import
+# Must also specify `PYTHONPATH` when invoking Pylint.
+
+import os
+import sys
+import gzip
+import time
+import logging
+import argparse
+import unittest
+from unittest import mock
+
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+import cache
+
+
+
+LOG = logging.getLogger('test_cache')
+
+
+
+class TestMemoryCache(unittest.TestCase):
+
+    def test_evict(self):
+        memory = cache.MemoryCache(10)
+        memory.set("a", 1, 4)
+        memory.set("b", 2, 4)
+        self.assertEqual(memory.get("a"), 1)
+        memory.set("c", 3, 4)
+        self.assertEqual(memory.get("b"), None)
+        self.assertEqual(memory.get("a"), 1)
+        self.assertEqual(memory.get("c"), 3)
+        self.assertEqual(memory.stats()["bytes"], 8)
+        self.assertEqual(memory.evictions, 1)
+
+    def test_too_large(self):
+        memory = cache.MemoryCache(10)
+        memory.set("a", 1, 11)
+        self.assertEqual(memory.get("a"), None)
+        self.assertEqual(memory.stats()["bytes"], 0)
+
+
+
+class TestCompress(unittest.TestCase):
+
+    def test_compress(self):
+        value = b'{"name": "Org"}' * 100
+        encoded = cache.compress(value)
+        self.assertEqual(gzip.decompress(encoded["gzip"]), value)
+        self.assertLess(len(encoded["gzip"]), len(value))
+
+        entry = cache.CacheEntry(
+            value, cache.compute_etag(value), True, encoded)
+        self.assertEqual(
+            cache.entry_size(entry),
+            len(value) + sum(len(v) for v in encoded.values()))
+
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_trip(self):
+        breaker = cache.CircuitBreaker(threshold=2, reset=30)
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertFalse(breaker.closed)
+        self.assertFalse(breaker.allow())
+
+        # Half open allows a single trial.
+        breaker.opened -= 30
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+
+        breaker.success()
+        self.assertTrue(breaker.closed)
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.trips, 1)
+
+
+
+class TestBreakerConnection(unittest.TestCase):
+
+    def test_read_response(self):
+        breaker = cache.CircuitBreaker(threshold=1, reset=30)
+        connection = cache.BreakerConnection(breaker=breaker)
+        with mock.patch.object(
+                cache.redis.Connection, "read_response",
+                side_effect=cache.redis.TimeoutError) as read_response:
+            with self.assertRaises(cache.redis.TimeoutError):
+                connection.read_response(disable_decoding=True)
+        read_response.assert_called_once_with(disable_decoding=True)
+        self.assertFalse(breaker.closed)
+
+
+
+class UnavailableRedis(object):
+    def __getattr__(self, name):
+        def unavailable(*_args, **_kwargs):
+            raise cache.redis.ConnectionError("Unavailable")
+        return unavailable
+
+
+
+class TestRedisCacheUnavailable(unittest.TestCase):
+
+    def setUp(self):
+        # pylint: disable=protected-access
+        # Replace the client with one that always fails.
+        self.cache = cache.RedisCache("test", memory=10000)
+        self.cache._cache = UnavailableRedis()
+
+    def test_strict(self):
+        self.cache.set("key", "value", tags={"tag": 1})
+        # Tags can't be checked, so only the soft TTL applies...
+        self.assertEqual(self.cache.get("key"), "value")
+        # ...unless the value mustn't outlive an invalidation.
+        self.assertIsNone(self.cache.get("key", strict=True))
+
+    def test_delete(self):
+        self.cache.set("key", "value", tags={"tag": 1})
+        self.cache.delete("key")
+        self.assertIsNone(self.cache.get("key"))
+
+    def test_tag_period(self):
+        # pylint: disable=protected-access
+        # Check the expiry of the in-process entry.
+        self.cache.set("key", "value", period=None, tags={"tag": 1})
+        _entry, expires, _tags = self.cache._memory.get("test:key")
+        self.assertLessEqual(
+            expires, time.time() + cache.TAG_VERSION_TTL)
+
+
+
+def main():
+    LOG.addHandler(logging.StreamHandler())
+
+    parser = argparse.ArgumentParser(
+        description="Unittest cache.")
+    parser.add_argument(
+        "--verbose", "-v",
+        action="count", default=0,
+        help="Print verbose information for debugging.")
+    parser.add_argument(
+        "--quiet", "-q",
+        action="count", default=0,
+        help="Suppress warnings.")
+
+    args = parser.parse_args()
+
+    level = (logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG)[
+        max(0, min(3, 1 + args.verbose - args.quiet))]
+    LOG.setLevel(level)
+
+    unittest.main()
+
+
+
+if __name__ == "__main__":
+    main()
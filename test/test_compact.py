@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+# pylint: disable=wrong-import-position,import-error
+# Allow appending to import path before import
+# Must also specify `PYTHONPATH` when invoking Pylint.
+
+import os
+import sys
+import json
+import logging
+import argparse
+import unittest
+
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+import compact
+
+
+
+LOG = logging.getLogger('test_compact')
+
+
+
+MARKER_LIST = [
+    {
+        "name": "Org A",
+        "alias": None,
+        "url": "/organisation/12",
+        "latitude": 51.50735,
+        "longitude": -0.12776,
+    },
+    {
+        "name": "Org B",
+        "alias": "B",
+        "url": "/organisation/7",
+        "latitude": 51.50741,
+        "longitude": -0.12801,
+    },
+    {
+        "name": "Org C",
+        "alias": None,
+        "url": "/organisation/9",
+        "latitude": None,
+        "longitude": None,
+    },
+]
+
+
+
+class TestCompact(unittest.TestCase):
+
+    def test_table(self):
+        table = compact.encode_table(MARKER_LIST)
+        self.assertEqual(table["ids"], {"url": "/organisation/"})
+        self.assertEqual(table["columns"]["url"], [12, 7, 9])
+        self.assertEqual(
+            table["deltas"]["latitude"], [5150735, 6, None])
+        self.assertEqual(compact.decode_table(table), MARKER_LIST)
+
+    def test_missing_key(self):
+        obj_list = [{"label": "A", "alias": ["a"]}, {"label": "B"}]
+        self.assertEqual(
+            compact.loads(compact.dumps(obj_list)),
+            [{"label": "A", "alias": ["a"]}, {"label": "B", "alias": None}])
+
+    def test_packet(self):
+        packet = {
+            "location": {"south": 51, "north": 52, "west": -1, "east": 1},
+            "markerList": MARKER_LIST,
+            "clusterList": [],
+            "hint": [],
+        }
+        self.assertEqual(compact.loads(compact.dumps(packet)), packet)
+        self.assertEqual(
+            compact.loads_binary(compact.dumps_binary(packet)), packet)
+
+    def test_binary(self):
+        obj_list = MARKER_LIST * 100
+        blob = compact.dumps_binary(obj_list)
+        self.assertEqual(compact.loads_binary(blob), obj_list)
+        self.assertLess(len(blob), len(compact.dumps(obj_list)))
+        self.assertLess(
+            len(compact.dumps(obj_list)) * 2, len(json.dumps(obj_list)))
+
+
+
+def main():
+    LOG.addHandler(logging.StreamHandler())
+
+    parser = argparse.ArgumentParser(
+        description="Unittest compact.")
+    parser.add_argument(
+        "--verbose", "-v",
+        action="count", default=0,
+        help="Print verbose information for debugging.")
+    parser.add_argument(
+        "--quiet", "-q",
+        action="count", default=0,
+        help="Suppress warnings.")
+
+    args = parser.parse_args()
+
+    level = (logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG)[
+        max(0, min(3, 1 + args.verbose - args.quiet))]
+    LOG.setLevel(level)
+
+    unittest.main()
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+# pylint: disable=wrong-import-position,import-error
+# Allow appending to import path before import
+# Must also specify `PYTHONPATH` when invoking Pylint.
+
+import os
+import sys
+import logging
+import argparse
+import unittest
+
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+import geo
+
+
+
+LOG = logging.getLogger('test_geo')
+
+
+
+class TestClusterMarkers(unittest.TestCase):
+
+    def setUp(self):
+        self.marker_list = [
+            {"name": "a", "latitude": 51.50, "longitude": -0.12},
+            {"name": "b", "latitude": 51.51, "longitude": -0.13},
+            {"name": "c", "latitude": 53.48, "longitude": -2.24},
+            {"name": "d", "latitude": None, "longitude": None},
+        ]
+
+    def test_cluster(self):
+        cluster_list, marker_list = geo.cluster_markers(self.marker_list, 6)
+        self.assertEqual(len(cluster_list), 1)
+        self.assertEqual(cluster_list[0]["count"], 2)
+        self.assertAlmostEqual(cluster_list[0]["latitude"], 51.505)
+        self.assertEqual(cluster_list[0]["south"], 51.50)
+        self.assertEqual([marker["name"] for marker in marker_list], ["c"])
+
+        # Everything is in one cell at zoom level 0.
+        cluster_list, marker_list = geo.cluster_markers(self.marker_list, 0)
+        self.assertEqual([cluster["count"] for cluster in cluster_list], [3])
+        self.assertEqual(marker_list, [])
+
+    def test_max_zoom(self):
+        cluster_list, marker_list = geo.cluster_markers(
+            self.marker_list, geo.CLUSTER_MAX_ZOOM + 1)
+        self.assertEqual(cluster_list, [])
+        self.assertEqual(len(marker_list), 3)
+
+    def test_filter(self):
+        cluster_list, marker_list = geo.cluster_markers(self.marker_list, 6)
+        packet = geo.filter_clusters({
+            "clusterList": cluster_list,
+            "markerList": marker_list,
+        }, geo.Geobox(53, 54, -3, -2))
+        self.assertEqual(packet["clusterList"], [])
+        self.assertEqual(len(packet["markerList"]), 1)
+
+        # The cluster's centroid is outside, but one of its markers isn't.
+        packet = geo.filter_clusters({
+            "clusterList": cluster_list,
+            "markerList": marker_list,
+        }, geo.Geobox(51.506, 52, -1, -0.129))
+        self.assertEqual(len(packet["clusterList"]), 1)
+        self.assertEqual(packet["markerList"], [])
+
+    def test_contains_inverse(self):
+        geobox = geo.Geobox(-20, -10, 170, -170)
+        self.assertTrue(geobox.contains(-15, 178))
+        self.assertTrue(geobox.contains(-15, -175))
+        self.assertFalse(geobox.contains(-15, 0))
+
+
+
+def main():
+    LOG.addHandler(logging.StreamHandler())
+
+    parser = argparse.ArgumentParser(
+        description="Unittest geo.")
+    parser.add_argument(
+        "--verbose", "-v",
+        action="count", default=0,
+        help="Print verbose information for debugging.")
+    parser.add_argument(
+        "--quiet", "-q",
+        action="count", default=0,
+        help="Suppress warnings.")
+
+    args = parser.parse_args()
+
+    level = (logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG)[
+        max(0, min(3, 1 + args.verbose - args.quiet))]
+    LOG.setLevel(level)
+
+    unittest.main()
+
+
+
+if __name__ == "__main__":
+    main()
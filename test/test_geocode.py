@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+# pylint: disable=wrong-import-position,import-error
+# Allow appending to import path before import
+# Must also specify `PYTHONPATH` when invoking Pylint.
+
+import os
+import sys
+import logging
+import argparse
+import unittest
+
+import geopy
+from tornado.ioloop import IOLoop
+
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+import geo
+import geocode
+
+
+
+LOG = logging.getLogger('test_geocode')
+
+
+
+class FlakyGeocoder(geo.FakeGeocoder):
+    def __init__(self, failures):
+        super(FlakyGeocoder, self).__init__()
+        self.failures = failures
+        self.calls = []
+
+    def geocode(self, address):
+        self.calls.append(address)
+        if self.failures:
+            self.failures -= 1
+            raise geo.GeocodeRetry("Over quota")
+        if "nowhere" in address.lower():
+            return None
+        if "broken" in address.lower():
+            raise RuntimeError("Unexpected response")
+        return super(FlakyGeocoder, self).geocode(address)
+
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_delay(self):
+        bucket = geocode.TokenBucket(rate=2, burst=2)
+        self.assertEqual(bucket.delay(now=100), 0)
+        self.assertEqual(bucket.delay(now=100), 0)
+        self.assertEqual(bucket.delay(now=100), 0.5)
+        self.assertEqual(bucket.delay(now=100), 1)
+        # Refills at `rate` tokens per second.
+        self.assertEqual(bucket.delay(now=102), 0)
+
+
+
+class TestBatchGeocoder(unittest.TestCase):
+
+    def setUp(self):
+        self.store = geocode.GeocodeStore(":memory:")
+
+    def tearDown(self):
+        self.store.close()
+
+    def geocode_all(self, geocoder, address_list):
+        batch = geocode.BatchGeocoder(
+            geocoder, self.store, concurrency=2, rate=1000, retry_wait=0)
+        return IOLoop.current().run_sync(
+            lambda: batch.geocode_all(address_list))
+
+    def test_store(self):
+        geocoder = FlakyGeocoder(0)
+        address_list = ["%d Street, London" % i for i in range(5)]
+        address_list.append("Nowhere")
+        results = self.geocode_all(geocoder, address_list)
+        self.assertEqual(len(results), 6)
+        self.assertIsNone(results["Nowhere"])
+        self.assertEqual(
+            results["1 Street, London"],
+            geo.FakeGeocoder().geocode("1 Street, London"))
+
+        # Stored results, including not found, are not looked up again.
+        geocoder = FlakyGeocoder(0)
+        self.assertEqual(self.geocode_all(geocoder, address_list), results)
+        self.assertEqual(geocoder.calls, [])
+
+    def test_retry(self):
+        geocoder = FlakyGeocoder(2)
+        results = self.geocode_all(geocoder, ["1 Street, London"])
+        self.assertTrue(results["1 Street, London"])
+        self.assertEqual(len(geocoder.calls), 3)
+
+        # Unresolved addresses are not stored.
+        geocoder = FlakyGeocoder(10)
+        results = self.geocode_all(geocoder, ["2 Street, London"])
+        self.assertEqual(results, {})
+        self.assertEqual(
+            self.store.get("2 Street, London"), (False, None))
+
+    def test_error(self):
+        geocoder = FlakyGeocoder(0)
+        results = self.geocode_all(
+            geocoder, ["Broken", "1 Street, London", "2 Street, London"])
+        self.assertEqual(
+            sorted(results), ["1 Street, London", "2 Street, London"])
+        self.assertEqual(self.store.get("Broken"), (False, None))
+
+
+
+class TestGoogleGeocoder(unittest.TestCase):
+
+    def test_unavailable(self):
+        class Unavailable(object):
+            def __init__(self, error):
+                self.error = error
+
+            def geocode(self, *_args, **_kwargs):
+                raise self.error
+
+        geocoder = geo.GoogleGeocoder()
+        for error in (
+                geopy.exc.GeocoderTimedOut("Timed out"),
+                geopy.exc.GeocoderUnavailable("Unavailable"),
+                geopy.exc.GeocoderQuotaExceeded("Over quota"),
+        ):
+            geocoder.geocoder = Unavailable(error)
+            with self.assertRaises(geo.GeocodeRetry):
+                geocoder.geocode("1 Street, London")
+
+        geocoder.geocoder = Unavailable(geopy.exc.GeocoderQueryError("Bad"))
+        self.assertIsNone(geocoder.geocode("1 Street, London"))
+
+
+
+class TestCoords(unittest.TestCase):
+
+    def test_unavailable(self):
+        geocoder = FlakyGeocoder(failures=1)
+        default, geo.GEOCODER = geo.GEOCODER, geocoder
+        try:
+            # Requests don't wait for the geocoder to come back.
+            self.assertIsNone(geo.coords("1 Street, London", cache=False))
+            self.assertEqual(len(geocoder.calls), 1)
+            self.assertIsNotNone(
+                geo.coords("1 Street, London", cache=False))
+        finally:
+            geo.GEOCODER = default
+
+
+
+def main():
+    LOG.addHandler(logging.StreamHandler())
+
+    parser = argparse.ArgumentParser(
+        description="Unittest geocode.")
+    parser.add_argument(
+        "--verbose", "-v",
+        action="count", default=0,
+        help="Print verbose information for debugging.")
+    parser.add_argument(
+        "--quiet", "-q",
+        action="count", default=0,
+        help="Suppress warnings.")
+
+    args = parser.parse_args()
+
+    level = (logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG)[
+        max(0, min(3, 1 + args.verbose - args.quiet))]
+    LOG.setLevel(level)
+
+    unittest.main()
+
+
+
+if __name__ == "__main__":
+    main()
@@ -8,10 +8,17 @@ import os
 import sys
 import logging
 import argparse
+import datetime
 import unittest
 
+from sqlalchemy import create_engine
+from sqlalchemy import event as sqla_event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql import func
+
 sys.path.insert(1, os.path.join(sys.path[0], '..'))
 
+import geo
 import model
 import model_v
 
@@ -49,6 +56,392 @@ class TestModel(unittest.TestCase):
 
 
 
+class TestOrgName(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine("sqlite://")
+        # `user` uses MySQL-specific column types.
+        model.Base.metadata.create_all(engine, tables=[
+            table for table in model.Base.metadata.sorted_tables
+            if table.name != "user"
+        ])
+        self.orm = sessionmaker(bind=engine)()
+        model.attach_search(engine, self.orm, enabled=False)
+
+    def tearDown(self):
+        self.orm.close()
+
+    def search(self, name_search):
+        name_subquery = model.org_name_search_subquery(self.orm, name_search)
+        name_column = func.lower(model.org_name.c.name)
+        query = self.orm.query(model.org_name.c.name) \
+            .join(name_subquery,
+                  name_subquery.c.org_name_id ==
+                  model.org_name.c.org_name_id) \
+            .filter(name_column.contains(name_search.lower()))
+        return sorted([name for (name, ) in query])
+
+    def test_trigrams(self):
+        self.assertEqual(
+            model.org_name_trigrams("Abc"),
+            set(["abc", "bc ", "c  "]))
+
+    def test_search(self):
+        self.orm.add(model.Org("Acme Defence Systems", public=True))
+        self.orm.add(model.Org("Systematic", public=True))
+        self.orm.commit()
+        self.orm.expunge_all()
+
+        org = self.orm.query(model.Org).filter_by(name="Acme Defence Systems") \
+            .one()
+        model.Orgalias("ADS", org, public=True)
+        self.orm.commit()
+
+        self.assertEqual(self.search("a"), [
+            "ADS", "Acme Defence Systems", "Systematic"])
+        self.assertEqual(self.search("ds"), ["ADS"])
+        self.assertEqual(self.search("SYSTEM"), [
+            "Acme Defence Systems", "Systematic"])
+        self.assertEqual(self.search("defence sys"), [
+            "Acme Defence Systems"])
+        self.assertEqual(self.search("missile"), [])
+
+        org.name = "Acme Missile Systems"
+        self.orm.delete(org.orgalias_list[0])
+        self.orm.commit()
+
+        self.assertEqual(self.search("ds"), [])
+        self.assertEqual(self.search("missile"), ["Acme Missile Systems"])
+
+        self.orm.delete(org)
+        self.orm.commit()
+
+        self.assertEqual(self.search("s"), ["Systematic"])
+        self.assertEqual(self.orm.query(model.org_name_trigram).count(), 10)
+
+    def test_verify(self):
+        self.orm.add(model.Org("Acme", public=True))
+        self.orm.add(model.Org("Bolt", public=True))
+        self.orm.commit()
+        self.orm.expunge_all()
+
+        org = self.orm.query(model.Org).filter_by(name="Acme").one()
+        model.Orgalias("Acme Ltd", org, public=True)
+        self.orm.commit()
+
+        # Same number of rows, but out of date.
+        self.orm.execute(model.org_name.update()
+                         .where(model.org_name.c.name == "Bolt")
+                         .values(name="Bolt Old"))
+        self.orm.commit()
+        self.assertEqual(self.search("bolt"), ["Bolt Old"])
+
+        model.verify_org_name(self.orm)
+        self.assertEqual(self.search("bolt"), ["Bolt"])
+
+        # Same length, so only found by comparing names.
+        self.orm.execute(model.org_name.update()
+                         .where(model.org_name.c.name == "Bolt")
+                         .values(name="Volt"))
+        self.orm.commit()
+        model.verify_org_name(self.orm)
+        self.assertEqual(self.search("bolt"), [])
+        model.verify_org_name(self.orm, names=True)
+        self.assertEqual(self.search("bolt"), ["Bolt"])
+
+        model.rebuild_org_name(self.orm)
+        self.assertEqual(self.search("acme"), ["Acme", "Acme Ltd"])
+        self.assertEqual(self.orm.query(model.org_name).count(), 3)
+
+
+
+class TestTagCount(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine("sqlite://")
+        # `user` uses MySQL-specific column types.
+        model.Base.metadata.create_all(engine, tables=[
+            table for table in model.Base.metadata.sorted_tables
+            if table.name != "user"
+        ])
+        self.orm = sessionmaker(bind=engine)()
+        model.attach_search(engine, self.orm, enabled=False)
+
+    def tearDown(self):
+        self.orm.close()
+
+    def test_rebuild(self):
+        orgtag = model.Orgtag("Market | Widgets", public=True)
+        self.orm.add(orgtag)
+        self.orm.add(model.Orgtag("Market | Gadgets", public=True))
+        for i, public in enumerate((True, True, None, False)):
+            org = model.Org("Org %d" % i, public=public)
+            self.orm.add(org)
+            org.orgtag_list.append(orgtag)
+        self.orm.commit()
+
+        model.rebuild_tag_count(self.orm)
+
+        self.assertEqual(
+            self.orm.query(
+                model.tag_count.c.tag_type,
+                model.tag_count.c.tag_id,
+                model.tag_count.c.public_count,
+                model.tag_count.c.pending_count,
+                model.tag_count.c.private_count,
+            ).all(),
+            [("orgtag", orgtag.orgtag_id, 2, 1, 1)])
+
+    def test_verify(self):
+        orgtag = model.Orgtag("Market | Widgets", public=True)
+        self.orm.add(orgtag)
+        org = model.Org("Org", public=True)
+        self.orm.add(org)
+        org.orgtag_list.append(orgtag)
+        self.orm.commit()
+
+        # SQLite has no triggers to maintain the table.
+        model.verify_tag_count(self.orm)
+        self.assertEqual(
+            self.orm.query(model.tag_count.c.public_count).scalar(), 1)
+
+        self.orm.execute(model.tag_count.update().values(public_count=0))
+        self.orm.commit()
+        model.verify_tag_count(self.orm)
+        self.assertEqual(
+            self.orm.query(model.tag_count.c.public_count).scalar(), 1)
+
+
+
+class TestAddressGeobox(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine("sqlite://")
+        # `user` uses MySQL-specific column types.
+        model.Base.metadata.create_all(engine, tables=[
+            table for table in model.Base.metadata.sorted_tables
+            if table.name != "user"
+        ])
+        self.orm = sessionmaker(bind=engine)()
+        self.orm.execute(model.Address.__table__.insert(), [
+            {"a_time": 0, "postal": postal, "source": "test",
+             "latitude": latitude, "longitude": longitude}
+            for postal, latitude, longitude in (
+                ("London", 51.5, -0.1),
+                ("Canterbury", 51.28, 1.08),
+                ("Fiji", -17.7, 178.1),
+                ("Samoa", -13.8, -172.1),
+                ("Unknown", None, None),
+            )
+        ])
+
+    def tearDown(self):
+        self.orm.close()
+
+    def postal(self, geobox):
+        query = model.Address.filter_geobox(
+            self.orm.query(model.Address.postal), geobox)
+        return sorted([postal for (postal, ) in query])
+
+    def test_geobox(self):
+        self.assertEqual(
+            self.postal(geo.Geobox(51, 52, -1, 0.5)), ["London"])
+        self.assertEqual(
+            self.postal(geo.Geobox(50, 60, -10, 10)),
+            ["Canterbury", "London"])
+
+    def test_antimeridian(self):
+        self.assertEqual(
+            self.postal(geo.Geobox(-20, -10, 170, -170)), ["Fiji", "Samoa"])
+
+
+
+class TestVirtualOrgtag(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine("sqlite://")
+        # `user` uses MySQL-specific column types.
+        model.Base.metadata.create_all(engine, tables=[
+            table for table in model.Base.metadata.sorted_tables
+            if table.name != "user"
+        ])
+        self.orm = sessionmaker(bind=engine)()
+        model.attach_search(engine, self.orm, enabled=False)
+
+        self.virtual_tag = model.Orgtag("Activity | Military", public=False)
+        self.virtual_tag.is_virtual = True
+        self.orgtag = model.Orgtag("Activity | Missiles", public=True)
+        self.org_list = [
+            model.Org("Org %d" % i, public=True) for i in range(3)]
+        self.orm.add_all([self.virtual_tag, self.orgtag] + self.org_list)
+        self.orm.commit()
+
+    def tearDown(self):
+        self.orm.close()
+
+    def tagged(self):
+        return sorted([org_id for (org_id, ) in self.orm.query(
+            model.org_orgtag.c.org_id
+        ).filter(
+            model.org_orgtag.c.orgtag_id == self.virtual_tag.orgtag_id)])
+
+    def test_edit(self):
+        org1, org2 = self.org_list[:2]
+        org1.orgtag_list.append(self.orgtag)
+        org2.orgtag_list.append(self.orgtag)
+        self.orm.commit()
+        self.assertEqual(self.tagged(), [org1.org_id, org2.org_id])
+        self.assertIn(self.virtual_tag, org1.orgtag_list)
+
+        org1.orgtag_list.remove(self.orgtag)
+        self.orm.commit()
+        self.assertEqual(self.tagged(), [org2.org_id])
+        self.assertEqual(org1.orgtag_list, [])
+
+    def test_update_all(self):
+        org1, org2, org3 = self.org_list
+        self.orm.execute(model.org_orgtag.insert(), [
+            {"org_id": org1.org_id, "orgtag_id": self.orgtag.orgtag_id},
+            {"org_id": org2.org_id, "orgtag_id": self.orgtag.orgtag_id},
+            {"org_id": org3.org_id, "orgtag_id": self.virtual_tag.orgtag_id},
+        ])
+        model.update_all_virtual_orgtags(self.orm)
+        self.assertEqual(self.tagged(), [org1.org_id, org2.org_id])
+
+
+
+class TestDetailOptions(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+        # `user` uses MySQL-specific column types.
+        model.Base.metadata.create_all(self.engine, tables=[
+            table for table in model.Base.metadata.sorted_tables
+            if table.name != "user"
+        ])
+        self.orm = sessionmaker(bind=self.engine)()
+        model.attach_search(self.engine, self.orm, enabled=False)
+
+        self.statement_count = 0
+        sqla_event.listen(
+            self.engine, "before_cursor_execute", self.count_statement)
+
+    def tearDown(self):
+        self.orm.close()
+
+    def count_statement(self, *_args):
+        self.statement_count += 1
+
+    def add_org(self, n):
+        org = model.Org("Org %d" % n, public=True)
+        self.orm.add(org)
+        self.orm.commit()
+        self.orm.expunge_all()
+
+        org = self.orm.query(model.Org).filter_by(name="Org %d" % n).one()
+        medium = self.orm.query(model.Medium).first() or \
+            model.Medium("Email")
+        event = model.Event(
+            "Event %d" % n,
+            datetime.date(2017, 9, 12), datetime.date(2017, 9, 15),
+            public=True)
+        for i in range(3):
+            org.address_list.append(model.Address(
+                "%d Street" % i, "test", latitude=51, longitude=0,
+                public=True))
+            org.orgtag_list.append(model.Orgtag(
+                "Tag %d %d" % (n, i), public=True))
+            org.contact_list.append(model.Contact(
+                medium, "%d@example.com" % i, public=True))
+            event.address_list.append(model.Address(
+                "%d Road" % i, "test", latitude=51, longitude=0,
+                public=True))
+            event.contact_list.append(model.Contact(
+                medium, "%d@example.net" % i, public=True))
+        model.Orgalias("Alias %d" % n, org, public=True)
+        org.event_list.append(event)
+        self.orm.commit()
+        self.orm.expunge_all()
+
+    def test_org(self):
+        for n in range(2):
+            self.add_org(n)
+
+        for all_visible in (True, False):
+            self.statement_count = 0
+            org_list = self.orm.query(model.Org) \
+                .options(*model.Org.detail_options(all_visible)) \
+                .all()
+            for org in org_list:
+                suffix = not all_visible and "_public" or ""
+                for name in ("address_list", "orgtag_list", "event_list",
+                             "orgalias_list", "contact_list"):
+                    self.assertTrue(getattr(org, name + suffix))
+                for contact in getattr(org, "contact_list" + suffix):
+                    self.assertEqual(contact.medium.name, "Email")
+            self.assertEqual(self.statement_count, 6)
+            self.orm.expunge_all()
+
+    def test_event(self):
+        for n in range(2):
+            self.add_org(n)
+
+        for all_visible in (True, False):
+            self.statement_count = 0
+            event_list = self.orm.query(model.Event) \
+                .options(*model.Event.detail_options(all_visible)) \
+                .all()
+            for event in event_list:
+                suffix = not all_visible and "_public" or ""
+                for name in ("org_list", "address_list", "contact_list"):
+                    self.assertTrue(getattr(event, name + suffix))
+                for contact in getattr(event, "contact_list" + suffix):
+                    self.assertEqual(contact.medium.name, "Email")
+            self.assertEqual(self.statement_count, 5)
+            self.orm.expunge_all()
+
+
+
+class TestHistory(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine("sqlite://")
+        model_v.history.create(engine)
+        self.orm = sessionmaker(bind=engine)()
+
+        for history_id, a_time, user_id in (
+                (1, 100.0, 1),
+                (2, 100.0, 2),
+                (3, 100.5, 1),
+        ):
+            self.orm.execute(model_v.history.insert().values(
+                history_id=history_id, type="organisation",
+                entity_id=1, entity_v_id=history_id, a_time=a_time,
+                moderation_user_id=user_id))
+        self.orm.commit()
+
+    def tearDown(self):
+        self.orm.close()
+
+    def test_cursor(self):
+        cursor = model_v.history_cursor({"date": 100.5, "history_id": 3})
+        self.assertEqual(model_v.parse_history_cursor(cursor), (100.5, 3))
+        for text in ("", "100.5", "a:3", "100.5:3:1"):
+            with self.assertRaises(ValueError):
+                model_v.parse_history_cursor(text)
+
+    def test_count(self):
+        self.assertEqual(model_v.count_history(self.orm), 3)
+        self.assertEqual(model_v.count_history(self.orm, 1), 2)
+        self.assertEqual(model_v.count_history(self.orm, 3), 0)
+
+    def test_exists(self):
+        # pylint: disable=protected-access
+        # Test keyset comparison with equal `a_time`.
+        exists = model_v._history_exists
+        self.assertTrue(exists(self.orm, None, "<", "100.0:2"))
+        self.assertFalse(exists(self.orm, None, "<", "100.0:1"))
+        self.assertTrue(exists(self.orm, None, ">", "100.0:2"))
+        self.assertFalse(exists(self.orm, None, ">", "100.5:3"))
+        self.assertFalse(exists(self.orm, 2, "<", "100.0:2"))
+        self.assertTrue(exists(self.orm, 1, ">", "100.0:2"))
+
+
+
 def main():
     LOG.addHandler(logging.StreamHandler())
 
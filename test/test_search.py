@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+
+# pylint: disable=wrong-import-position,import-error
+# Allow appending to import path before import
+# Must also specify `PYTHONPATH` when invoking Pylint.
+
+import os
+import sys
+import logging
+import argparse
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+import pyelasticsearch
+
+import model
+from search import search
+
+
+
+LOG = logging.getLogger('test_search')
+
+
+
+class FakeOrg(object):
+    def __init__(self, org_id):
+        self.org_id = org_id
+        self.name = "Org %d" % org_id
+        self.public = True
+        self.orgalias_list = []
+        self.orgalias_list_public = []
+
+
+
+class FakeSession(object):
+    def close(self):
+        pass
+
+
+
+class FakeSearch(object):
+    """
+    Records bulk requests, failing the first `failures`, and rejecting
+    the actions for org IDs in `rejects` once each.
+    """
+
+    def __init__(self, failures=0, rejects=()):
+        self.failures = failures
+        self.rejects = set(rejects)
+        self.requests = []
+
+    @staticmethod
+    def index_op(doc, **meta):
+        return ("index", meta["id"], doc["name"])
+
+    @staticmethod
+    def delete_op(**meta):
+        return ("delete", meta["id"])
+
+    def bulk(self, actions, **_kwargs):
+        if self.failures:
+            self.failures -= 1
+            raise pyelasticsearch.exceptions.Timeout("Timed out")
+        self.requests.append(actions)
+        errors = [
+            {action[0]: {"_id": str(action[1]), "status": 429}}
+            for action in actions if action[1] in self.rejects
+        ]
+        if errors:
+            self.rejects.clear()
+            raise pyelasticsearch.exceptions.BulkError(errors, [])
+
+
+
+class FakeIndex(object):
+    "Stores documents by ID and answers the queries `verify` makes."
+
+    def __init__(self, docs):
+        self.docs = docs
+
+    @staticmethod
+    def index_op(doc, **meta):
+        return ("index", meta["id"], doc)
+
+    @staticmethod
+    def delete_op(**meta):
+        return ("delete", meta["id"])
+
+    def bulk(self, actions, **_kwargs):
+        for action in actions:
+            if action[0] == "index":
+                self.docs[action[1]] = action[2]
+            else:
+                del self.docs[action[1]]
+
+    def search(self, query, **_kwargs):
+        org_id_list = sorted(self.docs)
+        if "sort" in query:
+            org_id_list.reverse()
+        else:
+            bounds = query["query"]["range"]["org_id"]
+            org_id_list = [
+                org_id for org_id in org_id_list
+                if bounds["gte"] <= org_id < bounds["lt"]]
+        return {"hits": {"hits": [
+            {"_source": self.docs[org_id]}
+            for org_id in org_id_list[:query["size"]]
+        ]}}
+
+
+
+class TestNameSearch(unittest.TestCase):
+    def test_query(self):
+        query = search.name_search_query("acme", offset=20, size=10)
+        self.assertEqual(
+            query["query"]["filtered"]["filter"], {"term": {"public": 1}})
+        self.assertEqual((query["from"], query["size"]), (20, 10))
+        # Equal scores are ordered so pages don't overlap.
+        self.assertEqual(query["sort"][-1], {"org_id": {"order": "asc"}})
+
+        query = search.name_search_query("acme", public=False)
+        self.assertEqual(
+            query["query"]["multi_match"]["query"], "acme")
+
+
+
+class TestVerify(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine("sqlite://")
+        # `user` uses MySQL-specific column types.
+        model.Base.metadata.create_all(engine, tables=[
+            table for table in model.Base.metadata.sorted_tables
+            if table.name != "user"
+        ])
+        self.orm = sessionmaker(bind=engine)()
+        model.attach_search(engine, self.orm, enabled=False)
+
+        for name in ("Acme", "Bolt", "Crane"):
+            self.orm.add(model.Org(name, public=True))
+        self.orm.commit()
+        self.orm.expunge_all()
+
+        for org in self.orm.query(model.Org):
+            model.Orgalias(org.name + " Ltd", org, public=True)
+            model.Orgalias(org.name + " Inc", org, public=False)
+        self.orm.commit()
+
+    def tearDown(self):
+        self.orm.close()
+
+    def test_docs(self):
+        docs = search.org_docs(self.orm, model.Org, model.Orgalias, 0, 10)
+        for org in self.orm.query(model.Org):
+            self.assertEqual(docs[org.org_id], search.org_doc(org))
+        self.assertEqual(docs[1]["alias_public"], ["Acme", "Acme Ltd"])
+        self.assertEqual(
+            docs[1]["alias_all"], ["Acme", "Acme Ltd", "Acme Inc"])
+
+    def test_verify_buckets(self):
+        docs = search.org_docs(self.orm, model.Org, model.Orgalias, 0, 10)
+        es = FakeIndex({
+            1: docs[1],
+            2: dict(docs[2], name="Bolt Old"),
+            3000: dict(docs[3], org_id=3000),
+        })
+
+        self.assertEqual(
+            search.verify_buckets(es, self.orm, model.Org, model.Orgalias),
+            (2, 1))
+        self.assertEqual(es.docs, docs)
+        self.assertEqual(
+            search.verify_buckets(es, self.orm, model.Org, model.Orgalias),
+            (0, 0))
+
+
+
+class TestIndexQueue(unittest.TestCase):
+
+    @staticmethod
+    def query_orgs(_orm, org_id_list):
+        # Org 3 has been deleted since it was queued.
+        return [FakeOrg(org_id) for org_id in org_id_list if org_id != 3]
+
+    def index_queue(self, es, **kwargs):
+        return search.IndexQueue(
+            es, FakeSession, self.query_orgs, retry_wait=0, **kwargs)
+
+    def test_batch(self):
+        es = FakeSearch()
+        queue = self.index_queue(es, batch_size=2)
+        with queue.condition:
+            # Hold the worker until everything is queued.
+            queue.put({1: queue.INDEX, 2: queue.INDEX})
+            queue.put({1: queue.DELETE, 3: queue.INDEX})
+        self.assertTrue(queue.join(5))
+
+        self.assertEqual(es.requests, [
+            [("index", 2, "Org 2"), ("delete", 1)],
+            [("delete", 3)],
+        ])
+        self.assertEqual(queue.stats()["sent"], 3)
+
+    def test_retry(self):
+        es = FakeSearch(failures=2)
+        queue = self.index_queue(es, attempts=3)
+        queue.put({1: queue.INDEX})
+        self.assertTrue(queue.join(5))
+        self.assertEqual(len(es.requests), 1)
+        self.assertEqual(queue.retries, 2)
+
+        es.failures = 3
+        queue.put({2: queue.INDEX})
+        self.assertTrue(queue.join(5))
+        self.assertEqual(len(es.requests), 1)
+        self.assertEqual(queue.dead_letters, 1)
+
+    def test_partial_retry(self):
+        es = FakeSearch(rejects=[2])
+        queue = self.index_queue(es)
+        queue.put({1: queue.INDEX, 2: queue.INDEX})
+        self.assertTrue(queue.join(5))
+        # Only the rejected action is resent...
+        self.assertEqual(es.requests, [
+            [("index", 1, "Org 1"), ("index", 2, "Org 2")],
+            [("index", 2, "Org 2")],
+        ])
+        # ...and each operation is counted once.
+        self.assertEqual(queue.stats()["sent"], 2)
+        self.assertEqual(queue.stats()["batches"], 1)
+
+
+
+def main():
+    LOG.addHandler(logging.StreamHandler())
+
+    parser = argparse.ArgumentParser(
+        description="Unittest search.")
+    parser.add_argument(
+        "--verbose", "-v",
+        action="count", default=0,
+        help="Print verbose information for debugging.")
+    parser.add_argument(
+        "--quiet", "-q",
+        action="count", default=0,
+        help="Suppress warnings.")
+
+    args = parser.parse_args()
+
+    level = (logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG)[
+        max(0, min(3, 1 + args.verbose - args.quiet))]
+    LOG.setLevel(level)
+
+    unittest.main()
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import logging
+import argparse
+
+from sqlalchemy import create_engine, and_, exists
+from sqlalchemy.orm import sessionmaker
+from tornado.ioloop import IOLoop
+
+from model import mysql, CONF_PATH
+from model import User, Address
+from model_v import moderation_pending
+from geo import GoogleGeocoder, FakeGeocoder
+from geocode import GeocodeStore, BatchGeocoder, LOG as LOG_GEOCODE
+
+
+
+LOG = logging.getLogger('geocode_addresses')
+
+GEOCODERS = {
+    "google": GoogleGeocoder,
+    "fake": FakeGeocoder,
+}
+
+
+
+def missing_address_query(orm):
+    """
+    Addresses without coordinates. Addresses with revisions awaiting
+    moderation are left alone, since saving would hide those revisions.
+    """
+    # pylint: disable=singleton-comparison
+    # Cannot use `is` in SQLAlchemy filters
+
+    return orm.query(Address) \
+        .filter(and_(
+            Address.latitude == None,
+            Address.manual_latitude == None,
+        )) \
+        .filter(~exists().where(and_(
+            moderation_pending.c.entity_type == Address.__tablename__,
+            moderation_pending.c.entity_id == Address.address_id,
+        )))
+
+
+
+def geocode_addresses(orm, batch, limit=None):
+    system_user = orm.query(User).filter_by(user_id=-1).one()
+
+    query = missing_address_query(orm)
+    if limit:
+        query = query.limit(limit)
+    address_list = query.all()
+
+    lookup_dict = {}
+    for address in address_list:
+        lookup_dict.setdefault(address.lookup or address.postal, []) \
+            .append(address)
+
+    LOG.info("%d addresses without coordinates.", len(address_list))
+
+    results = IOLoop.current().run_sync(
+        lambda: batch.geocode_all(list(lookup_dict)))
+
+    found = 0
+    for lookup, coords in results.items():
+        if not coords:
+            continue
+        for address in lookup_dict[lookup]:
+            (address.latitude, address.longitude) = coords
+            address.moderation_user = system_user
+            found += 1
+
+    orm.commit()
+
+    LOG.info("Geocoded %d of %d addresses with %d lookups and %d retries.",
+             found, len(address_list), batch.lookups, batch.retries)
+
+
+
+def main():
+    LOG.addHandler(logging.StreamHandler())
+    LOG_GEOCODE.addHandler(logging.StreamHandler())
+
+    parser = argparse.ArgumentParser(
+        description="Geocode addresses that have no coordinates.")
+    parser.add_argument(
+        "--verbose", "-v",
+        action="count", default=0,
+        help="Print verbose information for debugging.")
+    parser.add_argument(
+        "--quiet", "-q",
+        action="count", default=0,
+        help="Suppress warnings.")
+
+    parser.add_argument(
+        "--geocoder", "-g",
+        choices=sorted(GEOCODERS), default="google",
+        help="Geocoder to use. Default: %(default)s.")
+    parser.add_argument(
+        "--store", "-s",
+        default="geocode.sqlite",
+        help="SQLite file in which to keep results. Default: %(default)s.")
+    parser.add_argument(
+        "--concurrency", "-c",
+        type=int, default=4,
+        help="Number of concurrent lookups. Default: %(default)s.")
+    parser.add_argument(
+        "--rate", "-r",
+        type=float, default=10,
+        help="Maximum lookups per second. Default: %(default)s.")
+    parser.add_argument(
+        "--limit", "-l",
+        type=int,
+        help="Maximum number of addresses to geocode.")
+
+    args = parser.parse_args()
+
+    log_level = (logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG,)[
+        max(0, min(3, 1 + args.verbose - args.quiet))]
+    LOG.setLevel(log_level)
+    LOG_GEOCODE.setLevel(log_level)
+
+    connection_url = mysql.connection_url_app(CONF_PATH)
+    engine = create_engine(connection_url,)
+    session_factory = sessionmaker(
+        bind=engine, autocommit=False, autoflush=False)
+    orm = session_factory()
+
+    store = GeocodeStore(args.store)
+    batch = BatchGeocoder(
+        GEOCODERS[args.geocoder](), store,
+        concurrency=args.concurrency, rate=args.rate)
+
+    try:
+        geocode_addresses(orm, batch, limit=args.limit)
+    finally:
+        store.close()
+
+
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,7 @@ sys.path.append(".")
 
 from model import mysql, CONF_PATH
 from model import Auth, User
+from handle.base_moderation import rebuild_moderation_pending
 
 
 
@@ -84,6 +85,10 @@ def main():
         user.locked = args.lock
     orm.commit()
 
+    if args.moderator is not None:
+        # Triggers don't update the queue for revisions already made.
+        rebuild_moderation_pending(orm)
+
 
 
 if __name__ == "__main__":
@@ -8,8 +8,8 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
 from model import mysql, CONF_PATH, attach_search
-from model import User, Org, Orgtag, \
-    VIRTUAL_ORGTAG_LIST, virtual_org_orgtag_all
+from model import User, Orgtag, \
+    VIRTUAL_ORGTAG_LIST, update_virtual_orgtags, update_all_virtual_orgtags
 from model import LOG as LOG_MODEL
 
 
@@ -18,14 +18,6 @@ LOG = logging.getLogger('set_virtual_tags')
 
 
 
-def shell_red(text):
-    return "\033[91m%s\033[0m" % text
-
-def shell_blue(text):
-    return "\033[94m%s\033[0m" % text
-
-
-
 def create_all_virtual_orgtags(orm, system_user):
     for virtual_name, _filter_search in VIRTUAL_ORGTAG_LIST:
         LOG.info(virtual_name)
@@ -51,23 +43,11 @@ def create_all_virtual_orgtags(orm, system_user):
 
 
 
-def check_orgtags(orm, org_id_list=None):
-    query = orm.query(Org)
-    if org_id_list:
-        query = query.filter(Org.org_id.in_(org_id_list))
-
-    total = query.count()
-    for i, org in enumerate(query.all(), 1):
-        if i % 100 == 0:
-            LOG.info("%5d/%d", i, total)
-        LOG.debug(shell_blue(org.name))
-
-        if LOG.level == logging.DEBUG:
-            before = [orgtag.orgtag_id for orgtag in org.orgtag_list]
-        virtual_org_orgtag_all(org)
-        if LOG.level == logging.DEBUG:
-            if before != [orgtag.orgtag_id for orgtag in org.orgtag_list]:
-                LOG.warning(shell_red("Changed: %s" % org.name))
+def check_orgtags(orm, org_id_list, batch_size=1000):
+    connection = orm.connection()
+    for i in range(0, len(org_id_list), batch_size):
+        LOG.info("%5d/%d", i, len(org_id_list))
+        update_virtual_orgtags(connection, org_id_list[i:i + batch_size])
 
     orm.commit()
 
@@ -115,7 +95,7 @@ def main():
     attach_search(engine, orm)
 
     try:
-        org_id_list = [int(arg) for arg in args]
+        org_id_list = [int(arg) for arg in args.org_id]
     except ValueError:
         LOG.error("Could not convert all arguments to integers.")
         parser.print_usage()
@@ -129,7 +109,10 @@ def main():
         create_all_virtual_orgtags(orm, system_user)
         return
 
-    check_orgtags(orm, org_id_list)
+    if org_id_list:
+        check_orgtags(orm, org_id_list)
+    else:
+        update_all_virtual_orgtags(orm)
 
 
 
@@ -5,7 +5,7 @@ import math
 import logging
 import argparse
 
-from sqlalchemy import create_engine, and_
+from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
 from mako.lookup import TemplateLookup
@@ -14,6 +14,7 @@ from model import mysql, CONF_PATH, attach_search
 from model import Org, Orgtag, Address
 from model import org_orgtag, org_address
 from model import LOG as LOG_MODEL
+from geo import Geobox
 
 
 
@@ -37,15 +38,9 @@ def svg_map(orm, orgtag_name_short):
         ) \
         .join(org_address, org_address.c.org_id == Org.org_id) \
         .join(Address, Address.address_id == org_address.c.address_id) \
-        .add_columns(Address.address_id, Address.latitude, Address.longitude) \
-        .filter(and_(
-            Address.latitude != None,
-            Address.longitude != None,
-            Address.latitude >= uk_south,
-            Address.latitude <= uk_north,
-            Address.longitude >= uk_west,
-            Address.longitude <= uk_east,
-        ))
+        .add_columns(Address.address_id, Address.latitude, Address.longitude)
+    query = Address.filter_geobox(
+        query, Geobox(uk_south, uk_north, uk_west, uk_east))
 
     lookup = TemplateLookup(
         directories=['tools'],